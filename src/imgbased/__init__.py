@@ -27,6 +27,7 @@ import argparse
 from .imgbase import constants
 from .imgbase import ImageLayers
 from .hooks import Hooks
+from .profiling import Profiler
 from . import plugins
 
 log = logging.getLogger()
@@ -47,7 +48,32 @@ class Application(object):
         plugins.init(self)
 
 
+def _profiler_from_args(args):
+    """The profiler needs to run before the plugins get initialized,
+    thus the profiling arguments are looked at before the real parsing
+    """
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("--profile", action="store_true")
+    parser.add_argument("--profile-output")
+    known, _ = parser.parse_known_args(sys.argv[1:] if args is None
+                                       else args)
+    if known.profile or known.profile_output:
+        return Profiler(output=known.profile_output)
+
+
 def CliApplication(args=None):
+    profiler = _profiler_from_args(args)
+    if profiler:
+        profiler.start()
+    try:
+        _run_cli(args)
+    finally:
+        if profiler:
+            profiler.stop()
+            sys.stderr.write(profiler.report() + "\n")
+
+
+def _run_cli(args):
     log.debug("Version: %s" % constants.version())
 
     app = Application()
@@ -63,6 +89,11 @@ def CliApplication(args=None):
     parser.add_argument("--experimental", action="store_true",
                         help="Enable experimental functionality")
     parser.add_argument("--stream", default="Image")
+    parser.add_argument("--profile", action="store_true",
+                        help="Print the time spent in plugins and hooks")
+    parser.add_argument("--profile-output", metavar="PATH",
+                        help="Write cProfile statistics (pstats) to PATH, "
+                        "implies --profile")
 
     app.hooks.emit("pre-arg-parse", parser, subparsers)
 
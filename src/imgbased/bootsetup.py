@@ -7,6 +7,7 @@ from .bootloader import BootConfiguration
 from .command import chroot
 from .lvm import LVM
 from .naming import Layer
+from .timeline import step
 
 log = logging.getLogger(__package__)
 
@@ -51,8 +52,9 @@ class BootSetupHandler(object):
         log.debug("Regenerating initrd for %s", initrd)
         initrd_in_root = "/boot/" + os.path.basename(initrd)
         with utils.bindmounted("/proc", self._root + "/proc"):
-            chroot(["dracut", "-f", "--add", "multipath",
-                   initrd_in_root, kver], self._root)
+            with step("dracut"):
+                chroot(["dracut", "-f", "--add", "multipath",
+                       initrd_in_root, kver], self._root)
 
     def _install_kernel(self, b, title, cmdline, kfiles):
         bootdir = "/boot/{}".format(self._lv.lv_name)
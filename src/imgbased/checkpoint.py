@@ -0,0 +1,252 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# imgbase
+#
+# Copyright (C) 2018  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import functools
+import hashlib
+import json
+import logging
+import os
+import threading
+
+
+log = logging.getLogger(__package__)
+
+
+class CheckpointError(Exception):
+    pass
+
+
+class Checkpoint(object):
+    """Durable record of the finished phases of an update, which allows to
+    resume a failed update
+
+    Only one checkpoint is active at a time, code which wants to be
+    skipped once it finished uses the module level phase() decorator:
+
+    >>> import tempfile
+    >>> path = tempfile.mkdtemp() + "/checkpoint.json"
+    >>> calls = []
+    >>> @phase("migrate")
+    ... def migrate(path):
+    ...     calls.append(path)
+
+    >>> c = Checkpoint.start(path, "image.squashfs.img", inputs={"a": 1})
+    >>> c.record(base="Image-2.0-0")
+    >>> migrate("/etc")
+    >>> c.stop()
+
+    >>> c = Checkpoint.start(path, "image.squashfs.img", resume=True,
+    ...                      inputs={"a": 1})
+    >>> c.get("base")
+    'Image-2.0-0'
+    >>> migrate("/etc")
+    >>> migrate("/root")
+    >>> calls
+    ['/etc', '/root']
+
+    The phases depend on the inputs of the whole update (i.e. the
+    configuration) as well, if they changed every phase runs again:
+
+    >>> c.stop()
+    >>> c = Checkpoint.start(path, "image.squashfs.img", resume=True,
+    ...                      inputs={"a": 2})
+    >>> migrate("/etc")
+    >>> calls
+    ['/etc', '/root', '/etc']
+
+    A phase which started but did not finish was interrupted:
+
+    >>> @phase("broken")
+    ... def broken():
+    ...     raise RuntimeError()
+    >>> broken()
+    Traceback (most recent call last):
+    ...
+    RuntimeError
+    >>> c.interrupted()
+    ['broken']
+
+    >>> c.finish()
+    >>> Checkpoint.load(path) is None
+    True
+    """
+    _active = None
+
+    path = None
+    key = None
+
+    def __init__(self, path, key, state=None):
+        self.path = path
+        self.key = key
+        self._state = state or {"key": key, "inputs": None, "info": {},
+                                "started": [], "done": []}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def active(cls):
+        return cls._active
+
+    @classmethod
+    def load(cls, path):
+        """Returns the checkpoint stored in path, or None
+        """
+        try:
+            with open(path) as src:
+                state = json.load(src)
+        except (IOError, OSError, ValueError):
+            return None
+        return cls(path, state["key"], state)
+
+    @classmethod
+    def start(cls, path, key, resume=False, inputs=None):
+        """Start checkpointing an update of key, or resume it
+
+        inputs is a JSON serializable description of everything the
+        phases depend on besides their arguments
+        """
+        inputs = _fingerprint([json.dumps(inputs, sort_keys=True)])
+        if resume:
+            checkpoint = cls.load(path)
+            if checkpoint is None or checkpoint.key != key:
+                raise CheckpointError("There is no failed update of %s to "
+                                      "resume" % key)
+            log.info("Resuming the update, finished phases: %s" %
+                     ", ".join(checkpoint._state["done"]))
+            for name in checkpoint.interrupted():
+                log.warning("Phase %s was interrupted by the failed update, "
+                            "it runs again" % name)
+            if checkpoint.inputs != inputs:
+                log.warning("The configuration or the running layer changed "
+                            "since the failed update, all phases run again")
+        else:
+            checkpoint = cls(path, key)
+        checkpoint._state["inputs"] = inputs
+        checkpoint._state["started"] = []
+        checkpoint._write()
+        cls._active = checkpoint
+        return checkpoint
+
+    def _write(self):
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as dst:
+            json.dump(self._state, dst, sort_keys=True)
+            dst.flush()
+            os.fsync(dst.fileno())
+        os.rename(tmp, self.path)
+        fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def record(self, **info):
+        """Durably record information about the update
+        """
+        with self._lock:
+            self._state["info"].update(info)
+            self._write()
+
+    def get(self, name):
+        return self._state["info"].get(name)
+
+    @property
+    def inputs(self):
+        return self._state.get("inputs")
+
+    def is_done(self, name):
+        return name in self._state["done"]
+
+    def mark_started(self, name):
+        with self._lock:
+            self._state.setdefault("started", []).append(name)
+            self._write()
+
+    def mark_done(self, name):
+        with self._lock:
+            self._state["done"].append(name)
+            self._write()
+
+    def interrupted(self):
+        """Returns the names of the phases which started, but did not
+        finish
+        """
+        done = set(self._state["done"])
+        return sorted(set(started.split(":")[0]
+                          for started in self._state.get("started", [])
+                          if started not in done))
+
+    def stop(self):
+        """Stop checkpointing, the checkpoint is kept to resume later
+        """
+        Checkpoint._active = None
+
+    def finish(self):
+        """The update finished, the checkpoint is not needed anymore
+        """
+        self.stop()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+def _fingerprint(args):
+    """Identify the arguments of a phase, volumes by their name
+
+    Other objects (i.e. the ImageLayers) are only identified by their
+    type, what they stand for is part of the inputs of the checkpoint.
+
+    >>> _fingerprint(["/etc", None]) == _fingerprint(["/etc", None])
+    True
+    >>> _fingerprint(["/etc"]) == _fingerprint(["/root"])
+    False
+    """
+    parts = [getattr(a, "lvm_name", None) or
+             (repr(a) if isinstance(a, (str, list, tuple, type(None)))
+              else type(a).__name__)
+             for a in args]
+    return hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()[:16]
+
+
+def phase(name):
+    """Skip the function if it finished with the same inputs before the
+    active checkpoint was resumed
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            checkpoint = Checkpoint.active()
+            if checkpoint is None:
+                return func(*args, **kwargs)
+            done = "%s:%s" % (name, _fingerprint([checkpoint.inputs] +
+                                                 list(args) +
+                                                 sorted(kwargs.items())))
+            if checkpoint.is_done(done):
+                log.info("Phase %s finished before, skipping" % name)
+                return None
+            checkpoint.mark_started(done)
+            result = func(*args, **kwargs)
+            checkpoint.mark_done(done)
+            return result
+        return wrapper
+    return decorator
+
+# vim: sw=4 et sts=4:
@@ -0,0 +1,512 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# imgbase
+#
+# Copyright (C) 2018  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import errno
+import logging
+import os
+import shutil
+import stat
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger(__package__)
+
+
+class CopyError(Exception):
+    pass
+
+
+class CopyStats(object):
+    """What was copied by a TreeCopier
+    """
+    def __init__(self):
+        self.files = 0
+        self.dirs = 0
+        self.symlinks = 0
+        self.hardlinks = 0
+        self.specials = 0
+        self.bytes = 0
+        # Like bytes, but advanced while a file is copied
+        self.copied = 0
+        # Only differs from bytes when mirroring
+        self.written = 0
+        self.unchanged = 0
+        self.removed = 0
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, **counts):
+        with self._lock:
+            for k, v in counts.items():
+                setattr(self, k, getattr(self, k) + v)
+
+    def entries(self):
+        return self.files + self.dirs + self.symlinks + self.hardlinks + \
+            self.specials
+
+    def __repr__(self):
+        return "<CopyStats files=%d dirs=%d symlinks=%d hardlinks=%d " \
+            "specials=%d bytes=%d />" % (self.files, self.dirs,
+                                         self.symlinks, self.hardlinks,
+                                         self.specials, self.bytes)
+
+
+def _copy_xattrs(src, dst):
+    """Copy all extended attributes, this includes POSIX ACLs
+    (system.posix_acl_*), file capabilities and SELinux labels
+    """
+    for name in os.listxattr(src, follow_symlinks=False):
+        value = os.getxattr(src, name, follow_symlinks=False)
+        os.setxattr(dst, name, value, follow_symlinks=False)
+
+
+def _xattrs(path):
+    return dict((name, os.getxattr(path, name, follow_symlinks=False))
+                for name in os.listxattr(path, follow_symlinks=False))
+
+
+def _metadata_differs(src, dst, st, dst_st, owner):
+    if owner + (st.st_mode, st.st_mtime_ns) != \
+            (dst_st.st_uid, dst_st.st_gid, dst_st.st_mode,
+             dst_st.st_mtime_ns):
+        return True
+    return _xattrs(src) != _xattrs(dst)
+
+
+def _same_content(src, dst, chunk_size=1024 * 1024):
+    with open(src, "rb") as a, open(dst, "rb") as b:
+        while True:
+            chunk = a.read(chunk_size)
+            if chunk != b.read(chunk_size):
+                return False
+            if not chunk:
+                return True
+
+
+def _remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    else:
+        os.unlink(path)
+
+
+def _copy_metadata(src, dst, st, owner):
+    """Ownership first, a chown clears setuid bits and capabilities
+    """
+    os.chown(dst, owner[0], owner[1], follow_symlinks=False)
+    if not stat.S_ISLNK(st.st_mode):
+        os.chmod(dst, stat.S_IMODE(st.st_mode))
+    _copy_xattrs(src, dst)
+    os.utime(dst, ns=(st.st_atime_ns, st.st_mtime_ns),
+             follow_symlinks=False)
+
+
+def data_segments(fd, size):
+    """Returns the (offset, length) of the regions of fd which contain
+    data, holes are skipped
+
+    >>> import tempfile
+    >>> with tempfile.TemporaryFile() as f:
+    ...     _ = f.write(b"a")
+    ...     f.flush()
+    ...     list(data_segments(f.fileno(), 1))
+    [(0, 1)]
+    """
+    segments = []
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                # Only a hole is left
+                break
+            raise
+        end = os.lseek(fd, start, os.SEEK_HOLE)
+        segments.append((start, min(end, size) - start))
+        offset = end
+    return segments
+
+
+class TreeCopier(object):
+    """Copy a tree natively, file data is copied by a pool of workers
+
+    Hardlinks, sparse files, ownership, modes, timestamps and extended
+    attributes (which covers ACLs and SELinux labels) are preserved.
+
+    >>> import tempfile
+    >>> src, dst = tempfile.mkdtemp(), tempfile.mkdtemp()
+    >>> os.mkdir(src + "/etc")
+    >>> with open(src + "/etc/motd", "w") as f:
+    ...     _ = f.write("Hello")
+    >>> os.link(src + "/etc/motd", src + "/etc/issue")
+    >>> os.symlink("motd", src + "/etc/motd.link")
+
+    >>> stats = TreeCopier(workers=2).sync(src, dst)
+    >>> stats
+    <CopyStats files=1 dirs=1 symlinks=1 hardlinks=1 specials=0 bytes=5 />
+    >>> open(dst + "/etc/issue").read()
+    'Hello'
+    >>> os.path.samefile(dst + "/etc/issue", dst + "/etc/motd")
+    True
+    >>> os.readlink(dst + "/etc/motd.link")
+    'motd'
+
+    In mirror mode the destination is made identical to the source, only
+    entries which differ in content or metadata are written, and entries
+    which are not in the source are removed:
+
+    >>> with open(src + "/etc/motd", "w") as f:
+    ...     _ = f.write("Bye")
+    >>> os.unlink(src + "/etc/motd.link")
+    >>> with open(src + "/etc/fstab", "w") as f:
+    ...     _ = f.write("")
+    >>> stats = TreeCopier(workers=2, mirror=True).sync(src, dst)
+    >>> stats.written, stats.removed
+    (3, 1)
+    >>> open(dst + "/etc/issue").read()
+    'Bye'
+    >>> sorted(os.listdir(dst + "/etc"))
+    ['fstab', 'issue', 'motd']
+    """
+    workers = None
+    stats = None
+    mirror = False
+    # Called with the number of bytes after each copied chunk, from the
+    # worker threads
+    on_progress = None
+    # The maps of source uids and gids to the ones written to dst
+    owners = None
+
+    _chunk_size = 16 * 1024 * 1024
+
+    def __init__(self, workers=None, on_progress=None, mirror=False,
+                 owners=None):
+        if os.getenv("IMGBASED_DISABLE_THREADS"):
+            workers = 1
+        self.workers = workers or min(32, (os.cpu_count() or 1) * 4)
+        self.on_progress = on_progress
+        self.mirror = mirror
+        self.owners = owners or ({}, {})
+        self.stats = CopyStats()
+        self._copy_file_range = hasattr(os, "copy_file_range")
+        self._sendfile = hasattr(os, "sendfile")
+
+    def _scan(self, source, dst):
+        """Yields (src, dst, stat) of every entry below source
+        """
+        stack = [(source, dst)]
+        while stack:
+            srcdir, dstdir = stack.pop()
+            names = set()
+            with os.scandir(srcdir) as it:
+                for entry in it:
+                    names.add(entry.name)
+                    st = entry.stat(follow_symlinks=False)
+                    dstpath = os.path.join(dstdir, entry.name)
+                    yield entry.path, dstpath, st
+                    if stat.S_ISDIR(st.st_mode):
+                        stack.append((entry.path, dstpath))
+            if self.mirror:
+                for name in set(os.listdir(dstdir)) - names:
+                    log.debug("Removing %s" % os.path.join(dstdir, name))
+                    _remove(os.path.join(dstdir, name))
+                    self.stats.add(removed=1)
+
+    def _owner(self, st):
+        """Returns the uid and gid which dst gets for the source ids
+        """
+        uids, gids = self.owners
+        return (uids.get(st.st_uid, st.st_uid),
+                gids.get(st.st_gid, st.st_gid))
+
+    def _existing(self, dstpath, st):
+        """Returns the stat of dstpath in mirror mode, if it has the same
+        type as the source
+        """
+        if not self.mirror:
+            return None
+        try:
+            dst_st = os.lstat(dstpath)
+        except FileNotFoundError:
+            return None
+        if stat.S_IFMT(dst_st.st_mode) != stat.S_IFMT(st.st_mode):
+            _remove(dstpath)
+            return None
+        return dst_st
+
+    def sync(self, source, dst):
+        """Copy the contents of the source directory into dst
+        """
+        assert os.path.isdir(source), "%s is not a directory" % source
+        self.stats = CopyStats()
+        started = time.time()
+
+        expected = CopyStats()
+        directories = []
+        hardlinks = []
+        inodes = {}
+        errors = []
+        # Bound the number of queued files, to not hold every file of
+        # the tree in memory
+        slots = threading.BoundedSemaphore(self.workers * 64)
+
+        def _done(future):
+            if future.exception():
+                errors.append(future.exception())
+            slots.release()
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for srcpath, dstpath, st in self._scan(source, dst):
+                if errors:
+                    break
+
+                dst_st = self._existing(dstpath, st)
+
+                if stat.S_ISDIR(st.st_mode):
+                    if dst_st is None and not os.path.isdir(dstpath):
+                        os.mkdir(dstpath, 0o700)
+                    directories.append((srcpath, dstpath, st))
+                    expected.add(dirs=1)
+                    continue
+
+                if st.st_nlink > 1:
+                    key = (st.st_dev, st.st_ino)
+                    if key in inodes:
+                        hardlinks.append((inodes[key], dstpath))
+                        expected.add(hardlinks=1)
+                        continue
+                    inodes[key] = dstpath
+
+                if stat.S_ISREG(st.st_mode):
+                    expected.add(files=1, bytes=st.st_size)
+                    slots.acquire()
+                    pool.submit(self._copy_file, srcpath, dstpath,
+                                st, dst_st).add_done_callback(_done)
+                elif stat.S_ISLNK(st.st_mode):
+                    expected.add(symlinks=1)
+                    self._copy_symlink(srcpath, dstpath, st, dst_st)
+                elif stat.S_ISSOCK(st.st_mode):
+                    log.debug("Skipping socket %s" % srcpath)
+                else:
+                    expected.add(specials=1)
+                    self._copy_special(srcpath, dstpath, st, dst_st)
+
+        if errors:
+            raise errors[0]
+
+        for target, linkname in hardlinks:
+            if self.mirror and os.path.lexists(linkname):
+                if os.path.samefile(target, linkname):
+                    self.stats.add(hardlinks=1, unchanged=1)
+                    continue
+                _remove(linkname)
+            os.link(target, linkname)
+            self.stats.add(hardlinks=1)
+
+        # Children first, creating entries changes the mtime of the parent
+        for srcpath, dstpath, st in reversed(directories):
+            self._sync_metadata(srcpath, dstpath, st)
+            self.stats.add(dirs=1)
+        self._sync_metadata(source, dst, os.lstat(source))
+
+        self.stats.seconds = time.time() - started
+        self._verify(expected)
+
+        log.info("Copied %d entries (%d MiB) in %.1fs (%.1f MiB/s)" %
+                 (self.stats.entries(), self.stats.bytes >> 20,
+                  self.stats.seconds,
+                  (self.stats.bytes >> 20) / max(self.stats.seconds, 0.001)))
+        return self.stats
+
+    def _verify(self, expected):
+        for attr in ["files", "dirs", "symlinks", "hardlinks", "specials",
+                     "bytes"]:
+            if getattr(self.stats, attr) != getattr(expected, attr):
+                raise CopyError("Incomplete copy, expected %s but got %s" %
+                                (expected, self.stats))
+
+    def _replace(self, path):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+    def _sync_metadata(self, src, dst, st, dst_st=None):
+        if self.mirror:
+            dst_st = dst_st or os.lstat(dst)
+            if not _metadata_differs(src, dst, st, dst_st,
+                                     self._owner(st)):
+                return
+        _copy_metadata(src, dst, st, self._owner(st))
+
+    def _copy_symlink(self, src, dst, st, dst_st=None):
+        target = os.readlink(src)
+        if dst_st and os.readlink(dst) == target:
+            self._sync_metadata(src, dst, st, dst_st)
+            self.stats.add(symlinks=1, unchanged=1)
+            return
+        self._replace(dst)
+        os.symlink(target, dst)
+        _copy_metadata(src, dst, st, self._owner(st))
+        self.stats.add(symlinks=1)
+
+    def _copy_special(self, src, dst, st, dst_st=None):
+        if dst_st and dst_st.st_rdev == st.st_rdev:
+            self._sync_metadata(src, dst, st, dst_st)
+            self.stats.add(specials=1, unchanged=1)
+            return
+        self._replace(dst)
+        os.mknod(dst, st.st_mode, st.st_rdev)
+        _copy_metadata(src, dst, st, self._owner(st))
+        self.stats.add(specials=1)
+
+    def _copy_file(self, src, dst, st, dst_st=None):
+        if dst_st and dst_st.st_size == st.st_size and \
+                _same_content(src, dst):
+            self._sync_metadata(src, dst, st, dst_st)
+            self.stats.add(files=1, bytes=st.st_size, copied=st.st_size,
+                           unchanged=1)
+            return
+        self._replace(dst)
+        sfd = os.open(src, os.O_RDONLY | os.O_NOFOLLOW)
+        try:
+            dfd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            try:
+                if st.st_blocks * 512 < st.st_size:
+                    segments = data_segments(sfd, st.st_size)
+                else:
+                    segments = [(0, st.st_size)] if st.st_size else []
+                data = 0
+                for offset, length in segments:
+                    self._copy_range(sfd, dfd, offset, length)
+                    data += length
+                os.ftruncate(dfd, st.st_size)
+                if os.fstat(dfd).st_size != st.st_size:
+                    raise CopyError("Short copy of %s" % src)
+            finally:
+                os.close(dfd)
+        finally:
+            os.close(sfd)
+        _copy_metadata(src, dst, st, self._owner(st))
+        # The holes of sparse files were skipped
+        self.stats.add(files=1, bytes=st.st_size, written=st.st_size,
+                       copied=st.st_size - data)
+
+    def _copy_range(self, sfd, dfd, offset, length):
+        end = offset + length
+        while offset < end:
+            count = min(self._chunk_size, end - offset)
+            copied = self._copy_chunk(sfd, dfd, offset, count)
+            if copied == 0:
+                raise CopyError("Unexpected end of file at %d" % offset)
+            offset += copied
+            self.stats.add(copied=copied)
+            if self.on_progress:
+                self.on_progress(copied)
+
+    def _copy_chunk(self, sfd, dfd, offset, count):
+        """Use the fastest way the kernel supports to copy a chunk
+        """
+        if self._copy_file_range:
+            try:
+                return os.copy_file_range(sfd, dfd, count, offset, offset)
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                                   errno.EOPNOTSUPP):
+                    raise
+                log.debug("copy_file_range not usable: %s" % e)
+                self._copy_file_range = False
+        if self._sendfile:
+            try:
+                os.lseek(dfd, offset, os.SEEK_SET)
+                return os.sendfile(dfd, sfd, offset, count)
+            except OSError as e:
+                if e.errno not in (errno.ENOSYS, errno.EINVAL):
+                    raise
+                log.debug("sendfile not usable: %s" % e)
+                self._sendfile = False
+        return os.pwrite(dfd, os.pread(sfd, count, offset), offset)
+
+
+def write_image(image, device, block_size=1024 * 1024, on_progress=None):
+    """Stream a filesystem image onto a block device
+
+    All-zero blocks are not written, the device needs to read back zeroes
+    for them, which is true for a freshly created thin volume, and it keeps
+    the volume sparse.
+    on_progress is called with the number of bytes of each processed
+    block.  Returns the number of written and skipped bytes.
+
+    >>> import tempfile
+    >>> img = tempfile.NamedTemporaryFile()
+    >>> _ = img.write(b"data" + b"\\0" * 8188 + b"tail")
+    >>> img.flush()
+    >>> dev = tempfile.NamedTemporaryFile()
+    >>> write_image(img.name, dev.name, block_size=4096)
+    (4100, 4096)
+    >>> dev.read() == open(img.name, "rb").read()
+    True
+    """
+    size = os.stat(image).st_size
+    written = skipped = 0
+    zeroes = bytes(block_size)
+    buf = bytearray(block_size)
+
+    sfd = os.open(image, os.O_RDONLY)
+    try:
+        dfd = os.open(device, os.O_WRONLY)
+        try:
+            device_size = os.lseek(dfd, 0, os.SEEK_END)
+            if stat.S_ISBLK(os.fstat(dfd).st_mode) and device_size < size:
+                raise CopyError("Image %s (%d bytes) does not fit on %s "
+                                "(%d bytes)" % (image, size, device,
+                                                device_size))
+            offset = 0
+            while offset < size:
+                length = os.readv(sfd, [buf])
+                if length == 0:
+                    raise CopyError("Unexpected end of %s at %d" %
+                                    (image, offset))
+                block = memoryview(buf)[:length]
+                if block == zeroes[:length]:
+                    skipped += length
+                else:
+                    os.pwrite(dfd, block, offset)
+                    written += length
+                offset += length
+                if on_progress:
+                    on_progress(length)
+            if not stat.S_ISBLK(os.fstat(dfd).st_mode):
+                # Regular files need to get the trailing hole, devices
+                # have their size
+                os.ftruncate(dfd, max(size, device_size))
+            os.fsync(dfd)
+        finally:
+            os.close(dfd)
+    finally:
+        os.close(sfd)
+
+    log.info("Wrote %d MiB of %s to %s, skipped %d MiB of zeroes" %
+             (written >> 20, image, device, skipped >> 20))
+    return written, skipped
+
+# vim: sw=4 et sts=4:
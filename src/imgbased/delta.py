@@ -0,0 +1,318 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# imgbase
+#
+# Copyright (C) 2018  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""File level deltas between two image trees
+
+A delta payload is a tar archive with:
+
+- delta.json, the manifest: the nvr the delta applies to, the nvr it
+  creates, the removed paths and the checksum of the resulting tree
+- tree/, every entry which is new or changed in the new tree
+
+The new tree is reconstructed by stacking tree/ (plus whiteouts for the
+removed paths) on top of the old tree with a read-only overlayfs.
+"""
+import hashlib
+import json
+import logging
+import os
+import stat
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from .utils import mounted
+
+log = logging.getLogger(__package__)
+
+
+MANIFEST = "delta.json"
+TREE = "tree"
+
+_tar_args = ["--selinux", "--xattrs", "--acls", "--xattrs-include=*",
+             "--warning=no-timestamp"]
+
+# tar can not detect the compression of an archive read from a pipe
+_compression_magic = [(b"\xfd7zXZ\x00", "--xz"), (b"\x1f\x8b", "--gzip"),
+                      (b"BZh", "--bzip2"), (b"\x28\xb5\x2f\xfd", "--zstd")]
+
+
+class DeltaError(Exception):
+    pass
+
+
+class DeltaChecksumError(DeltaError):
+    pass
+
+
+def _walk(root):
+    """Yields the relative path and stat of every entry below root
+    """
+    stack = [""]
+    while stack:
+        reldir = stack.pop()
+        with os.scandir(os.path.join(root, reldir)) as it:
+            for entry in it:
+                relpath = os.path.join(reldir, entry.name)
+                st = entry.stat(follow_symlinks=False)
+                yield relpath, st
+                if stat.S_ISDIR(st.st_mode):
+                    stack.append(relpath)
+
+
+def _file_digest(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as src:
+        for chunk in iter(lambda: src.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _xattrs(path):
+    return sorted((name, os.getxattr(path, name, follow_symlinks=False))
+                  for name in os.listxattr(path, follow_symlinks=False))
+
+
+def _describe(root, relpath, st, digest=None):
+    """A description of an entry, two entries are equal if the
+    descriptions are equal
+    """
+    path = os.path.join(root, relpath)
+    desc = [relpath, stat.S_IFMT(st.st_mode), stat.S_IMODE(st.st_mode),
+            st.st_uid, st.st_gid, _xattrs(path)]
+    if stat.S_ISREG(st.st_mode):
+        desc += [st.st_size, st.st_mtime_ns, digest]
+    elif stat.S_ISLNK(st.st_mode):
+        desc += [os.readlink(path)]
+    elif stat.S_ISCHR(st.st_mode) or stat.S_ISBLK(st.st_mode):
+        desc += [st.st_rdev]
+    return repr(desc)
+
+
+def tree_checksum(root, workers=8):
+    """Returns a sha256 over the content and metadata of a tree
+
+    >>> import tempfile
+    >>> a, b = tempfile.mkdtemp(), tempfile.mkdtemp()
+    >>> for d in [a, b]:
+    ...     with open(d + "/motd", "w") as f:
+    ...         _ = f.write("Hello")
+    ...     os.utime(d + "/motd", (0, 0))
+    >>> tree_checksum(a) == tree_checksum(b)
+    True
+    >>> with open(b + "/motd", "w") as f:
+    ...     _ = f.write("Bye")
+    >>> tree_checksum(a) == tree_checksum(b)
+    False
+    """
+    entries = sorted(_walk(root))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        digests = pool.map(lambda e: _file_digest(os.path.join(root, e[0]))
+                           if stat.S_ISREG(e[1].st_mode) else None, entries)
+        h = hashlib.sha256()
+        for (relpath, st), digest in zip(entries, digests):
+            desc = _describe(root, relpath, st, digest)
+            h.update(desc.encode("utf-8", "replace"))
+            h.update(b"\0")
+    return h.hexdigest()
+
+
+def diff_trees(old_root, new_root):
+    """Returns the entries which are new or changed in new_root, and the
+    entries which were removed
+
+    >>> import tempfile
+    >>> old, new = tempfile.mkdtemp(), tempfile.mkdtemp()
+    >>> os.mkdir(old + "/etc")
+    >>> os.mkdir(new + "/etc")
+    >>> for d, c in [(old, "Hello"), (new, "Bye")]:
+    ...     with open(d + "/etc/motd", "w") as f:
+    ...         _ = f.write(c)
+    >>> with open(old + "/etc/fstab", "w") as f:
+    ...     _ = f.write("")
+    >>> os.utime(old + "/etc", (0, 0))
+    >>> os.utime(new + "/etc", (0, 0))
+    >>> diff_trees(old, new)
+    (['etc/motd'], ['etc/fstab'])
+    """
+    changed = []
+    new_entries = set()
+    for relpath, st in _walk(new_root):
+        new_entries.add(relpath)
+        try:
+            old_st = os.lstat(os.path.join(old_root, relpath))
+        except FileNotFoundError:
+            changed.append(relpath)
+            continue
+        if stat.S_ISDIR(st.st_mode) and stat.S_ISDIR(old_st.st_mode):
+            # The content of directories is compared entry by entry
+            same = (_describe(old_root, relpath, old_st) ==
+                    _describe(new_root, relpath, st)) and \
+                old_st.st_mtime_ns == st.st_mtime_ns
+        elif stat.S_ISREG(st.st_mode) and stat.S_ISREG(old_st.st_mode) and \
+                st.st_size == old_st.st_size:
+            same = _describe(old_root, relpath, old_st, _file_digest(
+                os.path.join(old_root, relpath))) == \
+                _describe(new_root, relpath, st, _file_digest(
+                    os.path.join(new_root, relpath)))
+        else:
+            same = _describe(old_root, relpath, old_st) == \
+                _describe(new_root, relpath, st)
+        if not same:
+            changed.append(relpath)
+
+    removed = []
+    for relpath, st in _walk(old_root):
+        if relpath not in new_entries and \
+                os.path.dirname(relpath) in new_entries | {""}:
+            # Only the top most removed entry is needed
+            removed.append(relpath)
+    return sorted(changed), sorted(removed)
+
+
+def _with_parents(paths, entries):
+    """Returns entries plus all parent directories of paths
+
+    >>> _with_parents(["etc/ssh/sshd_config", "usr/bin/vi"], ["usr/bin/vi"])
+    ['etc', 'etc/ssh', 'usr', 'usr/bin', 'usr/bin/vi']
+    """
+    result = set(entries)
+    for path in paths:
+        parent = os.path.dirname(path)
+        while parent:
+            result.add(parent)
+            parent = os.path.dirname(parent)
+    return sorted(result)
+
+
+def create_delta(old_root, new_root, old_nvr, new_nvr, payload):
+    """Create a delta payload to get from old_root to new_root
+    """
+    changed, removed = diff_trees(old_root, new_root)
+    log.info("Delta contains %d changed and %d removed entries" %
+             (len(changed), len(removed)))
+
+    manifest = {"format": 1,
+                "from": old_nvr,
+                "to": new_nvr,
+                "removed": removed,
+                "checksum": tree_checksum(new_root)}
+
+    workdir = os.path.dirname(os.path.abspath(payload))
+    manifest_path = os.path.join(workdir, MANIFEST)
+    list_path = os.path.join(workdir, MANIFEST + ".files")
+    with open(manifest_path, "w") as dst:
+        json.dump(manifest, dst, indent=2, sort_keys=True)
+    with open(list_path, "w") as dst:
+        # The parent directories are always shipped, overlayfs takes the
+        # metadata of a directory from the top most layer
+        entries = _with_parents(changed + removed, changed)
+        dst.write("\n".join("./" + p for p in entries))
+        dst.write("\n")
+
+    try:
+        subprocess.check_call(["tar", "-c", "-a", "-f", payload] +
+                              _tar_args +
+                              ["-C", workdir, MANIFEST,
+                               "--no-recursion",
+                               "--transform", r"s,^\./,%s/," % TREE,
+                               "-C", new_root, "-T", list_path])
+    finally:
+        os.unlink(manifest_path)
+        os.unlink(list_path)
+
+
+class DeltaPayload(object):
+    """An extracted delta payload
+    """
+    path = None
+    manifest = None
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, MANIFEST)) as src:
+            self.manifest = json.load(src)
+        if self.manifest.get("format") != 1:
+            raise DeltaError("Unsupported delta format: %s" %
+                             self.manifest.get("format"))
+
+    @classmethod
+    def extract(cls, payload, workdir, on_read=None, chunk_size=1024 * 1024):
+        """Unpacks the payload into workdir
+
+        The payload is read once, and fed to tar through a pipe, thus
+        on_read can see each chunk (i.e. to checksum it) without reading
+        the payload a second time.
+        """
+        with open(payload, "rb") as src:
+            chunk = src.read(chunk_size)
+            cmd = ["tar", "-x", "-f", "-"] + _tar_args + ["-C", workdir]
+            cmd += [arg for magic, arg in _compression_magic
+                    if chunk.startswith(magic)]
+            proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+            try:
+                while chunk:
+                    if on_read:
+                        on_read(chunk)
+                    proc.stdin.write(chunk)
+                    chunk = src.read(chunk_size)
+            except BrokenPipeError:
+                # tar gave up early, its exit code tells why
+                pass
+            finally:
+                try:
+                    proc.stdin.close()
+                except BrokenPipeError:
+                    pass
+                returncode = proc.wait()
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, cmd)
+        return cls(workdir)
+
+    @property
+    def tree(self):
+        return os.path.join(self.path, TREE)
+
+    def add_whiteouts(self):
+        """Mark the removed entries for overlayfs
+        """
+        for relpath in self.manifest["removed"]:
+            path = os.path.join(self.tree, relpath)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            os.mknod(path, stat.S_IFCHR | 0o000, os.makedev(0, 0))
+
+    def applied(self, base_root):
+        """Returns a read-only mount of base_root with the delta on top
+        """
+        if not os.path.isdir(self.tree):
+            os.mkdir(self.tree)
+        self.add_whiteouts()
+        options = "ro,lowerdir=%s:%s" % (self.tree, base_root)
+        return mounted("overlay", options=options, fstype="overlay")
+
+    def verify(self, root):
+        checksum = tree_checksum(root)
+        if checksum != self.manifest["checksum"]:
+            raise DeltaChecksumError("Reconstructed tree has checksum %s, "
+                                     "expected %s" %
+                                     (checksum, self.manifest["checksum"]))
+        log.info("Reconstructed tree matches checksum %s" % checksum)
+
+# vim: sw=4 et sts=4:
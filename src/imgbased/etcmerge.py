@@ -0,0 +1,416 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# imgbase
+#
+# Copyright (C) 2018  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Merge /etc of the previous layer into a new layer
+
+Four trees are involved: /etc of the old and the new layer, and the
+factory /etc (/usr/share/factory/etc) each image shipped.  Comparing the
+old /etc with the old factory tells what the user changed, comparing both
+factories tells what the update changed.
+
+Each tree is scanned once into a manifest, all decisions are planned from
+the manifests.  File contents are only hashed when the metadata can not
+tell if two files are the same, through the hash cache.
+"""
+import fnmatch
+import logging
+import os
+import re
+import shutil
+import stat
+from concurrent.futures import ThreadPoolExecutor
+
+from . import hashcache
+from .utils import copy_files, remove_file
+
+log = logging.getLogger(__package__)
+
+
+class Entry(object):
+    """Metadata of a path in a tree
+    """
+    __slots__ = ("path", "kind", "size", "mtime_ns", "mode", "uid", "gid",
+                 "target", "_digest")
+
+    def __init__(self, path, kind, size, mode, uid, gid, target=None,
+                 mtime_ns=None, digest=None):
+        self.path = path
+        self.kind = kind
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.mode = mode
+        self.uid = uid
+        self.gid = gid
+        self.target = target
+        self._digest = digest
+
+    @classmethod
+    def from_stat(cls, path, st, target=None):
+        if stat.S_ISDIR(st.st_mode):
+            kind = "dir"
+        elif stat.S_ISREG(st.st_mode):
+            kind = "file"
+        elif stat.S_ISLNK(st.st_mode):
+            kind = "link"
+        else:
+            kind = "other"
+        return cls(path, kind, st.st_size, stat.S_IMODE(st.st_mode),
+                   st.st_uid, st.st_gid, target, st.st_mtime_ns)
+
+    def digest(self):
+        if self._digest is None:
+            self._digest = hashcache.digest(self.path)
+        return self._digest
+
+    def same(self, other):
+        """True if both have the same content, like filecmp files with the
+        same size and mtime are considered the same
+        """
+        if other is None or self.kind != other.kind:
+            return False
+        if self.kind == "link":
+            return self.target == other.target
+        if self.kind == "file":
+            if self.size != other.size:
+                return False
+            if self.mtime_ns is not None and \
+                    self.mtime_ns == other.mtime_ns:
+                return True
+            return self.digest() == other.digest()
+        if self.kind == "other":
+            return self.mode == other.mode
+        return True
+
+
+def scan(root, prefix="", skip=()):
+    """Returns a manifest {relpath: Entry} of everything below root,
+    except the relpaths in skip.  Symlinks are not followed
+
+    >>> import tempfile
+    >>> root = tempfile.mkdtemp()
+    >>> os.makedirs(root + "/ssh")
+    >>> os.symlink("ssh", root + "/ssh.link")
+    >>> with open(root + "/ssh/sshd_config", "w") as f:
+    ...     _ = f.write("PermitRootLogin no")
+    >>> m = scan(root)
+    >>> [(p, m[p].kind) for p in sorted(m)]
+    [('ssh', 'dir'), ('ssh.link', 'link'), ('ssh/sshd_config', 'file')]
+    >>> m["ssh.link"].target
+    'ssh'
+    >>> sorted(scan(root + "/ssh", "ssh"))
+    ['ssh/sshd_config']
+    >>> sorted(scan(root, skip=["ssh"]))
+    ['ssh.link']
+    >>> scan(root + "/missing")
+    {}
+    """
+    manifest = {}
+    stack = [(root, prefix)]
+    while stack:
+        path, relpath = stack.pop()
+        try:
+            it = os.scandir(path)
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+        with it:
+            for e in it:
+                rel = relpath + "/" + e.name if relpath else e.name
+                if rel in skip:
+                    continue
+                st = e.stat(follow_symlinks=False)
+                target = os.readlink(e.path) if e.is_symlink() else None
+                manifest[rel] = Entry.from_stat(e.path, st, target)
+                if e.is_dir(follow_symlinks=False):
+                    stack.append((e.path, rel))
+    return manifest
+
+
+def _parents(path):
+    while "/" in path:
+        path = path.rsplit("/", 1)[0]
+        yield path
+
+
+def changes(tree, base):
+    """Returns the paths of tree which were added or changed compared to
+    base.  Of an added directory only the directory is returned
+
+    >>> import tempfile
+    >>> root = tempfile.mkdtemp()
+    >>> for d in ["etc/ssh", "factory/ssh", "etc/new"]:
+    ...     os.makedirs(root + "/" + d)
+    >>> for fn, data in [("etc/ssh/sshd_config", "PermitRootLogin yes"),
+    ...                  ("factory/ssh/sshd_config", "PermitRootLogin no"),
+    ...                  ("etc/new/file", "")]:
+    ...     with open(root + "/" + fn, "w") as f:
+    ...         _ = f.write(data)
+    >>> changes(scan(root + "/etc"), scan(root + "/factory"))
+    ['new', 'ssh/sshd_config']
+    """
+    changed = []
+    added_dirs = set()
+    for path in sorted(tree):
+        if any(p in added_dirs for p in _parents(path)):
+            continue
+        entry = tree[path]
+        other = base.get(path)
+        if other is None:
+            changed.append(path)
+            if entry.kind == "dir":
+                added_dirs.add(path)
+        elif "dir" in (entry.kind, other.kind):
+            continue
+        elif not entry.same(other):
+            changed.append(path)
+    return changed
+
+
+class Decision(object):
+    """What to do with a path of /etc
+
+    copy: copy the file of the old layer, which the user changed
+    keep: keep the file of the new layer
+    factory: restore the file of the new layer from its factory /etc
+    imgnew: the user and the update changed the file, the new factory
+            version is stored as <path>.imgnew next to the user's version
+    remove: remove the file from the new layer
+    """
+    def __init__(self, action, path, reason):
+        self.action = action
+        self.path = path
+        self.reason = reason
+
+    def __repr__(self):
+        return "<%s %s>" % (self.action, self.path)
+
+
+class EtcMerge(object):
+    """Plans and applies the merge of /etc from old_root into new_root
+
+    >>> import tempfile
+    >>> old, new = tempfile.mkdtemp(), tempfile.mkdtemp()
+    >>> def write(root, path, data):
+    ...     path = root + path
+    ...     if not os.path.isdir(os.path.dirname(path)):
+    ...         os.makedirs(os.path.dirname(path))
+    ...     with open(path, "w") as f:
+    ...         _ = f.write(data)
+    >>> for root, version in [(old, "1"), (new, "2")]:
+    ...     for etc in ["/etc", "/usr/share/factory/etc"]:
+    ...         write(root, etc + "/chrony.conf", "pool %s" % version)
+    ...         write(root, etc + "/motd", "Welcome %s" % version)
+    ...         write(root, etc + "/systemd/system/a.wants/sshd.service",
+    ...               "")
+    >>> write(old, "/etc/chrony.conf", "server ntp")
+    >>> write(old, "/etc/hostname", "node")
+    >>> os.unlink(old + "/etc/systemd/system/a.wants/sshd.service")
+
+    >>> merge = EtcMerge(old, new)
+    >>> decisions = merge.plan()
+    >>> decisions
+    [<copy chrony.conf>, <imgnew chrony.conf>, <copy hostname>, \
+<keep motd>, <remove systemd/system/a.wants/sshd.service>]
+    >>> merge.apply(decisions)
+    >>> sorted(scan(new + "/etc"))
+    ['chrony.conf', 'chrony.conf.imgnew', 'hostname', 'motd', 'systemd', \
+'systemd/system', 'systemd/system/a.wants']
+    >>> open(new + "/etc/chrony.conf").read()
+    'server ntp'
+    """
+    # Never carried over from the old layer
+    exclude = ["selinux/targeted/active/modules",
+               "selinux/targeted/active/modules/*",
+               "selinux/targeted/policy/policy.31"]
+    # Generated or merged on the host, never restored from the factory
+    critical = [re.compile(r) for r in [r'.*?/initiatorname.iscsi$',
+                                        r'.*?group-?$',
+                                        r'.*?passwd-?$',
+                                        r'.*?shadow-?$',
+                                        r'.*?fstab$',
+                                        r'.*?ifcfg-.*$']]
+
+    def __init__(self, old_root, new_root, subtree=None, manifest=None):
+        """If the manifest of the new image is given, the new trees are
+        read from it instead of being scanned
+        """
+        self.old_root = old_root
+        self.new_root = new_root
+        trees = [old_root + "/etc", old_root + "/usr/share/factory/etc",
+                 new_root + "/etc", new_root + "/usr/share/factory/etc"]
+        prefix = subtree or ""
+        if subtree:
+            trees = [t + "/" + subtree for t in trees]
+        if manifest is not None:
+            scanned = trees[:2]
+            self.new, self.new_factory = [
+                manifest.tree(new_root, t[len(new_root):], prefix)
+                for t in trees[2:]]
+        else:
+            scanned = trees
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            manifests = list(pool.map(lambda t: scan(t, prefix), scanned))
+        if manifest is not None:
+            self.old, self.old_factory = manifests
+        else:
+            self.old, self.old_factory, self.new, self.new_factory = \
+                manifests
+
+    def _excluded(self, path):
+        """The excluded paths, and everything below them
+        """
+        return any(fnmatch.fnmatch(p, pattern)
+                   for p in [path] + list(_parents(path))
+                   for pattern in self.exclude)
+
+    def _critical(self, path):
+        return any(c.match(path) for c in self.critical)
+
+    def _hash_ahead(self):
+        """Hash all files which can only be told apart by their content at
+        once, instead of one after the other while planning
+        """
+        trees = [self.old, self.old_factory, self.new, self.new_factory]
+        pending = []
+        for path in set(self.old) | set(self.old_factory):
+            files = [t[path] for t in trees
+                     if path in t and t[path].kind == "file"]
+            for entry in files:
+                if entry._digest is None and \
+                        any(entry.size == other.size and
+                            (other.mtime_ns is None or
+                             entry.mtime_ns != other.mtime_ns)
+                            for other in files if other is not entry):
+                    pending.append(entry)
+        digests = hashcache.digests([e.path for e in pending])
+        for entry in pending:
+            entry._digest = digests[entry.path]
+
+    def plan(self):
+        """Returns the decisions for all paths which the user or the
+        update changed
+        """
+        self._hash_ahead()
+        decisions = []
+        whole = set()
+        for path in sorted(set(self.old) | set(self.old_factory)):
+            if any(p in whole for p in _parents(path)):
+                continue
+            old = self.old.get(path)
+            old_factory = self.old_factory.get(path)
+            new = self.new.get(path)
+            new_factory = self.new_factory.get(path)
+
+            if old is None:
+                # Enabled units are symlinks in /etc/systemd, a unit
+                # which was disabled must not be re-enabled
+                if path.startswith("systemd/"):
+                    removed = self._disabled_unit(path, whole)
+                    decisions.extend(removed)
+                    whole.update(d.path for d in removed)
+                continue
+
+            user_changed = not old.same(old_factory)
+            if self._excluded(path):
+                if user_changed and old.kind != "dir":
+                    decisions.append(Decision("keep", path,
+                                              "never migrated"))
+                continue
+
+            if old.kind == "dir":
+                if new is None and old_factory is None:
+                    decisions.append(Decision("copy", path,
+                                              "directory was added"))
+                    whole.add(path)
+                continue
+
+            if user_changed:
+                if not old.same(new):
+                    decisions.append(Decision("copy", path,
+                                              "changed by the user"))
+                if old.kind == "file" and old_factory is not None and \
+                        new_factory is not None and \
+                        not old_factory.same(new_factory) and \
+                        not old.same(new_factory) and \
+                        not self._critical(path):
+                    decisions.append(Decision("imgnew", path,
+                                              "changed by the update too"))
+            elif old.kind == "file" and new is not None and \
+                    new_factory is not None and \
+                    not old.same(new_factory) and not self._critical(path):
+                if new.same(new_factory):
+                    decisions.append(Decision("keep", path,
+                                              "changed by the update"))
+                else:
+                    decisions.append(Decision("factory", path,
+                                              "changed by the update"))
+        return decisions
+
+    def _disabled_unit(self, path, whole):
+        """Remove a unit which was removed from the old /etc, wherever the
+        new /etc/systemd has it
+        """
+        name = os.path.basename(path)
+        paths = [p for p in sorted(self.new)
+                 if p.startswith("systemd/") and
+                 (p == path or os.path.basename(p) == name)]
+        decisions = []
+        for p in paths:
+            if p in whole or any(d.path == p for d in decisions) or \
+                    any(parent in whole for parent in _parents(p)):
+                continue
+            decisions.append(Decision("remove", p, "unit was disabled"))
+        return decisions
+
+    def apply(self, decisions):
+        old_etc = self.old_root + "/etc/"
+        new_etc = self.new_root + "/etc/"
+        new_factory = self.new_root + "/usr/share/factory/etc/"
+
+        # cp is used to also copy xattrs, once per directory
+        copies = {}
+        for d in decisions:
+            log.debug("%s %s (%s)" % (d.action, d.path, d.reason))
+            if d.action == "copy":
+                dst = os.path.dirname(new_etc + d.path)
+                copies.setdefault(dst, []).append(old_etc + d.path)
+            elif d.action == "factory":
+                shutil.copy2(new_factory + d.path, new_etc + d.path)
+            elif d.action == "imgnew":
+                copy_files(new_etc + d.path + ".imgnew",
+                           [new_factory + d.path], "-a")
+            elif d.action == "remove":
+                path = new_etc + d.path
+                if os.path.isdir(path) and not os.path.islink(path):
+                    remove_file(path, dir=True)
+                elif os.path.lexists(path):
+                    os.unlink(path)
+
+        for dst, srcs in sorted(copies.items()):
+            if not os.path.isdir(dst):
+                os.makedirs(dst)
+            for src in srcs:
+                # cp does not replace a directory with a file and vice versa
+                target = os.path.join(dst, os.path.basename(src))
+                if os.path.lexists(target) and \
+                        os.path.isdir(target) != os.path.isdir(src):
+                    remove_file(target, dir=True)
+            copy_files(dst, srcs, "-a", "-r")
+
+# vim: sw=4 et sts=4:
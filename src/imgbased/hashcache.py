@@ -0,0 +1,250 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# imgbase
+#
+# Copyright (C) 2018  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Persistent cache of the sha256 of files
+
+A file is identified by its device and inode, its cached digest is only
+used as long as the size, mtime and ctime of the file did not change.
+The files of the running layer and of /var are compared on every update,
+with the cache they are only read once.
+
+Only one cache is active at a time, the module level functions use it if
+there is one.
+"""
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from . import constants
+
+log = logging.getLogger(__package__)
+
+
+CHUNK_SIZE = 1024 * 1024
+
+# Below this amount of data the files are hashed one after the other
+PARALLEL_BYTES = 64 * 1024 * 1024
+
+# Entries which were not used for this long are dropped
+MAX_AGE = 90 * 24 * 60 * 60
+
+
+def sha256sum(path):
+    """Returns the sha256 of the file at path, read in chunks
+
+    >>> import tempfile
+    >>> with tempfile.NamedTemporaryFile() as f:
+    ...     _ = f.write(b"Hello")
+    ...     f.flush()
+    ...     sha256sum(f.name)[:16]
+    '185f8db32271fe25'
+    """
+    h = hashlib.sha256()
+    with open(path, "rb") as src:
+        for chunk in iter(lambda: src.read(CHUNK_SIZE), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _stamp(st):
+    return (st.st_size, st.st_mtime_ns, st.st_ctime_ns)
+
+
+class HashCache(object):
+    """Digests of files by device and inode
+
+    >>> import tempfile
+    >>> workdir = tempfile.mkdtemp()
+    >>> with open(workdir + "/motd", "w") as f:
+    ...     _ = f.write("Hello")
+    >>> cache = HashCache.start(workdir + "/hash-cache")
+    >>> digest(workdir + "/motd")[:16]
+    '185f8db32271fe25'
+    >>> HashCache.stop()
+
+    >>> cache = HashCache(workdir + "/hash-cache")
+    >>> cache.lookup(os.stat(workdir + "/motd"))[:16]
+    '185f8db32271fe25'
+    >>> with open(workdir + "/motd", "w") as f:
+    ...     _ = f.write("Hello again")
+    >>> cache.lookup(os.stat(workdir + "/motd")) is None
+    True
+    """
+    _active = None
+
+    path = None
+
+    def __init__(self, path=None):
+        self.path = path
+        self._entries = {}
+        self._used = set()
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            self._load()
+
+    @classmethod
+    def active(cls):
+        return cls._active
+
+    @classmethod
+    def start(cls, path=None):
+        cls._active = cls(path or constants.IMGBASED_HASH_CACHE)
+        return cls._active
+
+    @classmethod
+    def stop(cls):
+        cache, cls._active = cls._active, None
+        if cache:
+            try:
+                cache.save()
+            except (sqlite3.Error, IOError, OSError) as e:
+                log.warning("Failed to save the hash cache: %s" % e)
+
+    def _connect(self):
+        db = sqlite3.connect(self.path)
+        db.execute("CREATE TABLE IF NOT EXISTS hashes (dev INTEGER, "
+                   "ino INTEGER, size INTEGER, mtime_ns INTEGER, "
+                   "ctime_ns INTEGER, sha256 TEXT, used INTEGER, "
+                   "PRIMARY KEY (dev, ino))")
+        return db
+
+    def _load(self):
+        try:
+            db = self._connect()
+            try:
+                rows = db.execute("SELECT dev, ino, size, mtime_ns, "
+                                  "ctime_ns, sha256, used FROM hashes")
+                for dev, ino, size, mtime_ns, ctime_ns, sha256, used in rows:
+                    self._entries[(dev, ino)] = ((size, mtime_ns, ctime_ns),
+                                                 sha256, used)
+            finally:
+                db.close()
+        except sqlite3.Error as e:
+            log.warning("Ignoring the hash cache %s: %s" % (self.path, e))
+            self._entries = {}
+
+    def lookup(self, st):
+        """Returns the digest of the file with the stat result st, or None
+        """
+        key = (st.st_dev, st.st_ino)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != _stamp(st):
+                return None
+            self._used.add(key)
+            return entry[1]
+
+    def store(self, st, sha256):
+        key = (st.st_dev, st.st_ino)
+        with self._lock:
+            self._entries[key] = (_stamp(st), sha256, None)
+            self._used.add(key)
+
+    def save(self):
+        """Write the used and the recently used entries to the cache
+        """
+        now = int(time.time())
+        with self._lock:
+            rows = []
+            for key, (stamp, sha256, used) in self._entries.items():
+                used = now if key in self._used else used
+                if used is not None and now - used < MAX_AGE:
+                    rows.append(key + stamp + (sha256, used))
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        db = self._connect()
+        try:
+            with db:
+                db.execute("DELETE FROM hashes")
+                db.executemany("INSERT INTO hashes VALUES (?, ?, ?, ?, ?, "
+                               "?, ?)", rows)
+        finally:
+            db.close()
+        log.debug("Saved %d digests to %s" % (len(rows), self.path))
+
+
+def digest(path):
+    """Returns the sha256 of the file at path, from the active cache if it
+    knows the file
+    """
+    return digests([path])[path]
+
+
+def digests(paths, workers=None):
+    """Returns {path: sha256} of the files at paths
+
+    Files which the active cache does not know are hashed by a pool of
+    threads if there is enough data.  hashlib releases the GIL while it
+    hashes the 1MiB chunks, and so does reading them, thus the threads
+    run in parallel, without forking the threaded update process.
+    """
+    cache = HashCache.active()
+    result = {}
+    missing = []
+    for path in set(paths):
+        st = os.stat(path)
+        sha256 = cache.lookup(st) if cache else None
+        if sha256 is None:
+            missing.append((path, st))
+        else:
+            result[path] = sha256
+
+    size = sum(st.st_size for _, st in missing)
+    if len(missing) > 1 and size > PARALLEL_BYTES and \
+            not os.getenv("IMGBASED_DISABLE_THREADS"):
+        # Large files first, to keep all workers busy until the end
+        missing.sort(key=lambda m: m[1].st_size, reverse=True)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            hashed = list(pool.map(sha256sum, [p for p, _ in missing]))
+    else:
+        hashed = [sha256sum(p) for p, _ in missing]
+
+    for (path, st), sha256 in zip(missing, hashed):
+        if cache:
+            cache.store(st, sha256)
+        result[path] = sha256
+    return result
+
+
+def same_content(a, b, b_digest=None):
+    """True if the files at a and b have the same content
+
+    >>> import tempfile
+    >>> workdir = tempfile.mkdtemp()
+    >>> for name, data in [("a", "Hello"), ("b", "Hello"), ("c", "Hallo")]:
+    ...     with open(workdir + "/" + name, "w") as f:
+    ...         _ = f.write(data)
+    >>> same_content(workdir + "/a", workdir + "/b")
+    True
+    >>> same_content(workdir + "/a", workdir + "/c")
+    False
+    """
+    if os.path.getsize(a) != os.path.getsize(b):
+        return False
+    if b_digest is None:
+        return digest(a) == digest(b)
+    return digest(a) == b_digest
+
+# vim: sw=4 et sts=4:
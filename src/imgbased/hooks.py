@@ -24,6 +24,8 @@ import logging
 import os
 import subprocess
 
+from .profiling import callable_name, timed
+
 
 log = logging.getLogger(__package__)
 
@@ -117,7 +119,8 @@ class Hooks(object):
 
         for cb in all_cbs:
             # log.debug("Triggering: %s (%s, %s)" % (cb, self.context, args))
-            cb(self.context, *args)
+            with timed("hook:%s" % name, callable_name(cb)):
+                cb(self.context, *args)
 
     def add_filesystem_emitter(self, path):
         """Also call scripts on the fs if signals get emitted
@@ -130,7 +133,8 @@ class Hooks(object):
             for handler in os.listdir(path):
                 script = os.path.join(path, handler)
                 # log.debug("Triggering: %s (%s %s)" % (script, name, args))
-                subprocess.check_call([script, name] + list(args))
+                with timed("hook-script:%s" % name, script):
+                    subprocess.check_call([script, name] + list(args))
         self.create(None, _trigger_fs)
 
 # vim: sw=4 et sts=4:
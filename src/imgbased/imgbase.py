@@ -24,6 +24,7 @@ import logging
 import re
 
 from . import constants, local, naming, utils
+from .checkpoint import Checkpoint
 from .hooks import Hooks
 from .lvm import LVM, MissingLvmThinPool
 from .naming import Image
@@ -102,15 +103,17 @@ class ImageLayers(object):
     def list_our_lv_names(self):
         filtr = "lv_tags = {} || lv_tags = {}".format(self.lv_base_tag,
                                                       self.lv_layer_tag)
-        lvs = LVM.list_lvs(filtr=filtr)
+        # The tags come with the names, instead of an lvs call per LV
+        tags = LVM._list_lv_tags(filtr=filtr)
 
-        def has_our_tag(lv):
+        def has_our_tag(lvm_name):
             our_tags = [self.lv_base_tag, self.lv_layer_tag]
-            return any(tag in lv.tags()
+            return any(tag in tags[lvm_name]
                        for tag in our_tags)
 
-        our_lvs = [lv for lv in lvs if has_our_tag(lv)]
-        log.debug("Our LVS: %s" % lvs)
+        our_lvs = [LVM.LV.from_lvm_name(n) for n in sorted(tags)
+                   if has_our_tag(n)]
+        log.debug("Our LVS: %s" % our_lvs)
         return [lv.lv_name for lv in our_lvs]
 
     def _vg(self):
@@ -210,6 +213,9 @@ class ImageLayers(object):
         except utils.FilesystemNotSupported:
             raise
 
+        if Checkpoint.active():
+            Checkpoint.active().record(layer=new_lv.lv_name)
+
         self.hooks.emit("new-layer-added", prev_lv, new_lv)
 
         return new_lv
@@ -317,18 +323,26 @@ class ImageLayers(object):
                         existing_lv, initial_base, new_layer)
 
     def add_base(self, size, nvr, lvs=None,
-                 with_layer=False):
+                 with_layer=False, from_base=None):
         """Add a new base LV
+
+        If from_base is given, the new base is a thin snapshot of it
+        (and has its size), to share the blocks which don't change.
         """
         assert size
 
         new_base = Image.from_nvr(nvr)
         log.info("New base will be: %s" % new_base)
 
-        pool = self._thinpool()
-        log.debug("Pool: %s" % pool)
-
-        new_base_lv = pool.create_thinvol(new_base.lv_name, size)
+        if from_base:
+            from_base_lv = self._lvm_from_layer(from_base)
+            log.debug("Snapshotting base: %s" % from_base_lv)
+            from_base_lv.activate(True, True)
+            new_base_lv = from_base_lv.create_snapshot(new_base.lv_name)
+        else:
+            pool = self._thinpool()
+            log.debug("Pool: %s" % pool)
+            new_base_lv = pool.create_thinvol(new_base.lv_name, size)
         new_base_lv.addtag(self.lv_base_tag)
         log.info("New LV is: %s" % new_base_lv)
 
@@ -0,0 +1,220 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# imgbase
+#
+# Copyright (C) 2018  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Journal of the paths the steps of an update changed
+
+Each migration step records the paths it created, modified, removed or
+chowned (owner or mode changed), with the reason, in an sqlite database.
+Later steps query it with paths(): the owners and modes of the chowned
+paths are compared to the rpm headers, and all recorded paths are
+relabeled, so the journal must have every change of an update.  imgbase
+update --explain reports it.
+
+Paths are recorded as they are in the new layer, /etc/passwd and not the
+path below a temporary mount point.  Only one journal is active at a time,
+without one record() does nothing.
+"""
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from . import constants
+
+log = logging.getLogger(__package__)
+
+
+ACTIONS = ("created", "modified", "removed", "chowned")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS changes (path TEXT, action TEXT, step TEXT,
+                                    reason TEXT, time REAL);
+CREATE INDEX IF NOT EXISTS changes_path ON changes (path);
+CREATE INDEX IF NOT EXISTS changes_action ON changes (action);
+"""
+
+
+class Journal(object):
+    """The changes of the update of target
+
+    >>> import tempfile
+    >>> path = tempfile.mkdtemp() + "/journal"
+    >>> j = Journal.start("Image-2.0-0.squashfs.img", path)
+    >>> record("migrate-etc", "modified", ["/etc/passwd"],
+    ...        "merged the users of the image")
+    >>> record("migrate-var", "created", ["/var/lib/new", "/var/lib/x"])
+    >>> Journal.stop()
+
+    >>> j = Journal.load(path)
+    >>> j.target
+    'Image-2.0-0.squashfs.img'
+    >>> j.paths("created", below="/var/lib")
+    ['/var/lib/new', '/var/lib/x']
+    >>> [tuple(c) for c in j.changes(step="migrate-etc")]
+    [('/etc/passwd', 'modified', 'migrate-etc', \
+'merged the users of the image')]
+    """
+    _active = None
+
+    path = None
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.executescript(SCHEMA)
+
+    @classmethod
+    def active(cls):
+        return cls._active
+
+    @classmethod
+    def start(cls, target, path=None, resume=False):
+        """Start the journal of the update of target, a resumed update
+        keeps the changes recorded so far
+        """
+        path = path or constants.IMGBASED_JOURNAL
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        if not resume and os.path.exists(path):
+            os.unlink(path)
+        journal = cls(path)
+        with journal._db:
+            journal._db.execute("INSERT OR REPLACE INTO meta VALUES "
+                                "('target', ?)", (target,))
+        cls._active = journal
+        return journal
+
+    @classmethod
+    def stop(cls):
+        journal, cls._active = cls._active, None
+        if journal:
+            journal.close()
+
+    @classmethod
+    def load(cls, path=None):
+        """Returns the journal of the last update, or None
+        """
+        path = path or constants.IMGBASED_JOURNAL
+        if not os.path.exists(path):
+            return None
+        return cls(path)
+
+    def close(self):
+        self._db.close()
+
+    @property
+    def target(self):
+        row = self._db.execute("SELECT value FROM meta "
+                               "WHERE key = 'target'").fetchone()
+        return row[0] if row else None
+
+    def record(self, step, action, paths, reason=None):
+        assert action in ACTIONS, action
+        now = time.time()
+        rows = [(p, action, step, reason, now) for p in paths]
+        with self._lock, self._db:
+            self._db.executemany("INSERT INTO changes VALUES (?, ?, ?, ?, ?)",
+                                 rows)
+
+    def changes(self, action=None, step=None, below=None):
+        """Returns the recorded changes, in the order they were made
+        """
+        query = "SELECT path, action, step, reason FROM changes WHERE 1"
+        args = []
+        if action:
+            query += " AND action = ?"
+            args.append(action)
+        if step:
+            query += " AND step = ?"
+            args.append(step)
+        if below:
+            below = below.rstrip("/")
+            query += " AND (path = ? OR path BETWEEN ? AND ?)"
+            args += [below, below + "/", below + "0"]
+        with self._lock:
+            return self._db.execute(query + " ORDER BY rowid",
+                                    args).fetchall()
+
+    def paths(self, action=None, below=None):
+        """Returns the sorted paths with a recorded change
+        """
+        return sorted(set(c["path"] for c in self.changes(action,
+                                                          below=below)))
+
+    def explain(self):
+        """Returns a report of the changes per step
+
+        >>> import tempfile
+        >>> j = Journal(tempfile.mkdtemp() + "/journal")
+        >>> j.record("migrate-etc", "created", ["/etc/motd"], "user file")
+        >>> j.record("migrate-etc", "chowned", ["/usr/bin/a", "/usr/bin/b"],
+        ...          "uid/gid drift")
+        >>> print(j.explain())
+        migrate-etc: 1 created, 2 chowned
+          created  /etc/motd (user file)
+          chowned  /usr/bin/a (uid/gid drift)
+          chowned  /usr/bin/b (uid/gid drift)
+        """
+        steps = {}
+        for change in self.changes():
+            steps.setdefault(change["step"], []).append(change)
+        lines = []
+        for step, changes in steps.items():
+            counts = [(a, sum(1 for c in changes if c["action"] == a))
+                      for a in ACTIONS]
+            lines.append("%s: %s" % (step, ", ".join("%d %s" % (n, a)
+                                                     for a, n in counts
+                                                     if n)))
+            for c in changes:
+                reason = " (%s)" % c["reason"] if c["reason"] else ""
+                lines.append("  %-8s %s%s" % (c["action"], c["path"],
+                                              reason))
+        return "\n".join(lines)
+
+
+def record(step, action, paths, reason=None):
+    """Record the change of paths by step with the active journal
+    """
+    journal = Journal.active()
+    if journal is None:
+        return
+    paths = list(paths)
+    if paths:
+        journal.record(step, action, paths, reason)
+
+
+def paths(action=None, below=None):
+    """Returns the paths with a recorded change in the active journal, or
+    none without one
+
+    >>> paths("chowned")
+    []
+    """
+    journal = Journal.active()
+    if journal is None:
+        return []
+    return journal.paths(action, below)
+
+# vim: sw=4 et sts=4:
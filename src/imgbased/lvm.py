@@ -67,6 +67,25 @@ class LVM(object):
         log.debug("All LV names: %s" % names)
         return names
 
+    @staticmethod
+    def _list_lv_tags(filtr=""):
+        """Returns the tags of all LVs by their full name, with a single
+        lvs call
+        """
+        sep = "$"
+        cmd = ["--noheadings", "--ignoreskippedcluster", "--separator", sep,
+               "-o", "lv_full_name,lv_tags"]
+        if filtr:
+            cmd += ["--select", filtr]
+        tags = {}
+        for line in LVM._lvs(cmd).splitlines():
+            if not line.strip():
+                continue
+            name, _, lv_tags = line.strip().partition(sep)
+            tags[name] = lv_tags.split(",")
+        log.debug("All LV tags: %s" % tags)
+        return tags
+
     @classmethod
     def list_lvs(cls, filtr=""):
         lvs = [cls.LV.from_lvm_name(n) for n in cls._list_lv_full_names(filtr)]
@@ -105,7 +124,10 @@ class LVM(object):
         return vol
 
     @staticmethod
-    def reset_registered_volumes():
+    def reset_registered_volumes(keep=()):
+        """Remove the volumes created by this run, except the lv_names in
+        keep
+        """
         if os.getenv("IMGBASED_KEEP_VOLUMES"):
             return
         run = ExternalBinary()
@@ -113,6 +135,8 @@ class LVM(object):
         mtab = dict([itemgetter(9, 4)(m.split())
                      for m in open("/proc/self/mountinfo")])
         for lv in LVM._volume_registry:
+            if lv.lv_name in keep:
+                continue
             target = mtab.get(lv.dm_path)
             if target:
                 run.umount([target])
@@ -375,6 +399,17 @@ class LVM(object):
                     self.lvm_name]
             return map(float, LVM._lvs(args).split())
 
+        def metadata_usage(self):
+            """Returns the used percentage and size (in bytes) of the
+            metadata, and the chunk size (in bytes)
+            """
+            args = ["--noheadings", "--ignoreskippedcluster", "--nosuffix",
+                    "--units", "b", "-o",
+                    "metadata_percent,lv_metadata_size,chunk_size",
+                    self.lvm_name]
+            pct, size, chunk = LVM._lvs(args).replace(",", ".").split()
+            return float(pct), int(float(size)), int(float(chunk))
+
         def _resize_metadata(self, x_size_mb):
             free = float(LVM._vgs(["--noheading", "--ignoreskippedcluster",
                                    "--nosuffix", "-o", "free",
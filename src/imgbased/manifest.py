@@ -0,0 +1,302 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# imgbase
+#
+# Copyright (C) 2018  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Index of the contents of an image
+
+image-build --postprocess writes it to /usr/share/imgbased/manifest, an
+sqlite database with a row per path of the image: its type, size, mode,
+owner, SELinux label, sha256, symlink target, owning package and the rpm
+file flags of the path in that package.
+
+An update reads the new image from it, instead of walking and hashing
+the new tree.  The manifest describes the image as it was built, a layer
+can change afterwards.
+"""
+import logging
+import os
+import sqlite3
+
+import rpm
+
+from . import constants, hashcache
+from .etcmerge import Entry, scan
+
+log = logging.getLogger(__package__)
+
+
+SCHEMA_VERSION = "1"
+
+SCHEMA = """
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE files (path TEXT PRIMARY KEY, type TEXT, size INTEGER,
+                    mode INTEGER, uid INTEGER, gid INTEGER, label TEXT,
+                    sha256 TEXT, target TEXT, rpm TEXT, flags TEXT)
+    WITHOUT ROWID;
+CREATE INDEX files_uid ON files (uid);
+CREATE INDEX files_gid ON files (gid);
+"""
+
+# Mount points of the build environment, not part of the image
+SKIP = ["dev", "proc", "run", "sys", "tmp", "var/tmp"]
+
+
+def _label(path):
+    try:
+        label = os.getxattr(path, "security.selinux", follow_symlinks=False)
+    except OSError:
+        return None
+    return label.rstrip(b"\0").decode()
+
+
+def _rpm_file_lines(root, fmt):
+    """Yields the fmt formatted files of the packages in the rpmdb of root
+    """
+    if not os.path.isdir(root + "/usr/share/rpm"):
+        log.debug("%s has no rpmdb" % root)
+        return
+    rpm.addMacro("_dbpath", root + "/usr/share/rpm")
+    try:
+        for hdr in rpm.TransactionSet().dbMatch():
+            name = hdr.format("%{NAME}")
+            for line in hdr.format("[" + fmt + "\n]").splitlines():
+                yield name, line
+    finally:
+        rpm.delMacro("_dbpath")
+
+
+def rpm_files(root):
+    """Returns {path: (package, fflags)} of the files owned by the packages
+    in the rpmdb of root
+    """
+    files = {}
+    for name, line in _rpm_file_lines(root, "%{FILEFLAGS:fflags} "
+                                      "%{FILENAMES}"):
+        flags, path = line.split(" ", 1)
+        files.setdefault(path, (name, flags))
+    return files
+
+
+def rpm_owned_by(root, users, groups):
+    """Returns the paths which the packages in the rpmdb of root assign to
+    one of the users or groups
+    """
+    users, groups = set(users), set(groups)
+    paths = set()
+    for _, line in _rpm_file_lines(root, "%{FILEUSERNAME} %{FILEGROUPNAME} "
+                                   "%{FILENAMES}"):
+        user, group, path = line.split(" ", 2)
+        if user in users or group in groups:
+            paths.add(path)
+    return sorted(paths)
+
+
+def rpm_file_attrs(root):
+    """Returns {path: (mode, user, group)} of the files which the packages
+    in the rpmdb of root own, ghosts are left out
+    """
+    attrs = {}
+    for _, line in _rpm_file_lines(root, "%{FILEMODES:octal} "
+                                   "%{FILEUSERNAME} %{FILEGROUPNAME} "
+                                   "%{FILEFLAGS:fflags} %{FILENAMES}"):
+        mode, user, group, flags, path = line.split(" ", 4)
+        if "g" not in flags:
+            attrs.setdefault(path, (int(mode, 8), user, group))
+    return attrs
+
+
+def build(root, path=None):
+    """Index the tree at root, and write the manifest to root + path
+    """
+    path = path or constants.IMGBASED_MANIFEST
+    dst = root.rstrip("/") + path
+    directory = os.path.dirname(dst)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    skip = SKIP + [path.lstrip("/"), path.lstrip("/") + ".tmp"]
+    entries = scan(root.rstrip("/") or "/", skip=skip)
+    owners = rpm_files(root)
+
+    # Hashing the whole image is spread over all cores
+    digests = hashcache.digests([e.path for e in entries.values()
+                                 if e.kind == "file"])
+
+    def rows():
+        for relpath in sorted(entries):
+            entry = entries[relpath]
+            abspath = "/" + relpath
+            owner, flags = owners.get(abspath, (None, None))
+            digest = digests.get(entry.path)
+            yield (abspath, entry.kind, entry.size, entry.mode, entry.uid,
+                   entry.gid, _label(entry.path), digest, entry.target,
+                   owner, flags)
+
+    if os.path.exists(dst + ".tmp"):
+        os.unlink(dst + ".tmp")
+    db = sqlite3.connect(dst + ".tmp")
+    try:
+        db.executescript(SCHEMA)
+        db.execute("INSERT INTO meta VALUES ('version', ?)",
+                   (SCHEMA_VERSION,))
+        db.executemany("INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, "
+                       "?, ?, ?)", rows())
+        db.commit()
+    finally:
+        db.close()
+    os.rename(dst + ".tmp", dst)
+    log.info("Wrote the manifest of %d paths to %s" % (len(entries), dst))
+
+
+def _below(path):
+    """Returns the bounds of the paths below path, for a range query
+
+    >>> _below("/etc")
+    ('/etc/', '/etc0')
+    >>> _below("/")
+    ('/', '0')
+    """
+    path = path.rstrip("/")
+    return (path + "/", path + "0")
+
+
+class Manifest(object):
+    """The manifest of an image
+
+    >>> import tempfile
+    >>> root = tempfile.mkdtemp()
+    >>> os.makedirs(root + "/etc/ssh")
+    >>> with open(root + "/etc/ssh/sshd_config", "w") as f:
+    ...     _ = f.write("PermitRootLogin no")
+    >>> build(root)
+    >>> manifest = Manifest.open(root)
+    >>> [(r["path"], r["type"]) for r in manifest.entries("/etc")]
+    [('/etc/ssh', 'dir'), ('/etc/ssh/sshd_config', 'file')]
+    >>> manifest.get("/etc/ssh/sshd_config")["size"]
+    18
+    >>> sorted(manifest.tree(root, "/etc/ssh"))
+    ['sshd_config']
+    >>> manifest.get("/etc/missing") is None
+    True
+    >>> Manifest.open(tempfile.mkdtemp()) is None
+    True
+    """
+    path = None
+
+    def __init__(self, path):
+        self.path = path
+        self._db = sqlite3.connect("file:%s?mode=ro&immutable=1" % path,
+                                   uri=True, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+
+    @classmethod
+    def open(cls, root):
+        """Returns the manifest of the image at root, or None if the image
+        has no manifest which can be read
+        """
+        path = root.rstrip("/") + constants.IMGBASED_MANIFEST
+        if not os.path.exists(path):
+            log.debug("%s has no manifest" % root)
+            return None
+        try:
+            manifest = cls(path)
+            version = manifest._db.execute(
+                "SELECT value FROM meta WHERE key = 'version'").fetchone()
+        except sqlite3.Error as e:
+            log.warning("Ignoring the manifest %s: %s" % (path, e))
+            return None
+        if version is None or version[0] != SCHEMA_VERSION:
+            log.debug("Ignoring the manifest %s of another version" % path)
+            return None
+        return manifest
+
+    def get(self, path):
+        return self._db.execute("SELECT * FROM files WHERE path = ?",
+                                (path,)).fetchone()
+
+    def entries(self, path="/"):
+        """Yields the rows below path, parents before their children
+        """
+        return self._db.execute("SELECT * FROM files WHERE path >= ? AND "
+                                "path < ? ORDER BY path", _below(path))
+
+    def owned_by(self, uids, gids):
+        """Yields the rows owned by any of the uids or gids
+        """
+        uids, gids = list(uids), list(gids)
+        query = "SELECT * FROM files WHERE uid IN (%s) OR gid IN (%s)" % (
+            ", ".join("?" * len(uids)) or "NULL",
+            ", ".join("?" * len(gids)) or "NULL")
+        return self._db.execute(query, uids + gids)
+
+    def packaged(self):
+        """Yields the rows of the paths owned by a package
+        """
+        return self._db.execute("SELECT * FROM files WHERE rpm IS NOT NULL "
+                                "ORDER BY path")
+
+    def tree(self, root, path, prefix=""):
+        """Returns the rows below path like etcmerge.scan() returns the
+        tree at root + path
+        """
+        offset = len(path.rstrip("/")) + 1
+        tree = {}
+        for row in self.entries(path):
+            relpath = row["path"][offset:]
+            relpath = prefix + "/" + relpath if prefix else relpath
+            tree[relpath] = Entry(root.rstrip("/") + row["path"], row["type"],
+                                  row["size"], row["mode"], row["uid"],
+                                  row["gid"], row["target"],
+                                  digest=row["sha256"])
+        return tree
+
+    def listing(self):
+        """Returns a line per path, to compare images
+        """
+        lines = []
+        for row in self.entries("/"):
+            lines.append("%-4s %04o %5d %5d %10d %s %s%s\n" % (
+                row["type"], row["mode"], row["uid"], row["gid"],
+                row["size"], row["sha256"] or "-" * 64, row["path"],
+                " -> " + row["target"] if row["target"] else ""))
+        return lines
+
+
+def image_paths(root, path):
+    """Yields (path, type, size) of everything below path in the image at
+    root, parents before their children.  They are read from the manifest
+    if the image has one, otherwise the tree is walked
+
+    >>> import tempfile
+    >>> root = tempfile.mkdtemp()
+    >>> os.makedirs(root + "/var/lib/new")
+    >>> [(p, t) for p, t, _ in image_paths(root, "/var")]
+    [('/var/lib', 'dir'), ('/var/lib/new', 'dir')]
+    """
+    manifest = Manifest.open(root)
+    if manifest is not None:
+        for row in manifest.entries(path):
+            yield (row["path"], row["type"], row["size"])
+        return
+    tree = scan(root.rstrip("/") + path)
+    for relpath in sorted(tree):
+        entry = tree[relpath]
+        yield (path.rstrip("/") + "/" + relpath, entry.kind, entry.size)
+
+# vim: sw=4 et sts=4:
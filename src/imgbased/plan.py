@@ -0,0 +1,232 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# imgbase
+#
+# Copyright (C) 2018  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""The actions an update would take (update --plan), without taking them
+
+The actions are grouped by the timeline steps which perform them, so the
+duration of each step can be estimated from the timelines of the past
+updates of this host.
+"""
+import logging
+
+from .progress import format_duration
+from .timeline import Timeline
+
+log = logging.getLogger(__package__)
+
+
+# Steps which run as part of another step, their duration is already
+# included in the duration of the outer step
+NESTED_STEPS = {"rpm-perms": "migrate-etc",
+                "dracut": "boot-setup"}
+
+
+def _median(values):
+    """
+    >>> _median([3, 1, 2]), _median([1, 2, 3, 4])
+    (2, 2.5)
+    """
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+class CostModel(object):
+    """Estimates the duration of a step from its past durations
+
+    If the step recorded the amount of data it processed, the estimate is
+    based on the median throughput, otherwise on the median duration:
+
+    >>> costs = CostModel([{"copy-tree": (100.0, 1000, 10)},
+    ...                    {"copy-tree": (300.0, 1000, 10),
+    ...                     "relabel": (60.0, None, None)}])
+    >>> costs.estimate("copy-tree", bytes=2000)
+    400.0
+    >>> costs.estimate("copy-tree", files=5)
+    100.0
+    >>> costs.estimate("relabel", bytes=2000)
+    60.0
+    >>> costs.estimate("dracut") is None
+    True
+    """
+    runs = None
+
+    def __init__(self, runs):
+        self.runs = runs
+
+    @classmethod
+    def from_log_dir(cls, log_dir, last=5):
+        """Returns the costs of the last successful updates recorded in
+        log_dir
+        """
+        runs = []
+        for path in Timeline.list(log_dir)[::-1]:
+            try:
+                events = Timeline.load(path)
+            except ValueError:
+                log.debug("Skipping unreadable timeline %s" % path)
+                continue
+            if not any(e["event"] == "stop" and e.get("result") == "ok"
+                       for e in events):
+                continue
+            runs.append(cls._step_costs(events))
+            if len(runs) >= last:
+                break
+        return cls(runs)
+
+    @staticmethod
+    def _step_costs(events):
+        """Returns the summed up duration, bytes and files per step
+
+        >>> CostModel._step_costs([
+        ...     {"event": "step", "step": "dracut", "duration": 1.0,
+        ...      "bytes": None, "files": None, "result": "ok"},
+        ...     {"event": "step", "step": "dracut", "duration": 2.0,
+        ...      "bytes": 10, "files": None, "result": "ok"}])
+        {'dracut': (3.0, 10, None)}
+        """
+        costs = {}
+        for event in events:
+            if event["event"] != "step" or event.get("result") != "ok":
+                continue
+            duration, nbytes, nfiles = costs.get(event["step"],
+                                                 (0, None, None))
+            if event.get("bytes") is not None:
+                nbytes = (nbytes or 0) + event["bytes"]
+            if event.get("files") is not None:
+                nfiles = (nfiles or 0) + event["files"]
+            costs[event["step"]] = (duration + event["duration"],
+                                    nbytes, nfiles)
+        return costs
+
+    def estimate(self, step, bytes=None, files=None):
+        """Returns the expected seconds of step, or None without history
+        """
+        samples = [run[step] for run in self.runs if step in run]
+        if not samples:
+            return None
+        per_byte = [d / b for d, b, _ in samples if b]
+        per_file = [d / f for d, _, f in samples if f]
+        if bytes is not None and per_byte:
+            return _median(per_byte) * bytes
+        if files is not None and per_file:
+            return _median(per_file) * files
+        return _median([d for d, _, _ in samples])
+
+
+class Action(object):
+    """Something a step of the update would do
+    """
+    step = None
+    description = None
+    bytes = None
+    files = None
+
+    def __init__(self, step, description, bytes=None, files=None):
+        self.step = step
+        self.description = description
+        self.bytes = bytes
+        self.files = files
+
+
+class Plan(object):
+    """The actions of an update, grouped by step
+
+    >>> plan = Plan("Image-2.0-0")
+    >>> plan.add("copy-tree", "Copy 2000B in 5 files", bytes=2000, files=5)
+    >>> plan.add("migrate-etc", "Copy 12 modified files of /etc")
+    >>> plan.add("rpm-perms", "Verify the permissions of 400 packages")
+    >>> plan.add("migrate-etc", "Fix 2 drifted uids")
+    >>> costs = CostModel([{"copy-tree": (100.0, 1000, 10),
+    ...                     "migrate-etc": (30.0, None, None)}])
+    >>> print(plan.format(costs))
+    Update plan for Image-2.0-0
+    copy-tree           03:20  Copy 2000B in 5 files
+    migrate-etc         00:30  Copy 12 modified files of /etc
+                               Fix 2 drifted uids
+      rpm-perms             ?  Verify the permissions of 400 packages
+    Total               03:50  (without rpm-perms, no past timings)
+    """
+    target = None
+    actions = None
+
+    def __init__(self, target):
+        self.target = target
+        self.actions = []
+
+    def add(self, step, description, bytes=None, files=None):
+        self.actions.append(Action(step, description, bytes, files))
+
+    def steps(self):
+        """Returns the steps of the actions, nested steps follow their
+        outer step
+        """
+        steps = []
+        for action in self.actions:
+            if action.step not in steps and \
+                    action.step not in NESTED_STEPS:
+                steps.append(action.step)
+        for action in self.actions:
+            if action.step in steps:
+                continue
+            outer = NESTED_STEPS[action.step]
+            if outer in steps:
+                steps.insert(steps.index(outer) + 1, action.step)
+            else:
+                steps.append(action.step)
+        return steps
+
+    def estimate(self, costs, step):
+        actions = [a for a in self.actions if a.step == step]
+        nbytes = [a.bytes for a in actions if a.bytes is not None]
+        nfiles = [a.files for a in actions if a.files is not None]
+        return costs.estimate(step,
+                              sum(nbytes) if nbytes else None,
+                              sum(nfiles) if nfiles else None)
+
+    def format(self, costs):
+        lines = ["Update plan for %s" % self.target]
+        steps = self.steps()
+        total = 0
+        unknown = []
+        for step in steps:
+            estimate = self.estimate(costs, step)
+            nested = step in NESTED_STEPS and NESTED_STEPS[step] in steps
+            if estimate is None:
+                unknown.append(step)
+            elif not nested:
+                total += estimate
+            name = ("  " + step) if nested else step
+            label = "?" if estimate is None else format_duration(estimate)
+            for idx, action in enumerate(a for a in self.actions
+                                         if a.step == step):
+                if idx:
+                    name, label = "", ""
+                lines.append("%-18s %6s  %s" % (name, label,
+                                                action.description))
+        line = "%-18s %6s" % ("Total", format_duration(total))
+        if unknown:
+            line += "  (without %s, no past timings)" % ", ".join(unknown)
+        lines.append(line)
+        return "\n".join(lines)
+
+# vim: sw=4 et sts=4:
@@ -2,6 +2,8 @@
 import pkgutil
 import logging
 
+from ..profiling import timed
+
 log = logging.getLogger(__package__)
 plugins = []
 
@@ -17,7 +19,8 @@ def _on_all_plugins(funcname, *args):
         if hasattr(p, funcname):
             f = getattr(p, funcname)
             # log.debug("Calling init on: %s" % f)
-            f(*args)
+            with timed(funcname, p.__name__):
+                f(*args)
 
 
 def init(app):
@@ -8,7 +8,10 @@ import subprocess
 
 from configparser import ConfigParser
 
-from ..utils import BuildMetadata, File, Rsync, ShellVarFile, systemctl
+from .. import manifest
+from ..delta import create_delta
+from ..utils import BuildMetadata, File, Rsync, ShellVarFile, \
+    mounted_liveimg, systemctl
 
 log = logging.getLogger(__package__)
 
@@ -25,6 +28,10 @@ def add_argparse(app, parser, subparsers):
                    help="Do some post-processing")
     s.add_argument("--set-nvr",
                    help="Define the nvr of this build")
+    s.add_argument("--make-delta", nargs=3,
+                   metavar=("OLD", "NEW", "PAYLOAD"),
+                   help="Create a delta payload to update from the squashfs "
+                   "image OLD to the squashfs image NEW")
 
     s = subparsers.add_parser("image-introspect",
                               help="Informations around this image")
@@ -39,12 +46,23 @@ def post_argparse(app, args):
             Postprocessor.postprocess(app)
         if args.set_nvr:
             BuildMetadata().set("nvr", args.set_nvr)
+        if args.make_delta:
+            make_delta(*args.make_delta)
     elif args.command == "image-introspect":
         if args.metadata:
             metadata = dict(BuildMetadata().items())
             print(json.dumps(metadata, indent=2))
 
 
+def make_delta(old, new, payload):
+    with mounted_liveimg(old) as old_fs, mounted_liveimg(new) as new_fs:
+        old_root, new_root = old_fs.target, new_fs.target
+        old_nvr = BuildMetadata(old_root).get("nvr")
+        new_nvr = BuildMetadata(new_root).get("nvr")
+        log.info("Creating delta from %s to %s" % (old_nvr, new_nvr))
+        create_delta(old_root, new_root, old_nvr, new_nvr, payload)
+
+
 def factorize(path):
     """Prepare a path for systemd's factory model
 
@@ -227,4 +245,13 @@ def handle_bls_system():
         os.unlink(entry)
 
 
+@Postprocessor.add_step
+def write_manifest():
+    """Index the contents of the image, an update reads the new image from
+    the index. This has to be the last step
+    """
+    log.info("Writing the manifest of the image")
+    manifest.build("/")
+
+
 # vim: sw=4 et sts=4
@@ -5,6 +5,7 @@ import sys
 import logging
 
 from .. import utils
+from ..manifest import Manifest
 from ..naming import Image
 
 
@@ -66,10 +67,26 @@ def diff(imgbase, left, right, mode="tree"):
 
     with utils.mounted(imgl.path, target="/mnt/%s" % left) as mountl, \
             utils.mounted(imgr.path, target="/mnt/%s" % right) as mountr:
+        # Bases are not changed after they were built, their manifests
+        # describe them
+        manifests = [Manifest.open(m.target) for m in [mountl, mountr]]
+        if mode == "tree" and None not in manifests and \
+                all(Image.from_nvr(i).is_base() for i in [left, right]):
+            lside, rside = [m.listing() for m in manifests]
+            return print_diff(lside, rside, left, right)
         return path_diff(mountl.target, mountr.target, mode,
                          left, right)
 
 
+def print_diff(lside, rside, left_alias, right_alias):
+    udiff = difflib.unified_diff(rside, lside, fromfile=left_alias,
+                                 tofile=right_alias, n=0)
+    lines = (
+        current_line for current_line in udiff
+        if not current_line.startswith("@"))
+    sys.stdout.writelines(lines)
+
+
 def path_diff(left, right, mode, left_alias=None, right_alias=None):
     left_alias = left_alias or left
     right_alias = right_alias or right
@@ -81,12 +98,7 @@ def path_diff(left, right, mode, left_alias=None, right_alias=None):
     if mode == "tree":
         lside = utils.findls(left)
         rside = utils.findls(right)
-        udiff = difflib.unified_diff(rside, lside, fromfile=left_alias,
-                                     tofile=right_alias, n=0)
-        lines = (
-            current_line for current_line in udiff
-            if not current_line.startswith("@"))
-        sys.stdout.writelines(lines)
+        print_diff(lside, rside, left_alias, right_alias)
     elif mode == "content":
         import subprocess
         subprocess.call(["diff", "-urN",
@@ -0,0 +1,74 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# imgbase
+#
+# Copyright (C) 2018  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import argparse
+import logging
+
+from .. import constants
+from ..timeline import Timeline, history_table, summarize
+
+log = logging.getLogger(__package__)
+
+
+def init(app):
+    app.hooks.connect("pre-arg-parse", add_argparse)
+    app.hooks.connect("post-arg-parse", post_argparse)
+
+
+def add_argparse(app, parser, subparsers):
+    h = subparsers.add_parser("history",
+                              help="Show the step durations of past updates")
+    h.add_argument("--last", type=_positive, default=5,
+                   help="Number of updates to show")
+
+
+def _positive(value):
+    """
+    >>> _positive("3")
+    3
+    >>> _positive("0")
+    Traceback (most recent call last):
+    ...
+    argparse.ArgumentTypeError: 0 is not a positive number
+    """
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError("%s is not a positive number" %
+                                         value)
+    return number
+
+
+def post_argparse(app, args):
+    if args.command == "history":
+        print(history(constants.IMGBASED_LOG_DIR, args.last))
+
+
+def history(directory, last):
+    runs = []
+    for path in Timeline.list(directory)[-last:]:
+        try:
+            runs.append(summarize(Timeline.load(path)))
+        except (ValueError, KeyError):
+            log.warning("Skipping unreadable timeline %s" % path)
+    if not runs:
+        return "No updates were recorded in %s" % directory
+    return history_table(runs)
+
+# vim: sw=4 et sts=4:
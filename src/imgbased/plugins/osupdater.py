@@ -22,30 +22,39 @@
 #
 
 import errno
-import filecmp
 import glob
-import hashlib
 import logging
 import os
 import re
 import shutil
+import stat
 import subprocess
-from filecmp import dircmp
+import time
 from tempfile import mkdtemp
+from concurrent.futures import ThreadPoolExecutor
 from configparser import ConfigParser
+from contextlib import contextmanager
 
 import rpm
 
-from .. import bootloader, constants, timeserver, utils
+from .. import bootloader, constants, etcmerge, journal, timeserver, utils
 from ..bootsetup import BootSetupHandler
-from ..command import nsenter
+from ..checkpoint import Checkpoint, phase
+from ..command import chroot, nsenter
+from ..hashcache import same_content
 from ..lvm import LVM
+from ..manifest import (Manifest, image_paths, rpm_file_attrs, rpm_files,
+                        rpm_owned_by)
 from ..naming import Image
 from ..openscap import OSCAPScanner
-from ..utils import (File, Fstab, IDMap, LvmCLI, Motd, RpmPackageDb, Rsync,
-                     SELinux, SELinuxDomain, ShellVarFile, SystemRelease,
-                     ThreadRunner, copy_files, mounted, remove_file, systemctl,
-                     thread_group_handler)
+from ..prepare import PrepareCache, fingerprint
+from ..progress import format_bytes
+from ..scheduler import Scheduler
+from ..timeline import step
+from ..utils import (BuildMetadata, File, Fstab, IDMap, IDRegistry, LvmCLI,
+                     Motd, RpmPackageDb, Rsync, SELinux, SELinuxDomain,
+                     ShellVarFile, SystemRelease, copy_files, mounted,
+                     systemctl)
 from ..volume import Volumes
 
 log = logging.getLogger(__package__)
@@ -78,6 +87,8 @@ def pre_init(app):
 
 def init(app):
     app.imgbase.hooks.connect("new-layer-added", on_new_layer)
+    app.imgbase.hooks.connect("update-prepare", on_update_prepare)
+    app.imgbase.hooks.connect("update-plan", on_update_plan)
     app.imgbase.hooks.connect("pre-layer-removed", on_remove_layer)
     app.imgbase.hooks.connect("post-init-layout", on_post_init_layout)
 
@@ -87,39 +98,55 @@ def on_new_layer(imgbase, previous_lv, new_lv):
 
     vdsm_is_active = preprocess(imgbase)
     previous_layer_lv = get_prev_layer_lv(imgbase, new_lv)
-
+    since = None
+    if imgbase.mode == constants.IMGBASED_MODE_UPDATE:
+        since = migration_start()
+
+    # Steps which mount volumes or run lvm and rsync read the host's /etc,
+    # check-nist-layout bind mounts the new /etc over it for a while
+    migration = Scheduler()
+    # Some change in managed nodes is blapping /dev/mapper. Add it back
+    # so LVM and /dev/mapper agree
+    migration.add("thinpool-profile", set_thinpool_profile, imgbase, new_lv,
+                  reads=["new /etc", "/etc"])
+    migration.add("mknod-dev-urandom", mknod_dev_urandom, new_lv,
+                  reads=["/etc"], writes=["new /dev"])
+    migration.add("remediate-etc", remediate_etc, imgbase, new_lv,
+                  writes=["new /etc"])
+    migration.add("migrate-var", migrate_var, imgbase, new_lv,
+                  writes=["/var"])
+    # Creates the volumes below /var, their mounts are written to the new
+    # /etc which is bind mounted over /etc meanwhile
+    migration.add("check-nist-layout", check_nist_layout, imgbase, new_lv,
+                  after=["remediate-etc", "migrate-var"],
+                  writes=["new /etc", "/etc", "/var"])
+    migration.add("migrate-etc", migrate_etc, imgbase, new_lv,
+                  previous_layer_lv, after=["check-nist-layout"],
+                  writes=["new /etc", "new owners", "/var"])
+    migration.add("migrate-root", migrate_state, new_lv, previous_layer_lv,
+                  "/root/", reads=["/etc"], writes=["new /root"])
+    migration.add("migrate-rhn", migrate_state, new_lv, previous_layer_lv,
+                  "/usr/share/rhn/", exclude=["*.py*"], reads=["/etc"],
+                  writes=["new /usr/share/rhn"])
+    migration.add("relocate-update-manager", relocate_update_manager, new_lv,
+                  after=["migrate-var"], reads=["/etc"], writes=["/var"])
     try:
-        # Some change in managed nodes is blapping /dev/mapper. Add it back
-        # so LVM and /dev/mapper agree
-        set_thinpool_profile(imgbase, new_lv)
-        mknod_dev_urandom(new_lv)
-
-        threads = []
-        threads.append(ThreadRunner(remediate_etc, imgbase, new_lv))
-        threads.append(ThreadRunner(migrate_var, imgbase, new_lv))
-
-        thread_group_handler(threads, ConfigMigrationError)
-
-        check_nist_layout(imgbase, new_lv)
-
-        threads = []
-        threads.append(ThreadRunner(migrate_etc, imgbase, new_lv,
-                                    previous_layer_lv))
-        threads.append(ThreadRunner(migrate_state, new_lv, previous_layer_lv,
-                                    "/root/"))
-        threads.append(ThreadRunner(migrate_state, new_lv, previous_layer_lv,
-                                    "/usr/share/rhn/", exclude=["*.py*"]))
-        threads.append(ThreadRunner(relocate_update_manager, new_lv))
-
-        thread_group_handler(threads)
+        migration.run()
     except Exception:
         log.exception("Failed to migrate etc")
         raise ConfigMigrationError()
+    finally:
+        log.info(migration.report())
 
-    postprocess(new_lv)
-    migrate_boot(imgbase, new_lv, previous_layer_lv)
-    imgbase.protect_init_lv()
-    restart_vdsm(vdsm_is_active)
+    finish = Scheduler()
+    finish.add("postprocess", postprocess, new_lv)
+    finish.add("migrate-boot", migrate_boot, imgbase, new_lv,
+               previous_layer_lv, since, after=["postprocess"])
+    finish.add("protect-init-lv", imgbase.protect_init_lv,
+               after=["migrate-boot"])
+    finish.add("restart-vdsm", restart_vdsm, vdsm_is_active,
+               after=["protect-init-lv"])
+    finish.run()
 
 
 def preprocess(imgbase):
@@ -151,6 +178,7 @@ def get_prev_layer_lv(imgbase, new_lv):
     return previous_layer_lv
 
 
+@phase("mknod-dev-urandom")
 def mknod_dev_urandom(new_lv):
     with mounted(new_lv.path) as new_fs:
         devurandom = "{}/dev/urandom".format(new_fs.target)
@@ -172,6 +200,7 @@ def restart_vdsm(vdsm_is_active):
         log.info("vdsmd was not active, skipping restart")
 
 
+@phase("postprocess")
 def postprocess(new_lv):
     def _vdsm_config_lvm_filter():
         env = os.environ.copy()
@@ -250,7 +279,9 @@ def postprocess(new_lv):
         utils.ExternalBinary().rpm(["-U", "--quiet", "--justdb", "--root",
                                     new_fs.path("/"), rpms[0]])
 
-    with mounted(new_lv.path) as new_fs:
+    with mounted(new_lv.path) as new_fs, \
+            journaled("postprocess", new_fs.path("/"),
+                      ["/etc", "/usr/share/rpm", "/var/lib/rpm"]):
         _vdsm_config_lvm_filter()
         _reconfigure_vdsm()
         _apply_scap_profile()
@@ -260,9 +291,10 @@ def postprocess(new_lv):
     _clear_libvirt_cache()
 
 
-def migrate_boot(imgbase, new_lv, previous_layer_lv):
+@phase("migrate-boot")
+def migrate_boot(imgbase, new_lv, previous_layer_lv, since=None):
     try:
-        adjust_mounts_and_boot(imgbase, new_lv, previous_layer_lv)
+        adjust_mounts_and_boot(imgbase, new_lv, previous_layer_lv, since)
     except Exception:
         # FIXME Handle and rollback
         log.exception("Failed to update OS")
@@ -301,6 +333,7 @@ def set_thinpool_profile(imgbase, new_lv):
             log.warn("Unknown profile set for thinpool: %s", cur_profile)
 
 
+@phase("check-nist-layout")
 def check_nist_layout(imgbase, new_lv):
     paths = constants.volume_paths()
 
@@ -323,7 +356,8 @@ def check_nist_layout(imgbase, new_lv):
         new_config = "{}/lvm.conf.new".format(config_path)
 
         shutil.copy2(lvm_config_path, original_config)
-        with utils.bindmounted(new_fs.path("/etc"), "/etc"):
+        with utils.bindmounted(new_fs.path("/etc"), "/etc"), \
+                journaled("check-nist-layout", new_fs.path("/"), ["/etc"]):
             shutil.copy2("/etc/lvm/lvm.conf", new_config)
             shutil.copy2(original_config, lvm_config_path)
             v = Volumes(imgbase)
@@ -331,15 +365,36 @@ def check_nist_layout(imgbase, new_lv):
                 log.debug("Creating %s as %s" % (t, paths[t]))
                 v.create(t, paths[t]["size"], paths[t]["attach"])
             shutil.copy2(new_config, lvm_config_path)
+        journal.record("check-nist-layout", "created", to_create,
+                       "missing volume")
 
 
+@phase("migrate-state")
 def migrate_state(new_lv, previous_lv, path, exclude=None):
     log.debug("Migrating %s from the old image to the new image" % path)
     rsync = Rsync(exclude=exclude)
     with mounted(new_lv.path) as new_fs, mounted(previous_lv.path) as old_fs:
         old_path = old_fs.path(path)
         if os.path.isdir(old_path):
-            rsync.sync(old_path, new_fs.path(path))
+            with journaled("migrate-state", new_fs.path("/"),
+                           [path.rstrip("/")]):
+                rsync.sync(old_path, new_fs.path(path))
+
+
+def rpm_file_flags(new_root, files):
+    """Returns {path: fflags} of the files owned by a package of the image
+    at new_root, and {path: sha256} of the files if the image knows them
+
+    The flags are looked up in the manifest of the image, or in an index of
+    its rpmdb, both without running rpm.
+    """
+    manifest = Manifest.open(new_root)
+    if manifest is not None:
+        rows = [r for r in map(manifest.get, files) if r and r["rpm"]]
+        return ({r["path"]: r["flags"] for r in rows},
+                {r["path"]: r["sha256"] for r in rows})
+    index = rpm_files(new_root)
+    return ({f: index[f][1] for f in files if f in index}, {})
 
 
 def migrate_rpm_files(new_root, files):
@@ -347,17 +402,10 @@ def migrate_rpm_files(new_root, files):
         log.debug("No rpm files to migrate")
         return
     log.debug("Migrating files by rpm databases: %s", files)
-    rpmdb = RpmPackageDb()
-    rpmdb.root = new_root
-    rpms, unknown = rpmdb.get_query_files(files)
-    ghost_files = {}
-    conf_files = {}
-    if rpms:
-        ghost_files = rpmdb.get_ghost_files(rpms)
-        conf_files = rpmdb.get_conf_files(rpms)
+    flags, image_digests = rpm_file_flags(new_root, files)
     for dst in files:
-        if dst in list(ghost_files.keys()) + unknown:
-            log.debug("Skip %s, fflags=[%s]", dst, ghost_files.get(dst, ""))
+        if dst not in flags or "g" in flags[dst]:
+            log.debug("Skip %s, fflags=[%s]", dst, flags.get(dst, ""))
             continue
         src = new_root + "/" + dst
         if os.path.islink(src):
@@ -367,182 +415,139 @@ def migrate_rpm_files(new_root, files):
                     os.rename(dst, dst + ".imglnk")
                     os.symlink(src_lnk, dst)
                     log.debug("Updated symlink %s -> %s", dst, src_lnk)
+                    _record_rpm_file(dst, ".imglnk")
             else:
                 os.rename(dst, dst + ".imgbak")
                 os.symlink(src_lnk, dst)
                 log.debug("Updated symlink %s -> %s", dst, src_lnk)
+                _record_rpm_file(dst, ".imgbak")
             continue
-        if os.path.samefile(src, dst) or filecmp.cmp(src, dst):
+        if os.path.samefile(src, dst) or \
+                same_content(dst, src, image_digests.get(dst)):
             continue
-        dst_conf = conf_files.get(dst)
-        if dst_conf and "n" in dst_conf:  # %config(noreplace)
+        if "c" in flags[dst] and "n" in flags[dst]:  # %config(noreplace)
             shutil.copy2(src, dst + ".imgnew")
             log.debug("Saved config file to %s.imgnew", dst)
+            journal.record("migrate-var", "created", [dst + ".imgnew"],
+                           "new version of a changed config file")
             continue
         os.rename(dst, dst + ".imgbak")
         shutil.copy2(src, dst)
         log.debug("Updated file %s", dst)
-
-
+        _record_rpm_file(dst, ".imgbak")
+
+
+def _record_rpm_file(path, backup):
+    journal.record("migrate-var", "created", [path + backup],
+                   "backup of the replaced file")
+    journal.record("migrate-var", "modified", [path],
+                   "replaced by the version of the image")
+
+
+def var_changes(image_root, root="/"):
+    """Returns the entries of /var in image_root which don't exist in the
+    /var of root, and the files which exist in both.  Of a missing
+    directory only the directory is returned
+
+    >>> import tempfile
+    >>> image_root, root = tempfile.mkdtemp(), tempfile.mkdtemp()
+    >>> for d in ["/var/lib/new/sub", "/var/log", "/run"]:
+    ...     os.makedirs(image_root + d)
+    >>> os.makedirs(root + "/var/log")
+    >>> for path in ["/var/lib/new/sub/state", "/var/log/lastlog"]:
+    ...     with open(image_root + path, "w") as f:
+    ...         _ = f.write("")
+    >>> os.symlink("../run", image_root + "/var/run")
+    >>> os.symlink("../run", root + "/var/run")
+    >>> open(root + "/var/log/lastlog", "w").close()
+    >>> var_changes(image_root, root)
+    ([('/var/lib', 'dir')], ['/var/log/lastlog'])
+    """
+    missing, existing = [], []
+    listings = {}
+
+    def listing(path):
+        # The names in a directory of root, or None if it is none
+        if path not in listings:
+            live = os.path.join(root, path.lstrip("/"))
+            listings[path] = set(os.listdir(live)) \
+                if os.path.isdir(live) and not os.path.islink(live) else None
+        return listings[path]
+
+    pruned = set()
+    for path, kind, _ in image_paths(image_root, "/var"):
+        parent, name = os.path.split(path)
+        if parent in pruned:
+            pruned.add(path)
+            continue
+        present = listing(parent)
+        if present is None or kind == "dir" and name not in present:
+            # Nothing below is looked at again
+            pruned.add(path)
+            if present is not None:
+                missing.append((path, kind))
+        elif name not in present:
+            missing.append((path, kind))
+        elif kind != "dir" and not os.path.isdir(image_root + path):
+            existing.append(path)
+    return missing, existing
+
+
+def _copy_var_entry(src, dst, kind):
+    """Copies src to dst, returns the paths which were created
+    """
+    log.debug("Copying {} to {}".format(src, dst))
+    try:
+        if kind == "dir":
+            shutil.copytree(src, dst, symlinks=True)
+        else:
+            shutil.copy2(src, dst, follow_symlinks=False)
+    except IOError as e:
+        log.warn("Copy failed %s, err=%s", src, e.errno)
+        if e.errno != errno.ENOENT:
+            raise
+    if not os.path.lexists(dst):
+        return []
+    created = [dst]
+    if kind == "dir":
+        for parent, dirs, files in os.walk(dst):
+            created.extend(os.path.join(parent, name)
+                           for name in dirs + files)
+    return created
+
+
+@step("migrate-var")
+@phase("migrate-var")
 def migrate_var(imgbase, new_lv):
-    def strip(s):
-        return re.sub(r'^/tmp/mnt.*?/', '', s)
-
     log.debug("Syncing items from the new /var")
 
     with mounted(new_lv.path) as new_fs:
-        xfiles = []
-        for cur, _dirs, files in os.walk(new_fs.path("/var")):
-            for d in _dirs:
-                newlv_path = "/".join([cur, d])
-                realpath = "/".join([strip(cur), d])
-                # Don't copy the libvirt/qemu cache to new layers on upgrades.
-                # This is supposed to be checked by qemu/libvirt through a
-                # ctime comparison, but is also cleared on RPM upgrades.
-                #
-                # Instead of deleting it, we can just skip the copy
-
-                if not os.path.exists(realpath) and \
-                        "cache/libvirt/qemu/capabilities" not in realpath:
-                    log.debug("Copying {} to {}".format(newlv_path, realpath))
-                    if os.path.isdir(newlv_path):
-                        shutil.copytree(newlv_path, realpath, symlinks=True)
-                    else:
-                        shutil.copy2(newlv_path, realpath)
-            for f in files:
-                newlv_path = "/".join([cur, f])
-                realpath = "/".join([strip(cur), f])
-                if not os.path.exists(realpath):
-                    log.debug("Copying {} to {}".format(newlv_path, realpath))
-                    try:
-                        shutil.copy2(newlv_path, realpath)
-                    except IOError as e:
-                        log.warn("Copy failed %s, err=%s", newlv_path, e.errno)
-                        if e.errno != errno.ENOENT:
-                            raise
-                else:
-                    xfiles.append(realpath)
-        migrate_rpm_files(new_fs.path("/"), xfiles)
-
-
+        missing, existing = var_changes(new_fs.path("/"))
+        # Don't copy the libvirt/qemu cache to new layers on upgrades.
+        # This is supposed to be checked by qemu/libvirt through a
+        # ctime comparison, but is also cleared on RPM upgrades.
+        #
+        # Instead of deleting it, we can just skip the copy
+        missing = [(p, k) for p, k in missing
+                   if k != "dir" or "cache/libvirt/qemu/capabilities" not in p]
+        workers = 1 if os.getenv("IMGBASED_DISABLE_THREADS") else 8
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            copies = [pool.submit(_copy_var_entry, new_fs.path(p), p, k)
+                      for p, k in missing]
+            created = []
+            for copy in copies:
+                created.extend(copy.result())
+        journal.record("migrate-var", "created", created,
+                       "new in the image")
+        migrate_rpm_files(new_fs.path("/"), existing)
+
+
+@step("remediate-etc")
+@phase("remediate-etc")
 def remediate_etc(imgbase, new_lv):
-    # Find a list of files which have been erroneously copied and
-    # look through old layers to find them
-    critical_files = [r'.*?/initiatorname.iscsi$',
-                      r'.*?group-?$',
-                      r'.*?passwd-?$',
-                      r'.*?shadow-?$',
-                      r'.*?fstab$',
-                      r'.*?ifcfg-.*$'
-                      ]
-
-    crits = [re.compile(f) for f in critical_files]
-
-    def check_file(f):
-        return any(c.match(f) for c in crits)
-
-    def strip(s):
-        s = re.sub(r'^/tmp/mnt.*?/', '', s)
-        return re.sub(r'/+', '/', s)
-
-    def sha256sum(a, b):
-        chksum_a = hashlib.sha256(open(a, 'rb').read()).hexdigest()
-        chksum_b = hashlib.sha256(open(b, 'rb').read()).hexdigest()
-        return chksum_a == chksum_b
-
-    def diff_candidates(dc, problems, candidates=None):
-        if candidates is None:
-            candidates = set()
-        if dc.same_files:
-            for line in dc.same_files:
-                f = "{}/{}".format(dc.left, line)
-                if not os.path.islink(f):
-                    if strip(f) in problems and strip(f) not in candidates:
-                        if sha256sum(f, "{}/{}".format(dc.right, line)):
-                            candidates.add(strip(f))
-                            log.debug("Updating %s from the next "
-                                      "layer" % ("{}".format(strip(f))))
-        if dc.subdirs:
-            for d in dc.subdirs.values():
-                diff_candidates(d, problems, candidates)
-
-        return candidates
-
-    def diff_problems(dc, problems=None):
-        if problems is None:
-            problems = []
-        if dc.diff_files:
-            for line in dc.diff_files:
-                # This is annoying, but handle initiatorname.iscsi
-                # specially, since it's generated on-the-fly and will
-                # always match what's in the first factory, but we
-                # actually don't want to copy it
-                if not os.path.islink("{}/{}".format(dc.left, line)) and \
-                        not check_file(line):
-                    problems.append("{}/{}".format(strip(dc.left), line))
-        if dc.subdirs:
-            for d in dc.subdirs.values():
-                diff_problems(d, problems)
-
-        return problems
-
-    def find_candidates(m, n, problems):
-        return diff_candidates(dircmp("{}/etc".format(m),
-                                      "{}/usr/share/factory/etc".format(m)),
-                               problems)
-
-    def find_problems(m, n):
-        problems = diff_problems(dircmp("{}/etc".format(m),
-                                        "{}/usr/share/factory/etc".format(n)))
-        candidates = find_candidates(m, n, problems)
-        return candidates
-
-    def check_layers(m, n):
-        candidates = find_problems(m.path("/"), n.path("/"))
-        for c in sorted(candidates):
-            if "targeted/active/modules" not in c:
-                copy_from = n.path("/usr/share/factory") + c
-                copy_to = n.path("/") + c
-
-                log.debug("Copying %s to %s" % (copy_from, copy_to))
-                if not filecmp.cmp(copy_from, copy_to):
-                    shutil.copy2(copy_from, copy_to)
-                else:
-                    log.debug("Unable to copy {} to {}. Symlink from a "
-                              "package rename?".format(copy_from, copy_to))
-
-    def analyze_removals(dc, pre_files=None):
-        if pre_files is None:
-            pre_files = []
-        if dc.left_only:
-            for f in dc.left_only:
-                log.debug("Planning to remove %s/%s" % (strip(dc.right), f))
-                pre_files.append("{}/{}".format(strip(dc.right), f))
-        if dc.subdirs:
-            for d in dc.subdirs.values():
-                analyze_removals(d, pre_files)
-
-        return pre_files
-
-    def perform_removals(rms, n):
-        for f in rms:
-            filename = "{}/{}".format(n.path("/"), f)
-            if not os.path.exists("{}/usr/share/factory/{}".format(
-                    n.path("/"), f)):
-                delete = False
-                if os.path.isfile(filename):
-                    delete = True
-                elif os.path.islink(filename):
-                    link_path = os.readlink(filename)
-                    if not os.path.exists("{}/{}".format(n.path("/"),
-                                                         link_path)):
-                        log.debug("{} is a broken symlink to {}. Removing "
-                                  "it".format(filename, link_path))
-                    delete = True
-
-                if delete:
-                    log.debug("os.unlink({})".format(filename))
-                    os.unlink(filename)
+    # Carry the changes of the user over to the new layer, restore the
+    # files the update changed from the new factory, and keep disabled
+    # systemd units disabled
 
     # due to ctypto-policy #BZ1921646
     # we remove a link which causes directory comparison to remove files.
@@ -562,67 +567,205 @@ def remediate_etc(imgbase, new_lv):
         with mounted(imgbase._lvm_from_layer(layers[idx]).path) as m:
             with mounted(imgbase._lvm_from_layer(layers[idx+1]).path) as n:
                 _hack_for_crypto_policy([n.path("/"), m.path("/")])
-                pre_files = analyze_removals(
-                    dircmp("{}/etc".format(m.path("/")),
-                           "{}/etc".format(n.path("/"))
-                           )
-                )
-                # Resync the files we changed on the last pass
-                r = Rsync(
-                    checksum_only=True,
-                    update_only=True,
-                    exclude=[
-                        "*targeted/active/modules*",
-                        "*selinux/targeted/policy/policy.31",
-                        "*network-scripts/ifcfg-*",
-                    ],
-                    preserve_owner=False,
-                )
-                r.sync(m.path("/etc"), n.path("/etc"))
-
-                check_layers(m, n)
-                fix_systemd_services(m, n)
-                perform_removals(pre_files, n)
+                merge = etcmerge.EtcMerge(m.path("/"), n.path("/"),
+                                          manifest=Manifest.open(n.path("/")))
+                decisions = merge.plan()
+                log.debug("Merging /etc: %s" % decisions)
+                merge.apply(decisions)
+                record_decisions("remediate-etc", merge, decisions)
+
+
+def record_decisions(step, merge, decisions):
+    """Record the changes the decisions of an EtcMerge made in the journal
+    """
+    changes = {}
+    for d in decisions:
+        path = "/etc/" + d.path
+        if d.action in ["copy", "factory"]:
+            action = "modified" if d.path in merge.new else "created"
+        elif d.action == "imgnew":
+            path, action = path + ".imgnew", "created"
+        elif d.action == "remove":
+            action = "removed"
+        else:
+            continue
+        changes.setdefault((action, d.reason), []).append(path)
+    for (action, reason), paths in sorted(changes.items()):
+        journal.record(step, action, paths, reason)
 
 
-def migrate_etc(imgbase, new_lv, previous_lv):
-    # Build a list of files in /etc which have been modified,
-    # or which don't exist in the new filesystem, and only copy those
-    changed = []
+def etc_changes(root):
+    """Returns the files in /etc of root which were modified or added,
+    compared to the factory /etc
+    """
+    return ["/etc/" + path for path in
+            etcmerge.changes(etcmerge.scan(root + "/etc"),
+                             etcmerge.scan(root + "/usr/share/factory/etc"))]
 
-    def strip(s):
-        return re.sub(r'^/tmp/mnt.*?/', '', s)
 
-    def changed_and_new(dc):
-        if dc.left_only:
-            changed.extend(["{}/{}".format(strip(dc.left), f)
-                            for f in dc.left_only])
-        if dc.diff_files:
-            changed.extend(["{}/{}".format(strip(dc.left), f)
-                            for f in dc.diff_files])
-        if dc.subdirs:
-            for d in dc.subdirs.values():
-                changed_and_new(d)
+def _etc_fingerprint(root):
+    return fingerprint(root, "/etc", "/usr/share/factory/etc")
 
-    def configure_versionlock():
-        log.info("Configuring versionlock for %s" % new_fs.source)
-        fmt = "{0.name}-{0.version}-{0.release}.{0.arch}\n"
-        data = "# imgbased: versionlock begin for layer %s\n" % new_fs.source
-        rpm.addMacro("_dbpath", new_fs.path("/usr/share/rpm"))
+
+def prepared_etc_changes(layer_name, root):
+    return PrepareCache().cached("etc-changes", layer_name,
+                                 _etc_fingerprint(root),
+                                 lambda: etc_changes(root))
+
+
+def versionlock_entries(root):
+    """Returns name-version-release.arch of all packages in the rpmdb of
+    root, except image-update
+    """
+    fmt = "{0.name}-{0.version}-{0.release}.{0.arch}"
+    entries = []
+    rpm.addMacro("_dbpath", root + "/usr/share/rpm")
+    try:
         for hdr in rpm.TransactionSet().dbMatch():
             if isinstance(hdr.name, str):
                 if "image-update" in hdr.name:
                     continue
             elif "image-update" in hdr.name.decode("utf-8"):
                 continue
-            data += fmt.format(hdr)
+            entries.append(fmt.format(hdr))
+    finally:
         rpm.delMacro("_dbpath")
+    return entries
+
+
+def _rpmdb_fingerprint(root):
+    return fingerprint(root, "/usr/share/rpm")
+
+
+def prepared_versionlock_entries(root):
+    return PrepareCache().cached("versionlock",
+                                 BuildMetadata(root).get("nvr"),
+                                 _rpmdb_fingerprint(root),
+                                 lambda: versionlock_entries(root))
+
+
+def on_update_prepare(imgbase, image_root):
+    """Compute the /etc change set of the running layer, and the
+    versionlock entries of the new image ahead of an update
+    """
+    cache = PrepareCache()
+    layer = imgbase.current_layer()
+    with step("prepare-etc-changes"):
+        cache.store("etc-changes", layer.lv_name, _etc_fingerprint("/"),
+                    etc_changes("/"))
+    with step("prepare-versionlock"):
+        cache.store("versionlock", BuildMetadata(image_root).get("nvr"),
+                    _rpmdb_fingerprint(image_root),
+                    versionlock_entries(image_root))
+
+
+def var_additions(image_root, root="/"):
+    """Returns the entries of /var in image_root which don't exist in the
+    /var of root, and their size.  These are copied by migrate_var
+
+    >>> import tempfile
+    >>> image_root, root = tempfile.mkdtemp(), tempfile.mkdtemp()
+    >>> os.makedirs(image_root + "/var/lib/new")
+    >>> os.makedirs(root + "/var/lib")
+    >>> with open(image_root + "/var/lib/new/state", "w") as f:
+    ...     _ = f.write("Hello")
+    >>> var_additions(image_root, root)
+    (['/var/lib/new', '/var/lib/new/state'], 5)
+    """
+    added = []
+    size = 0
+    for path, kind, nbytes in image_paths(image_root, "/var"):
+        if not os.path.lexists(root.rstrip("/") + path):
+            added.append(path)
+            size += nbytes if kind != "dir" else 0
+    return added, size
+
+
+def _as_lists(drift):
+    return [[list(pair) for pair in idmap] for idmap in drift]
+
+
+def fix_drift(imgbase, idmaps, new_root):
+    """Change the drifted uids and gids in the new layer back
+
+    The paths with drifted ids are taken from the manifest of the image.
+    Without one the whole layer is walked, or only the files the packages
+    of the image assign to a drifted user or group (drift_scope=packages).
+    Nothing is left to fix if the copy of the base applied the same drift
+    already.
+    """
+    checkpoint = Checkpoint.active()
+    if checkpoint and checkpoint.get("owners") and \
+            _as_lists(checkpoint.get("owners")) == \
+            _as_lists(idmaps.get_drift()):
+        log.info("The base was written with the settled owners")
+        return []
+    manifest = Manifest.open(new_root)
+    if manifest is not None:
+        return idmaps.fix_drift(new_root, manifest)
+    scope = imgbase.config.section("update").drift_scope
+    if scope == "packages":
+        users, groups = idmaps.drifted_names()
+        log.debug("Fixing the files of packages owned by %s and %s" %
+                  (users, groups))
+        return idmaps.fix_drift(new_root,
+                                paths=rpm_owned_by(new_root, users, groups))
+    return idmaps.fix_drift(new_root)
+
+
+def on_update_plan(imgbase, image_root, plan):
+    """Add what the configuration migration would do to an update plan
+    """
+    layer = imgbase.current_layer()
+    plan.add("remediate-etc", "Restore the files of /etc which were lost "
+             "by previous updates")
+
+    added, size = var_additions(image_root)
+    plan.add("migrate-var", "Copy %d new entries (%s) to /var" %
+             (len(added), format_bytes(size)), bytes=size, files=len(added))
+
+    changed = prepared_etc_changes(layer.lv_name, "/")
+    plan.add("migrate-etc", "Copy %d modified or added files of /etc" %
+             len(changed))
+    uidmap, gidmap = IDMap("/etc", image_root + "/usr/share/factory/etc") \
+        .get_drift()
+    if uidmap or gidmap:
+        plan.add("migrate-etc", "Fix the owners of files with %d drifted "
+                 "uids and %d drifted gids" % (len(uidmap), len(gidmap)))
+    packages = prepared_versionlock_entries(image_root)
+    plan.add("migrate-etc", "Lock the versions of %d packages" %
+             len(packages))
+    plan.add("rpm-perms", "Verify the permissions of %d packages" %
+             len(packages))
+
+    plan.add("relabel", "Relabel the SELinux contexts of the new layer")
+    for kernel in sorted(glob.glob(image_root + "/boot/vmlinuz-*")):
+        kver = os.path.basename(kernel)[len("vmlinuz-"):]
+        plan.add("boot-setup", "Install kernel %s" % kver)
+        plan.add("dracut", "Build the initrd of kernel %s" % kver)
+
+
+@step("migrate-etc")
+@phase("migrate-etc")
+def migrate_etc(imgbase, new_lv, previous_lv):
+    # Build a list of files in /etc which have been modified,
+    # or which don't exist in the new filesystem, and only copy those
+    changed = []
+
+    def configure_versionlock():
+        log.info("Configuring versionlock for %s" % new_fs.source)
+        data = "# imgbased: versionlock begin for layer %s\n" % new_fs.source
+        data += "".join(entry + "\n" for entry in
+                        prepared_versionlock_entries(new_fs.path("/")))
         data += "# imgbased: versionlock end\n"
         # versionlock.list must exist, so find which one should we use
         for d in ("/etc/yum/pluginconf.d", "/etc/dnf/plugins/"):
             f = File(os.path.join(new_fs.path(d), "versionlock.list"))
             if f.exists():
                 f.write(data)
+                journal.record("migrate-etc", "modified",
+                               [d.rstrip("/") + "/versionlock.list"],
+                               "packages of the layer")
         # Make sure we follow obsoletes for `yum versionlock`
         conf = File(new_fs.path("/etc/yum/pluginconf.d/versionlock.conf"))
         if conf.exists():
@@ -630,6 +773,9 @@ def migrate_etc(imgbase, new_lv, previous_lv):
             pattern = re.compile("^follow_obsoletes\\s*=\\s*1")
             if not [x for x in data if pattern.search(x)]:
                 conf.writen("follow_obsoletes = 1", mode="a")
+                journal.record("migrate-etc", "modified",
+                               ["/etc/yum/pluginconf.d/versionlock.conf"],
+                               "follow obsoletes")
 
     log.debug("Migrating etc (%s -> %s)" % (previous_lv, new_lv))
     with mounted(new_lv.path) as new_fs, \
@@ -660,17 +806,22 @@ def migrate_etc(imgbase, new_lv, previous_lv):
 
             # The IDMap check must be run before etc was copied!
             # The check relies on the fact that the old etc and new etc differ
-            idmaps = IDMap(old_etc, new_fs.path("/usr/share/factory/etc"))
+            idmaps = IDMap(old_etc, new_fs.path("/usr/share/factory/etc"),
+                           IDRegistry())
             if idmaps.has_drift():
                 log.info("UID/GID drift was detected")
                 log.debug("Drifted uids: %s gids: %s" %
                           idmaps.get_drift())
-                changes = idmaps.fix_drift(new_fs.path("/"))
+                changes = fix_drift(imgbase, idmaps, new_fs.path("/"))
                 group_content, passwd_content = idmaps.group_content, \
                     idmaps.passwd_content
                 if changes:
                     log.info("UID/GID adjustments were applied")
-                    log.debug("Changed files: %s" % list(changes))
+                    log.debug("Changed files: %s" % changes)
+                    prefix = new_fs.path("/").rstrip("/")
+                    journal.record("migrate-etc", "chowned",
+                                   [c[len(prefix):] for c in changes],
+                                   "uid/gid drift")
                 else:
                     log.debug("No changes necessary")
             else:
@@ -678,9 +829,8 @@ def migrate_etc(imgbase, new_lv, previous_lv):
 
             log.info("Migrating /etc (from %r)" % previous_lv)
 
-            changed_and_new(dircmp(old_etc,
-                            old_fs.path("/") + "/usr/share/factory/etc/")
-                            )
+            changed.extend(prepared_etc_changes(previous_lv.lv_name,
+                                                old_fs.path("/")))
 
             required_files = ["/etc/passwd", "/etc/group", "/etc/fstab",
                               "/etc/shadow", "/etc/iscsi/initiatorname.iscsi",
@@ -712,12 +862,25 @@ def migrate_etc(imgbase, new_lv, previous_lv):
                         dst_path = new_fs.path("/") + d
                         src_path = old_fs.path("/") + c
                         # if folder, do not copy folder into folder
+                        action = "modified" if os.path.lexists(dst_path) \
+                            else "created"
                         dst_path = os.path.dirname(dst_path) \
                             if os.path.isdir(src_path) else dst_path
                         copy_files(dst_path, [src_path], "-a", "-r")
+                        journal.record("migrate-etc", action, [d],
+                                       "changed in the previous layer")
 
             File(new_fs.path("/etc/group")).write(group_content)
             File(new_fs.path("/etc/passwd")).write(passwd_content)
+            journal.record("migrate-etc", "modified",
+                           ["/etc/group", "/etc/passwd"],
+                           "merged with the accounts of the image")
+            # Only now the accounts settled on their ids
+            try:
+                IDRegistry().record(idmaps.to_etc, passwd_content,
+                                    group_content)
+            except (IOError, OSError) as e:
+                log.warning("Failed to record the settled ids: %s" % e)
 
         else:
             log.info("Just copying important files")
@@ -726,75 +889,49 @@ def migrate_etc(imgbase, new_lv, previous_lv):
                         old_etc + "/passwd",
                         old_etc + "/shadow",
                         old_etc + "/group"])
+            journal.record("migrate-etc", "modified",
+                           ["/etc/fstab", "/etc/passwd", "/etc/shadow",
+                            "/etc/group"], "copied from another product")
 
         configure_versionlock()
 
         log.info("Migrating /root")
 
-        threads = []
-        threads.append(ThreadRunner(migrate_ntp_to_chrony, new_lv))
-        threads.append(ThreadRunner(run_rpm_perms, new_lv))
-        threads.append(ThreadRunner(fix_systemd_services, old_fs, new_fs))
-        threads.append(ThreadRunner(run_rpm_selinux_post, new_lv))
-
-        thread_group_handler(threads)
+        layer = Scheduler()
+        layer.add("ntp-to-chrony", migrate_ntp_to_chrony, new_lv,
+                  writes=["new /etc/chrony.conf"])
+        layer.add("rpm-perms", run_rpm_perms, new_lv,
+                  writes=["new owners"])
+        layer.add("systemd-services", fix_systemd_services, old_fs, new_fs,
+                  writes=["new /etc/systemd"])
+        layer.add("rpm-selinux-post", run_rpm_selinux_post, new_lv,
+                  writes=["new /etc/selinux"])
+        layer.run()
 
-        Motd(new_etc + "/motd").clear_motd()
+        motd = Motd(new_etc + "/motd")
+        if motd.exists():
+            motd.clear_motd()
+            journal.record("migrate-etc", "modified", ["/etc/motd"],
+                           "status of the previous layer")
 
 
 def fix_systemd_services(old_fs, new_fs):
-    # Enabled systemd services are preserved with rsync, but services
-    # which were disabled will be spuriously re-enabled after an
+    # Enabled systemd services are preserved when /etc is migrated, but
+    # services which were disabled will be spuriously re-enabled after an
     # upgrade unless we do this. Check vs the factory in /usr/share/factory
-    # so we can tell what changed
-    diffs = []
-
-    def strip(path):
-        return strip_factory(re.sub(r'/tmp/.*?/', '/', path))
-
-    def strip_factory(path):
-        return re.sub(r'/usr/share/factory', '', path)
-
-    def diff(dc):
-        if dc.right_only:
-            diffs.extend(["{}/{}".format(strip(dc.right), f)
-                          for f in dc.right_only])
-        if dc.subdirs:
-            for d in dc.subdirs.values():
-                diff(d)
-
+    # so we can tell what changed. EL updates can move some of these
+    # around, firewalld goes from basic.target.wants to
+    # multiuser.target.wants in 7.4, so the entire tree is checked
     log.info("Syncing systemd levels")
-
-    diff(dircmp(old_fs.target + "/etc/systemd",
-                old_fs.target + "/usr/share/factory/etc/systemd")
-         )
-
-    for d in diffs:
-        log.debug("Removing %s" % d)
-        filename = os.path.basename(d)
-        try:
-            if os.path.exists(new_fs.path("/") + d):
-                if os.path.isdir(new_fs.path("/") + d):
-                    remove_file(new_fs.path("/") + d, dir=True)
-                elif os.path.isfile(new_fs.path("/") + d):
-                    remove_file(new_fs.path("/") + d)
-
-            # EL updates can move some of these around. Firewalld goes from
-            # basic.target.wants to multiuser.target.wants in 7.4. Check the
-            # entire tree
-            for root, dirs, files in os.walk(new_fs.path("/etc/systemd")):
-                for d in dirs:
-                    if d == filename:
-                        log.debug("Found a disabled systemd service "
-                                  "elsewhere. Removing it: %s" % filename)
-                        remove_file(os.path.join(root, d), dir=True)
-                for f in files:
-                    if f == filename:
-                        log.debug("Found a disabled systemd service "
-                                  "elsewhere. Removing it: %s" % filename)
-                        remove_file(os.path.join(root, f))
-        except Exception:
-            log.exception("Could not remove %s. Is it a read-only layer?")
+    merge = etcmerge.EtcMerge(old_fs.path("/"), new_fs.path("/"),
+                              subtree="systemd")
+    try:
+        decisions = [d for d in merge.plan() if d.action == "remove"]
+        merge.apply(decisions)
+        record_decisions("migrate-etc", merge, decisions)
+    except Exception:
+        log.exception("Could not remove disabled services. Is it a "
+                      "read-only layer?")
 
 
 def run_rpm_selinux_post(new_lv):
@@ -823,7 +960,9 @@ def run_rpm_selinux_post(new_lv):
         filter_selinux_commands(posttrans, 0)
 
         with utils.bindmounted("/proc",
-                               new_fs.target + "/proc"):
+                               new_fs.target + "/proc"), \
+                journaled("rpm-selinux-post", new_fs.path("/"),
+                          ["/etc/selinux"]):
             with utils.bindmounted("/dev",
                                    new_fs.target + "/dev"):
                 with utils.mounted("sys",
@@ -846,6 +985,7 @@ def run_rpm_selinux_post(new_lv):
         subprocess.call(["mount", "-a"])
 
 
+@phase("relocate-update-manager")
 def relocate_update_manager(new_lv):
     paths = ["/var/lib/yum", "/var/lib/dnf"]
     # Check whether /var is a symlink to /usr/share, and move it if it is not
@@ -861,6 +1001,8 @@ def relocate_update_manager(new_lv):
             os.mkdir(path)
             shutil.move(path, usr_share)
             os.symlink(usr_share, path)
+            journal.record("relocate-update-manager", "modified", [path],
+                           "replaced by a link to %s" % usr_share)
 
 
 def migrate_ntp_to_chrony(new_lv):
@@ -874,8 +1016,11 @@ def migrate_ntp_to_chrony(new_lv):
             log.debug("Migrating NTP configuration to chrony")
             c = timeserver.Chrony(new_fs.path("/") + "/etc/chrony.conf")
             c.from_ntp(timeserver.Ntp(new_fs.path("/") + "/etc/ntp.conf"))
+            journal.record("ntp-to-chrony", "modified", ["/etc/chrony.conf"],
+                           "migrated from ntp.conf")
 
 
+@step("rpm-perms")
 def run_rpm_perms(new_lv):
     with mounted(new_lv.path) as new_fs:
         with utils.bindmounted("/var", new_fs.path("/var"), rbind=True):
@@ -887,40 +1032,62 @@ def run_rpm_perms(new_lv):
 
 
 def hack_rpm_permissions(new_fs):
-    # FIXME changing the uid/gid is dropping the setuid.
-    # The following "solution" will use rpm to restore the
-    # correct permissions:
-    # rpm --setperms $(rpm --verify -qa | grep "^\.M\."
-    #                  | cut -d "/" -f2- | while read p ;
-    #                  do rpm -qf /$p ; done )
-    incorrect_groups = {"paths": [],
-                        "verb": "--setugids"
-                        }
-    incorrect_paths = {"paths": [],
-                       "verb": "--setperms"
-                       }
+    """Restore the modes and owners the packages assign to their files
+
+    Changing the uid/gid is dropping the setuid, so the files the journal
+    lists as chowned (i.e. by the drift fix) and all setuid/setgid files
+    are compared to the rpm headers, instead of running rpm --verify -qa
+    and resetting whole packages with rpm --setperms/--setugids.
+    """
     new_root = new_fs.path("/")
-    for line in nsenter(["rpm", "--verify", "-qa", "--nodeps", "--nodigest",
-                         "--nofiledigest", "--noscripts", "--nosignature"],
-                        new_root=new_root).splitlines():
-        _mode, _path = (line[0:13], line[13:])
-        if _mode[1] == "M":
-            incorrect_paths["paths"].append(_path)
-        if _mode[6] == "G":
-            incorrect_groups["paths"].append(_path)
-    log.debug("Incorrect groups according to rpm: %s" %
-              str(incorrect_groups["paths"]))
-    log.debug("Incorrect paths according to rpm: %s" %
-              str(incorrect_paths["paths"]))
-
-    for pgroup in [incorrect_groups, incorrect_paths]:
-        pkgs_req_update = nsenter(["rpm", "-qf", "--queryformat",
-                                   "%{NAME}\n"] + pgroup["paths"],
-                                  new_root=new_root).splitlines()
-        pkgs_req_update = list(set(pkgs_req_update))
-        if pkgs_req_update:
-            nsenter(["rpm", pgroup["verb"]] + pkgs_req_update,
-                    new_root=new_root)
+    fixed = restore_rpm_permissions(new_root, journal.paths("chowned"))
+    if fixed:
+        log.info("Restored the permissions of %d files" % len(fixed))
+        log.debug("Files with restored permissions: %s" % fixed)
+
+
+def restore_rpm_permissions(new_root, changed=()):
+    """Give the changed paths and the setuid/setgid files in new_root the
+    mode, user and group of their package, returns the fixed paths
+
+    changed are absolute paths inside of new_root.
+    """
+    prefix = new_root.rstrip("/")
+    attrs = rpm_file_attrs(new_root)
+    candidates = set(changed)
+    candidates.update(p for p, (mode, _, _) in attrs.items()
+                      if mode & (stat.S_ISUID | stat.S_ISGID))
+
+    uids = IDMap(None, None)._parse_ids(File(prefix + "/etc/passwd").contents)
+    gids = IDMap(None, None)._parse_ids(File(prefix + "/etc/group").contents)
+
+    fixed = []
+    for path in sorted(candidates):
+        if path not in attrs:
+            continue
+        mode, user, group = attrs[path]
+        fn = prefix + path
+        try:
+            st = os.lstat(fn)
+        except OSError:
+            continue
+        if stat.S_ISLNK(st.st_mode) or \
+                stat.S_IFMT(st.st_mode) != stat.S_IFMT(mode):
+            continue
+        uid, gid = uids.get(user, st.st_uid), gids.get(group, st.st_gid)
+        changes = False
+        # chown drops the setuid and setgid bits, so it goes first
+        if (st.st_uid, st.st_gid) != (uid, gid):
+            os.chown(fn, uid, gid)
+            changes = True
+        if changes or stat.S_IMODE(st.st_mode) != stat.S_IMODE(mode):
+            os.chmod(fn, stat.S_IMODE(mode))
+            changes = True
+        if changes:
+            fixed.append(fn)
+    journal.record("rpm-perms", "chowned", [f[len(prefix):] for f in fixed],
+                   "restored the permissions of the package")
+    return fixed
 
 
 def change_dir_perms(path, mode):
@@ -933,7 +1100,7 @@ def change_dir_perms(path, mode):
                 os.chmod(os.path.join(root, f), mode)
 
 
-def adjust_mounts_and_boot(imgbase, new_lv, previous_lv):
+def adjust_mounts_and_boot(imgbase, new_lv, previous_lv, since=None):
     """Add a new boot entry and update the layers /etc/fstab"""
 
     def _update_grub_cmdline(newroot):
@@ -958,6 +1125,8 @@ def adjust_mounts_and_boot(imgbase, new_lv, previous_lv):
             old_cmdline = old_grub.get("GRUB_CMDLINE_LINUX", "").strip('"')
             log.debug("Previous GRUB_CMDLINE_LINUX: %s", old_cmdline)
             defgrub = ShellVarFile(newroot + "/etc/default/grub")
+            journal.record("migrate-boot", "modified", ["/etc/default/grub"],
+                           "kernel arguments of the previous layer")
             defgrub.set("GRUB_CMDLINE_LINUX", old_cmdline)
             defgrub.set("GRUB_DISABLE_OS_PROBER", "true", force=True)
             if oldrootlv.lvm_name in old_cmdline:
@@ -979,6 +1148,8 @@ def adjust_mounts_and_boot(imgbase, new_lv, previous_lv):
         rootentry = newfstab.by_target("/")
         rootentry.source = new_lv.path
         newfstab.update(rootentry)
+        journal.record("migrate-boot", "modified", ["/etc/fstab"],
+                       "root of the new layer")
 
         # Ensure that discard is used
         # This can also be done in anaconda once it is fixed
@@ -1007,33 +1178,8 @@ def adjust_mounts_and_boot(imgbase, new_lv, previous_lv):
 
                 with open(fname, 'w') as mountfile:
                     c.write(mountfile)
-
-    def _relabel_selinux(newroot):
-        files = ["/etc/selinux/targeted/contexts/files/file_contexts",
-                 "/etc/selinux/targeted/contexts/files/file_contexts.homedirs",
-                 "/etc/selinux/targeted/contexts/files/file_contexts.local"]
-
-        dirs = ["/etc",
-                "/usr/bin",
-                "/usr/libexec",
-                "/usr/sbin",
-                "/usr/share",
-                "/var"]
-
-        exclude_dirs = ["/usr/share/factory", "/var/cache/app-info"]
-
-        # Reduce the list to something subprocess can use directly
-
-        log.debug("Relabeling selinux")
-
-        with SELinuxDomain("setfiles_t") as dom:
-            for fc in files:
-                if os.path.exists(newroot + "/" + fc):
-                    excludes = sum([["-e", d] for d in exclude_dirs], [])
-                    dom.runcon(["chroot", newroot, "setfiles", "-v", fc] +
-                               excludes + dirs)
-                else:
-                    log.debug("{} not found in new fs, skipping".format(fc))
+                journal.record("migrate-boot", "modified",
+                               [fname[len(newroot):]], "discard")
 
     log.info("Adjusting mount and boot related points")
     imgbase.hooks.emit("os-upgraded", previous_lv.lv_name, new_lv.lvm_name)
@@ -1044,15 +1190,156 @@ def adjust_mounts_and_boot(imgbase, new_lv, previous_lv):
                                    rbind=True):
                 _update_grub_cmdline(newroot.target)
                 _update_fstab(newroot.target)
-                _relabel_selinux(newroot.target)
-                BootSetupHandler(
-                    root=newroot.target,
-                    mkconfig=(imgbase.mode == constants.IMGBASED_MODE_INIT),
-                    mkinitrd=(imgbase.mode == constants.IMGBASED_MODE_UPDATE)
-                ).setup()
+                with step("relabel"):
+                    relabel_selinux(newroot.target, since)
+                with step("boot-setup"):
+                    mode = imgbase.mode
+                    BootSetupHandler(
+                        root=newroot.target,
+                        mkconfig=(mode == constants.IMGBASED_MODE_INIT),
+                        mkinitrd=(mode == constants.IMGBASED_MODE_UPDATE)
+                    ).setup()
                 bootloader.BootConfiguration.validate()
 
 
+def migration_start():
+    """Returns the time the migration to the new layer started, a resumed
+    update keeps the time of its first attempt
+    """
+    checkpoint = Checkpoint.active()
+    started = checkpoint.get("migration_start") if checkpoint else None
+    if started is None:
+        # Rounded down, the ctimes of files have a finer resolution
+        started = int(time.time())
+        if checkpoint:
+            checkpoint.record(migration_start=started)
+    return started
+
+
+RELABEL_DIRS = ["/etc", "/usr/bin", "/usr/libexec", "/usr/sbin",
+                "/usr/share", "/var"]
+
+RELABEL_EXCLUDE = ["/usr/share/factory", "/var/cache/app-info"]
+
+
+def relabel_candidates(root, since, dirs=RELABEL_DIRS,
+                       exclude=RELABEL_EXCLUDE):
+    """Returns the paths below dirs of root which were created or changed
+    (content, owner, mode or label) since the given time
+
+    >>> import tempfile
+    >>> root = tempfile.mkdtemp()
+    >>> for d in ["/etc/ssh", "/usr/share/factory/etc"]:
+    ...     os.makedirs(root + d)
+    >>> relabel_candidates(root, 0)
+    ['/etc', '/etc/ssh', '/usr/share']
+    >>> relabel_candidates(root, time.time() + 60)
+    []
+    """
+    prefix = root.rstrip("/")
+    exclude = set(exclude)
+    found = []
+    pending = [d for d in dirs if os.path.isdir(prefix + d) and
+               not os.path.islink(prefix + d)]
+    for d in pending:
+        if os.lstat(prefix + d).st_ctime >= since:
+            found.append(d)
+    while pending:
+        directory = pending.pop()
+        try:
+            entries = list(os.scandir(prefix + directory))
+        except OSError as e:
+            log.debug("Not relabeling %s: %s" % (directory, e))
+            continue
+        for entry in entries:
+            path = directory + "/" + entry.name
+            if path in exclude:
+                continue
+            st = entry.stat(follow_symlinks=False)
+            if st.st_ctime >= since:
+                found.append(path)
+            if entry.is_dir(follow_symlinks=False):
+                pending.append(path)
+    return sorted(found)
+
+
+@contextmanager
+def journaled(step, root, dirs):
+    """Record the entries below dirs of root which are created or changed
+    meanwhile, by tools which can't tell which ones they changed
+    """
+    started = int(time.time())
+    yield
+    if journal.Journal.active():
+        journal.record(step, "modified",
+                       relabel_candidates(root, started, dirs),
+                       "changed by the tools of the step")
+
+
+def _label_threads(newroot, tool):
+    """Returns the arguments to label with all cores, if the setfiles or
+    restorecon of newroot can
+    """
+    if os.getenv("IMGBASED_DISABLE_THREADS"):
+        return []
+    try:
+        usage = chroot([tool], newroot)
+    except subprocess.CalledProcessError as e:
+        usage = e.output
+    return ["-T", "0"] if b"-T" in (usage or b"") else []
+
+
+def relabel_selinux(newroot, since=None):
+    """Relabel the files of the new layer which the journal of the update
+    has, or which changed since the given time without one, or all of the
+    relabeled dirs
+
+    Both setfiles and restorecon load the .homedirs and .local specs
+    together with the file_contexts, so they are only run once.  The
+    changed paths are labeled by restorecon, which, unlike setfiles, does
+    not descend into the directories in the list: a directory which only
+    changed because entries were added to it costs a single lookup.
+    """
+    fc = "/etc/selinux/targeted/contexts/files/file_contexts"
+    if not os.path.exists(newroot + fc):
+        log.debug("{} not found in new fs, skipping".format(fc))
+        return
+
+    kwargs = {}
+    if since is None:
+        paths = RELABEL_DIRS
+        args = ["chroot", newroot, "setfiles", "-v"] + \
+            _label_threads(newroot, "setfiles") + \
+            sum([["-e", d] for d in RELABEL_EXCLUDE], []) + [fc] + paths
+    else:
+        if journal.Journal.active():
+            changed = set(p for action in ["created", "modified", "chowned"]
+                          for p in journal.paths(action)
+                          if os.path.lexists(newroot + p))
+        else:
+            # Nothing recorded the changes, find them by their ctime
+            changed = relabel_candidates(newroot, since)
+        # restorecon reads the list line by line
+        paths = [p for p in sorted(changed) if "\n" not in p]
+        if not paths:
+            log.info("No files of the new layer need to be relabeled")
+            return
+        args = ["chroot", newroot, "restorecon", "-v"] + \
+            _label_threads(newroot, "restorecon") + ["-f", "-"]
+        kwargs["input"] = "".join(p + "\n" for p in paths).encode()
+
+    log.debug("Relabeling selinux")
+    with SELinuxDomain("setfiles_t") as dom:
+        output = dom.runcon(args, **kwargs) or ""
+    relabeled = sum(1 for line in output.splitlines()
+                    if line.startswith("Relabeled"))
+    if since is None:
+        log.info("Relabeled %d files" % relabeled)
+    else:
+        log.info("Relabeled %d of %d changed files" %
+                 (relabeled, len(paths)))
+
+
 def on_remove_layer(imgbase, lv_fullname):
     remove_boot(imgbase, lv_fullname)
 
@@ -30,6 +30,9 @@ import subprocess
 import uuid
 
 from .. import constants, utils
+from ..checkpoint import phase
+from ..prepare import PrepareCache, fingerprint
+from ..timeline import step
 
 log = logging.getLogger(__package__)
 
@@ -45,6 +48,37 @@ def pre_init(app):
 
 def init(app):
     app.imgbase.hooks.connect("os-upgraded", on_os_upgraded)
+    app.imgbase.hooks.connect("update-prepare", on_update_prepare)
+    app.imgbase.hooks.connect("update-plan", on_update_plan)
+
+
+def on_update_prepare(imgbase, image_root):
+    """Check which persisted RPMs are installed ahead of an update
+    """
+    rpms = sorted(glob.glob(constants.IMGBASED_PERSIST_PATH + "/*.rpm"))
+    PrepareCache().store("persisted-rpms", "/", _persisted_fingerprint(),
+                         dict((r, check_if_rpm_installed(r)) for r in rpms))
+
+
+def on_update_plan(imgbase, image_root, plan):
+    """Add the persisted RPMs which would be reinstalled to an update plan
+    """
+    rpms = sorted(glob.glob(constants.IMGBASED_PERSIST_PATH + "/*.rpm"))
+    installed = PrepareCache().load("persisted-rpms", "/",
+                                    _persisted_fingerprint()) or {}
+    # Persisted RPMs which are not installed anymore are removed instead
+    reinstall = [r for r in rpms
+                 if (installed[r] if r in installed
+                     else check_if_rpm_installed(r))]
+    if reinstall:
+        plan.add("reinstall-rpms", "Reinstall %d persisted packages: %s" %
+                 (len(reinstall),
+                  ", ".join(os.path.basename(r) for r in reinstall)))
+
+
+def _persisted_fingerprint():
+    return fingerprint("/", os.path.realpath("/var/lib/rpm"),
+                       constants.IMGBASED_PERSIST_PATH)
 
 
 def on_os_upgraded(imgbase, previous_lv_name, new_lv_name):
@@ -62,6 +96,8 @@ def on_os_upgraded(imgbase, previous_lv_name, new_lv_name):
         raise RpmPersistenceError()
 
 
+@step("reinstall-rpms")
+@phase("reinstall-rpms")
 def reinstall_rpms(imgbase, new_lv, previous_lv):
     if imgbase.mode == constants.IMGBASED_MODE_UPDATE:
         with utils.mounted(new_lv.path) as new_fs:
@@ -99,8 +135,15 @@ def install_rpms(new_fs):
 
     rpms = glob.glob(constants.IMGBASED_PERSIST_PATH + "/*.rpm")
     if rpms:
+        installed = PrepareCache().load("persisted-rpms", "/",
+                                        _persisted_fingerprint()) or {}
         for rpm in list(rpms):
-            if not check_if_rpm_installed(rpm):
+            if rpm in installed:
+                log.debug("Using prepared check of %s" % rpm)
+                is_installed = installed[rpm]
+            else:
+                is_installed = check_if_rpm_installed(rpm)
+            if not is_installed:
                 try:
                     log.info("Removing dangling RPM ({})".format(
                         rpm,
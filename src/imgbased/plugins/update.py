@@ -2,13 +2,29 @@
 import glob
 import logging
 import os
+import shutil
 import sys
+import tempfile
+from contextlib import contextmanager
 
 from .. import constants, local
 from ..bootloader import BootConfiguration
+from ..checkpoint import Checkpoint
+from ..copier import TreeCopier, write_image
+from ..delta import DeltaError, DeltaPayload
+from ..hashcache import HashCache
+from ..journal import Journal
 from ..lvm import LVM
 from ..naming import Image
-from ..utils import BuildMetadata, File, Filesystem, SELinux, Tar, mounted
+from ..plan import CostModel, Plan
+from ..preflight import Preflight, changed_usage, image_usage, \
+    running_usage, tree_usage
+from ..prepare import PrepareCache
+from ..progress import Progress, format_bytes, tracked
+from ..timeline import Timeline, fs_usage, step
+from ..utils import BuildMetadata, File, Filesystem, IDMap, IDRegistry, \
+    ImageChecksum, SELinux, Tar, idle_io, mounted, mounted_liveimg
+from ..verity import BLOCK_SIZE, seal
 
 log = logging.getLogger(__package__)
 
@@ -16,6 +32,27 @@ log = logging.getLogger(__package__)
 class UpdateConfigurationSection(local.Configuration.Section):
     _type = "update"
     images_to_keep = 2
+    # How the tree of a new base is copied: native or tar
+    copy_engine = "native"
+    # Number of copy workers of the native engine, 0 picks a default
+    copy_workers = 0
+    # How a new base is installed: tree copies the files of the image onto
+    # a new filesystem, image writes the filesystem image onto the volume,
+    # snapshot syncs the changed files onto a snapshot of the current base
+    base_mode = "tree"
+    # Resource controls of update --background, see
+    # systemd.resource-control(5)
+    background_io_weight = 10
+    background_cpu_weight = 10
+    # i.e. "/dev/sda 50M", limits the read and write bandwidth per device
+    background_io_max = ""
+    # Compute the hash tree and root hash of new bases (imgbase verify),
+    # this reads the whole base once more, thus it's opt-in
+    verity = 0
+    # Which paths of a new layer are checked for drifted uids and gids,
+    # if the image has no manifest: tree checks all, packages only the
+    # files owned by packages
+    drift_scope = "tree"
 
 
 class RollbackFailedError(Exception):
@@ -26,6 +63,11 @@ class GCFailedError(Exception):
     pass
 
 
+def pre_init(app):
+    app.imgbase.hooks.create("update-prepare", ("image-root",))
+    app.imgbase.hooks.create("update-plan", ("image-root", "plan"))
+
+
 def init(app):
     app.hooks.connect("pre-arg-parse", add_argparse)
     app.hooks.connect("post-arg-parse", post_argparse)
@@ -40,7 +82,38 @@ def add_argparse(app, parser, subparsers):
     u = subparsers.add_parser("update",
                               help="Update handling")
 
-    u.add_argument("--format", default="liveimg")
+    u.add_argument("--format", default="liveimg",
+                   choices=["liveimg", "delta"],
+                   help="liveimg for a squashfs image, delta for a delta "
+                   "payload against an installed base")
+    u.add_argument("--copy-engine", choices=["native", "tar"],
+                   help="How to copy the image to the new base, defaults "
+                   "to the copy_engine configuration key")
+    u.add_argument("--base-mode", choices=["tree", "image", "snapshot"],
+                   help="How to install the new base, defaults to the "
+                   "base_mode configuration key")
+    u.add_argument("--checksum", metavar="[ALGORITHM:]DIGEST",
+                   help="Verify the image against this digest while it is "
+                   "extracted, defaults to the digest in FILENAME.sha256 "
+                   "if it exists")
+    u.add_argument("--background", action="store_true",
+                   help="Run with low I/O and CPU weights, to not starve "
+                   "the running workloads")
+    u.add_argument("--prepare", action="store_true",
+                   help="Only compute what the update of FILENAME needs "
+                   "from the running layer, to speed up the update later")
+    u.add_argument("--plan", action="store_true",
+                   help="Only show what the update of FILENAME would do "
+                   "and how long it would take, without changing anything")
+    u.add_argument("--explain", action="store_true",
+                   help="Show the files the last update to FILENAME "
+                   "changed, and why")
+    u.add_argument("--resume", action="store_true",
+                   help="Resume a failed update of FILENAME, reusing the "
+                   "base and layer it created")
+    u.add_argument("--gc-first", action="store_true",
+                   help="Remove old bases before the update, to make room "
+                   "for the new one")
     u.add_argument("FILENAME")
 
     r = subparsers.add_parser("rollback",
@@ -59,28 +132,276 @@ def post_argparse(app, args):
 
     elif args.command == "update":
         app.imgbase.set_mode(constants.IMGBASED_MODE_UPDATE)
-        if args.format == "liveimg":
+        if args.background:
+            run_in_background(app.imgbase.config.section("update"))
+        extractors = {"liveimg": LiveimgExtractor,
+                      "delta": DeltaExtractor}
+        if args.plan and args.format == "liveimg":
+            plan(app, args.FILENAME, args.base_mode)
+        elif args.plan:
+            log.error("Only liveimg updates can be planned")
+        elif args.explain:
+            explain(args.FILENAME)
+        elif args.prepare:
+            prepare(app, args.FILENAME)
+        elif args.format in extractors:
+            checkpoint = start_checkpoint(app.imgbase, args.FILENAME,
+                                          args.resume, args.checksum)
+            timeline = Timeline.start(constants.IMGBASED_LOG_DIR,
+                                      os.path.basename(args.FILENAME))
+            progress = Progress.start(constants.IMGBASED_UPDATE_STATUS,
+                                      os.path.basename(args.FILENAME))
+            HashCache.start()
+            Journal.start(os.path.basename(args.FILENAME),
+                          resume=args.resume)
+            result = "failed"
             try:
-                base, _ = LiveimgExtractor(app.imgbase).extract(args.FILENAME)
+                extractor = extractors[args.format](app.imgbase)
+                if args.copy_engine:
+                    extractor.copy_engine = args.copy_engine
+                if args.base_mode:
+                    extractor.base_mode = args.base_mode
+                if args.checksum:
+                    extractor.checksum = args.checksum
+                extractor.background = args.background
+                if not checkpoint.get("base"):
+                    with step("preflight"):
+                        extractor.preflight(args.FILENAME, args.gc_first)
+                base, _ = extractor.extract(args.FILENAME)
                 log.info("Update was pulled successfully")
+                result = "ok"
+                checkpoint.finish()
                 GarbageCollector(app.imgbase).run(base)
             except GCFailedError:
                 log.info("GC failed, skipping")
             except Exception:
                 exc_info = sys.exc_info()
-                log.error("Update failed, resetting registered LVs")
-                LVM.reset_registered_volumes()
+                if checkpoint.get("base"):
+                    log.error("Update failed, keeping %s to resume it with "
+                              "'imgbase update --resume %s'" %
+                              (checkpoint.get("base"), args.FILENAME))
+                    # Only the volumes a resumed update reuses are kept
+                    LVM.reset_registered_volumes(
+                        keep=[checkpoint.get("base"),
+                              checkpoint.get("layer")])
+                    checkpoint.stop()
+                else:
+                    log.error("Update failed, resetting registered LVs")
+                    LVM.reset_registered_volumes()
+                    checkpoint.finish()
                 raise exc_info[1].with_traceback(exc_info[2])
+            finally:
+                HashCache.stop()
+                Journal.stop()
+                if timeline:
+                    timeline.stop(result)
+                if progress:
+                    progress.stop(result)
         else:
             log.error("Unknown update format %r" % args.format)
 
 
+def background_command(argv, config):
+    """Returns the command to run imgbase with argv in a transient scope
+
+    >>> config = UpdateConfigurationSection()
+    >>> config.background_io_max = "/dev/sda 50M"
+    >>> cmd = background_command(["update", "--background", "a.img"], config)
+    >>> cmd[:2]
+    ['systemd-run', '--scope']
+    >>> for arg in cmd[4:13]:
+    ...     print(arg)
+    -p
+    IOWeight=10
+    -p
+    CPUWeight=10
+    -p
+    IOReadBandwidthMax=/dev/sda 50M
+    -p
+    IOWriteBandwidthMax=/dev/sda 50M
+    --quiet
+    >>> cmd[-5:]
+    ['-m', 'imgbased', 'update', '--background', 'a.img']
+    """
+    properties = ["IOWeight=%s" % config.background_io_weight,
+                  "CPUWeight=%s" % config.background_cpu_weight]
+    if config.background_io_max:
+        properties += ["IOReadBandwidthMax=%s" % config.background_io_max,
+                       "IOWriteBandwidthMax=%s" % config.background_io_max]
+    cmd = ["systemd-run", "--scope", "--unit",
+           "imgbased-update-%d" % os.getpid()]
+    for p in properties:
+        cmd += ["-p", p]
+    return cmd + ["--quiet", sys.executable, "-m", "imgbased"] + argv
+
+
+def run_in_background(config):
+    """Re-run this command in a transient scope with the resource controls
+    of the configuration, returns if it's running in the scope already
+    """
+    if os.getenv("IMGBASED_BACKGROUND"):
+        log.debug("Running in the background scope")
+        return
+    if not shutil.which("systemd-run"):
+        log.warning("systemd-run is not available, only lowering the I/O "
+                    "priority of the copies")
+        return
+    os.environ["IMGBASED_BACKGROUND"] = "1"
+    cmd = background_command(sys.argv[1:], config)
+    log.info("Moving the update into a transient scope")
+    log.debug("Running %s" % cmd)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.execvp(cmd[0], cmd)
+
+
+@contextmanager
+def _bulk_io(background):
+    """Bulk copies of background updates get idle I/O priority
+    """
+    if background:
+        with idle_io():
+            yield
+    else:
+        yield
+
+
+def _image_key(imagefile):
+    st = os.stat(imagefile)
+    return os.path.abspath(imagefile), "%d %d" % (st.st_size,
+                                                  st.st_mtime_ns)
+
+
+def _update_inputs(imgbase, imagefile, checksum=None):
+    """What the phases of an update depend on besides their arguments: the
+    content of the image, the running layer and the configuration
+    """
+    if checksum:
+        verifier = ImageChecksum(imagefile, checksum)
+    else:
+        verifier = ImageChecksum.from_sidecar(imagefile)
+    return {"checksum": verifier.expected if verifier else None,
+            "layer": str(imgbase.current_layer()),
+            "config": [repr(s) for s in imgbase.config.sections()]}
+
+
+def start_checkpoint(imgbase, imagefile, resume=False, checksum=None):
+    """Checkpoint the update of imagefile, or resume a failed update of it
+
+    The volumes of a failed update which is not resumed are discarded
+    """
+    path = constants.IMGBASED_CHECKPOINT
+    if not resume:
+        stale = Checkpoint.load(path)
+        if stale and stale.get("base"):
+            log.info("Discarding %s of a failed update" % stale.get("base"))
+            try:
+                base = Image.from_lv_name(stale.get("base"))
+                imgbase.remove_base(base.nvr, force=True)
+            except Exception:
+                log.warning("Failed to discard %s" % stale.get("base"),
+                            exc_info=True)
+    return Checkpoint.start(path, " ".join(_image_key(imagefile)), resume,
+                            _update_inputs(imgbase, imagefile, checksum))
+
+
+def prepare(app, liveimgfile):
+    """Compute everything which only depends on the running layer (and the
+    image) ahead of the update
+    """
+    cache = PrepareCache()
+    cache.clear()
+    with mounted_liveimg(liveimgfile) as rootfs:
+        log.info("Preparing the update to %s" %
+                 BuildMetadata(rootfs.target).get("nvr"))
+        with step("prepare-usage"):
+            cache.store("usage", *_image_key(liveimgfile),
+                        value=tree_usage(rootfs.target))
+        app.imgbase.hooks.emit("update-prepare", rootfs.target)
+    log.info("The update was prepared")
+
+
+def explain(liveimgfile):
+    """Print the changes the last update to liveimgfile recorded
+    """
+    journal = Journal.load()
+    if journal is None or \
+            journal.target != os.path.basename(liveimgfile):
+        log.error("No update to %s was recorded" % liveimgfile)
+        return
+    print(journal.explain() or "The update did not change any files")
+    journal.close()
+
+
+def plan(app, liveimgfile, base_mode=None):
+    """Print the actions of an update and their expected duration, the
+    image is only mounted read-only
+    """
+    imgbase = app.imgbase
+    extractor = LiveimgExtractor(imgbase)
+    base_mode = base_mode or extractor.base_mode
+    with mounted_liveimg(liveimgfile) as rootfs:
+        nvr = BuildMetadata(rootfs.target).get("nvr")
+        new_base = Image.from_nvr(nvr)
+        new_layer = new_base.derive_layer(1)
+        update_plan = Plan("%s (%s)" % (nvr, os.path.basename(liveimgfile)))
+
+        if base_mode == "snapshot":
+            used, boot = extractor._snapshot_usage(rootfs.target)
+        else:
+            used, boot = tree_usage(rootfs.target)
+        for requirement in Preflight(imgbase).requirements(used, boot):
+            update_plan.add("preflight", str(requirement))
+
+        # lvs reports the size with a unit suffix, i.e. "10737418240B"
+        size = int(str(extractor._recommend_size_for_tree()).strip()
+                   .rstrip("B"))
+        volumes = "base %s (%s) and layer %s" % \
+            (new_base.lv_name, format_bytes(size), new_layer.lv_name)
+        nbytes, nfiles = fs_usage(rootfs.target)
+        if base_mode == "image":
+            update_plan.add("write-image", "Write the image to new %s" %
+                            volumes, bytes=os.stat(rootfs.source).st_size)
+        else:
+            if base_mode == "snapshot":
+                update_plan.add("randomize-uuid", "Snapshot %s as new %s" %
+                                (imgbase.current_layer().base, volumes))
+            else:
+                update_plan.add("mkfs", "Create new %s" % volumes)
+            update_plan.add("copy-tree", "Copy %s in %d files to the new "
+                            "base" % (format_bytes(nbytes), nfiles),
+                            bytes=nbytes, files=nfiles)
+
+        if extractor.verity:
+            update_plan.add("verity", "Compute the hash tree of the new "
+                            "base", bytes=size)
+
+        imgbase.hooks.emit("update-plan", rootfs.target, update_plan)
+
+    gc = GarbageCollector(imgbase)
+    for base in gc.candidates_after_update(new_base):
+        update_plan.add("gc", "Remove base %s and its layers" % base)
+
+    print(update_plan.format(
+        CostModel.from_log_dir(constants.IMGBASED_LOG_DIR)))
+
+
 class LiveimgExtractor():
     imgbase = None
     can_pipe = False
+    copy_engine = None
+    base_mode = None
+    checksum = None
+    background = False
+    _verifier = None
 
     def __init__(self, imgbase):
         self.imgbase = imgbase
+        config = imgbase.config.section("update")
+        self.copy_engine = config.copy_engine
+        self.copy_workers = config.copy_workers
+        self.base_mode = config.base_mode
+        self.verity = config.verity
 
     def _recommend_size_for_tree(self):
         # Get the size of the current layer and use that
@@ -105,33 +426,234 @@ class LiveimgExtractor():
             os.makedirs(constants.IMGBASED_STATE_DIR)
         File(constants.IMGBASED_IMAGE_UPDATED).writen(img)
 
+    def _usage(self, liveimgfile):
+        if self.base_mode == "snapshot":
+            with mounted_liveimg(liveimgfile) as rootfs:
+                return self._snapshot_usage(rootfs.target)
+        return PrepareCache().cached("usage", *_image_key(liveimgfile),
+                                     compute=lambda: image_usage(liveimgfile))
+
+    def _snapshot_usage(self, root):
+        """A snapshot of the current base shares the unchanged files with
+        it, only the changed files of root need space
+        """
+        base = self.imgbase.current_layer().base
+        base_lv = self.imgbase._lvm_from_layer(base)
+        base_lv.activate(True, True)
+        with mounted(base_lv.path, options="ro") as basefs:
+            _, boot = tree_usage(root)
+            used = changed_usage(root, basefs.target)
+        log.debug("Snapshot of %s needs %s for the changed files" %
+                  (base, format_bytes(used)))
+        return used, boot
+
+    def preflight(self, imagefile, gc_first=False):
+        """Fail early if the update does not fit, before anything is
+        written
+        """
+        gc = GarbageCollector(self.imgbase)
+        if gc_first:
+            gc.run_before_update()
+        used, boot = self._usage(imagefile)
+        Preflight(self.imgbase).check(used, boot,
+                                      gc.candidates_before_update())
+        Preflight.announce(constants.IMGBASED_LOG_DIR)
+
+    def _start_verifier(self, imagefile, background=True):
+        """Checksum the image while it's read by the extraction
+
+        Without background, the extraction reads the image itself and
+        feeds the verifier.
+        """
+        if self.checksum:
+            self._verifier = ImageChecksum(imagefile, self.checksum)
+        else:
+            self._verifier = ImageChecksum.from_sidecar(imagefile)
+        if not self._verifier:
+            log.debug("No checksum for %s, not verifying it" % imagefile)
+        elif background:
+            self._verifier.start()
+
+    def _verify_image(self):
+        """Raises if the image did not match, before the new layer is added
+        """
+        if self._verifier:
+            with step("verify-image"):
+                self._verifier.verify()
+
+    def _stop_verifier(self):
+        if self._verifier:
+            self._verifier.cancel()
+            self._verifier = None
+
+    def _seal_base(self, new_base_lv):
+        """Compute the hash tree of the complete base
+        """
+        if self.verity:
+            with step("verity") as s:
+                s.bytes = seal(new_base_lv).data_blocks * BLOCK_SIZE
+
+    def _base_built(self, new_base_lv):
+        """The base is complete, a failed update can resume with it
+        """
+        if Checkpoint.active():
+            Checkpoint.active().record(base=new_base_lv.lv_name)
+
+    def _add_layer(self, new_base_lv):
+        """Adds the layer on the new base, or migrates to the layer which
+        was added before a resumed update failed
+        """
+        checkpoint = Checkpoint.active()
+        layer = checkpoint.get("layer") if checkpoint else None
+        with step("add-layer"):
+            if layer is None:
+                new_base = Image.from_lv_name(new_base_lv.lv_name)
+                return self.imgbase.add_layer(new_base)
+            log.info("Reusing layer %s of the failed update" % layer)
+            new_layer_lv = self.imgbase.lv(layer)
+            self.imgbase.hooks.emit("new-layer-added", new_base_lv,
+                                    new_layer_lv)
+            return new_layer_lv
+
+    def _resume(self):
+        """Returns the base and layer of the failed update which is
+        resumed, or None
+        """
+        checkpoint = Checkpoint.active()
+        if checkpoint is None or not checkpoint.get("base"):
+            return None
+        new_base_lv = self.imgbase.lv(checkpoint.get("base"))
+        log.info("Reusing base %s of the failed update" %
+                 new_base_lv.lv_name)
+        return (new_base_lv, self._add_layer(new_base_lv))
+
+    def _settled_owners(self, sourcetree):
+        """Returns the maps of the factory uids and gids of the image to
+        the ids the accounts settled on, if the registry knows them all
+
+        The applied drift is kept in the checkpoint, migrate-etc does not
+        fix it again.
+        """
+        drift = None
+        factory_etc = sourcetree + "/usr/share/factory/etc"
+        if Checkpoint.active() and os.path.exists(factory_etc + "/passwd"):
+            drift = IDRegistry().known("/etc", factory_etc)
+        if not drift or not any(drift):
+            self._applied_owners(None)
+            return None
+        log.info("Writing the settled owners of the drifted accounts")
+        self._applied_owners(drift)
+        return IDMap(None, None)._reverse_drift(drift)
+
+    def _applied_owners(self, drift):
+        if Checkpoint.active():
+            Checkpoint.active().record(owners=drift)
+
+    def _copy_tree(self, sourcetree, dst, s):
+        bytes_total, files_total = fs_usage(sourcetree)
+        if self.base_mode == "snapshot" or self.copy_engine == "native":
+            # Only the native engine can sync onto an existing tree
+            copier = TreeCopier(workers=self.copy_workers,
+                                mirror=self.base_mode == "snapshot",
+                                owners=self._settled_owners(sourcetree))
+            with tracked(bytes_total, files_total,
+                         lambda: (copier.stats.copied,
+                                  copier.stats.entries())):
+                stats = copier.sync(sourcetree, dst)
+            if copier.mirror:
+                s.bytes, s.files = stats.written, stats.entries()
+            else:
+                s.bytes, s.files = stats.bytes, stats.entries()
+        elif self.copy_engine == "tar":
+            self._applied_owners(None)
+            used = fs_usage(dst)
+
+            def copied():
+                now = fs_usage(dst)
+                return now[0] - used[0], now[1] - used[1]
+
+            with tracked(bytes_total, files_total, copied):
+                Tar().sync(sourcetree, dst)
+            s.bytes, s.files = fs_usage(dst)
+        else:
+            raise RuntimeError("Unknown copy engine: %s" % self.copy_engine)
+
     def add_base_with_tree(self, sourcetree, size, nvr, lvs=None):
         if not os.path.exists(sourcetree):
             raise RuntimeError("Sourcetree does not exist: %s" % sourcetree)
 
-        new_base = self.imgbase.add_base(size, nvr, lvs)
+        from_base = None
+        if self.base_mode == "snapshot":
+            from_base = self.imgbase.current_layer().base
+            log.info("Creating new base from %s" % from_base)
+
+        new_base = self.imgbase.add_base(size, nvr, lvs, from_base=from_base)
         new_base_lv = self.imgbase._lvm_from_layer(new_base)
 
         with new_base_lv.unprotected():
-            log.info("Creating new filesystem on base")
-            Filesystem.from_mountpoint("/").mkfs(new_base_lv.path)
+            if from_base:
+                # The snapshot has the same filesystem UUID as its origin
+                with step("randomize-uuid"):
+                    Filesystem.from_device(new_base_lv.path).randomize_uuid()
+            else:
+                log.info("Creating new filesystem on base")
+                with step("mkfs"):
+                    Filesystem.from_mountpoint("/").mkfs(new_base_lv.path)
 
             log.info("Writing tree to base")
             with mounted(new_base_lv.path) as mount:
                 dst = mount.target + "/"
-                tar = Tar()
-                tar.sync(sourcetree, dst)
+                with step("copy-tree") as s, _bulk_io(self.background):
+                    self._copy_tree(sourcetree, dst, s)
                 log.debug("Trying to copy prev fstab")
 
-        new_layer_lv = self.imgbase.add_layer(new_base)
+        self._verify_image()
+        self._seal_base(new_base_lv)
+        self._base_built(new_base_lv)
+        new_layer_lv = self._add_layer(new_base_lv)
+
+        return (new_base_lv, new_layer_lv)
+
+    def add_base_with_image(self, image, size, nvr, lvs=None):
+        new_base = self.imgbase.add_base(size, nvr, lvs)
+        new_base_lv = self.imgbase._lvm_from_layer(new_base)
+
+        self._applied_owners(None)
+        with new_base_lv.unprotected():
+            log.info("Writing image to base")
+            with step("write-image") as s, _bulk_io(self.background), \
+                    tracked(os.stat(image).st_size) as t:
+                s.bytes, _ = write_image(image, new_base_lv.path,
+                                         on_progress=t.advance)
+
+            with step("grow-fs"):
+                fs = Filesystem.from_device(new_base_lv.path)
+                fs.randomize_uuid()
+                fs.grow()
+
+        self._verify_image()
+        self._seal_base(new_base_lv)
+        self._base_built(new_base_lv)
+        new_layer_lv = self._add_layer(new_base_lv)
 
         return (new_base_lv, new_layer_lv)
 
     def extract(self, liveimgfile, nvr=None):
         self._clear_updated_file()
         self._check_selinux()
-        new_base = None
-        log.info("Extracting image '%s'" % liveimgfile)
+        new_base = self._resume()
+        if new_base is None:
+            log.info("Extracting image '%s'" % liveimgfile)
+            self._start_verifier(liveimgfile)
+            try:
+                new_base = self._extract(liveimgfile, nvr)
+            finally:
+                self._stop_verifier()
+        log.debug("Extraction done")
+        self._create_updated_file(os.path.basename(liveimgfile))
+        return new_base
+
+    def _extract(self, liveimgfile, nvr):
         with mounted(liveimgfile, options="ro") as squashfs:
             log.debug("Mounted squashfs")
             liveimg = glob.glob(squashfs.target + "/*/*.img").pop()
@@ -139,14 +661,80 @@ class LiveimgExtractor():
             with mounted(liveimg, options="ro") as rootfs:
                 nvr = nvr or BuildMetadata(rootfs.target).get("nvr")
                 log.debug("Using nvr: %s" % nvr)
+                if Timeline.active():
+                    Timeline.active().annotate(nvr=nvr)
+                size = self._recommend_size_for_tree()
+                log.debug("Recommeneded base size: %s" % size)
+                if self.base_mode == "image":
+                    # The image is only mounted read-only to get the nvr,
+                    # thus it's fine to read it as a whole
+                    log.info("Starting base creation from image")
+                    new_base = self.add_base_with_image(liveimg,
+                                                        "%s" % size, nvr)
+                else:
+                    log.info("Starting base creation")
+                    new_base = self.add_base_with_tree(rootfs.target,
+                                                       "%s" % size, nvr)
+                log.info("Files extracted")
+        return new_base
+
+
+class DeltaExtractor(LiveimgExtractor):
+    """Rebuilds the tree of the new image from an installed base and a
+    delta payload (see imgbased.delta), and adds it as a new base
+    """
+    def _usage(self, payloadfile):
+        # The new tree is only known once it was reconstructed
+        return running_usage()
+
+    def _base_for_delta(self, nvr):
+        base = Image.from_nvr(nvr)
+        if base not in self.imgbase.naming.bases():
+            raise DeltaError("The delta needs base %s, which is not "
+                             "installed" % nvr)
+        return base
+
+    def extract(self, payloadfile, nvr=None):
+        self._clear_updated_file()
+        self._check_selinux()
+        new_base = self._resume()
+        if new_base is not None:
+            self._create_updated_file(os.path.basename(payloadfile))
+            return new_base
+        if self.base_mode == "image":
+            log.info("Delta updates are applied as tree")
+            self.base_mode = "tree"
+        workdir = tempfile.mkdtemp(prefix=constants.IMGBASED_TMPFILE_PREFIX,
+                                   dir="/var/tmp")
+        self._start_verifier(payloadfile, background=False)
+        try:
+            log.info("Unpacking delta '%s'" % payloadfile)
+            on_read = self._verifier.update if self._verifier else None
+            with step("unpack-delta"):
+                delta = DeltaPayload.extract(payloadfile, workdir, on_read)
+            nvr = nvr or delta.manifest["to"]
+            log.debug("Using nvr: %s" % nvr)
+            if Timeline.active():
+                Timeline.active().annotate(nvr=nvr)
+
+            base = self._base_for_delta(delta.manifest["from"])
+            base_lv = self.imgbase._lvm_from_layer(base)
+            base_lv.activate(True, True)
+            with mounted(base_lv.path, options="ro") as basefs, \
+                    delta.applied(basefs.target) as tree:
+                with step("verify-delta"):
+                    delta.verify(tree.target)
                 size = self._recommend_size_for_tree()
                 log.debug("Recommeneded base size: %s" % size)
-                log.info("Starting base creation")
-                new_base = self.add_base_with_tree(rootfs.target,
+                log.info("Starting base creation from %s" % base)
+                new_base = self.add_base_with_tree(tree.target,
                                                    "%s" % size, nvr)
                 log.info("Files extracted")
+        finally:
+            self._stop_verifier()
+            shutil.rmtree(workdir)
         log.debug("Extraction done")
-        self._create_updated_file(os.path.basename(liveimgfile))
+        self._create_updated_file(os.path.basename(payloadfile))
         return new_base
 
 
@@ -204,10 +792,37 @@ class GarbageCollector():
 
     def run(self, new_base_lv):
         try:
-            self._do_run(new_base_lv)
+            with step("gc"):
+                self._do_run(new_base_lv)
         except Exception:
             raise GCFailedError("GC failed, remember to remove old bases")
 
+    def candidates_before_update(self):
+        """The bases which can be removed to make room for a new base
+        """
+        keep = self.imgbase.config.section("update").images_to_keep
+        bases = sorted(self.imgbase.naming.bases())
+        current_base = self.imgbase.current_layer().base
+        # The new base is going to count towards the kept ones
+        return self._filter_candidates(bases, current_base, current_base,
+                                       keep - 1)
+
+    def candidates_after_update(self, new_base):
+        """The bases which will be removed once new_base was added
+        """
+        keep = self.imgbase.config.section("update").images_to_keep
+        bases = sorted(set(self.imgbase.naming.bases()) | {new_base})
+        if len(bases) <= keep:
+            return []
+        current_base = self.imgbase.current_layer().base
+        return self._filter_candidates(bases, current_base, new_base, keep)
+
+    def run_before_update(self):
+        with step("gc-first"):
+            for base in self.candidates_before_update():
+                log.info("Freeing %s to make room" % base)
+                self.imgbase.remove_base(base.nvr, force=True)
+
     def _do_run(self, new_base_lv):
         log.info("Starting garbage collection")
 
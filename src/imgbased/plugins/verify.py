@@ -0,0 +1,100 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# imgbase
+#
+# Copyright (C) 2018  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import logging
+import os
+
+from ..naming import Image
+from ..progress import format_bytes
+from ..verity import NotSealedError, VerityError, seal, sealed_tree, \
+    tree_path, verify_all
+
+log = logging.getLogger(__package__)
+
+
+def init(app):
+    app.hooks.connect("pre-arg-parse", add_argparse)
+    app.hooks.connect("post-arg-parse", post_argparse)
+    app.imgbase.hooks.connect("base-removed", on_base_removed)
+
+
+def add_argparse(app, parser, subparsers):
+    v = subparsers.add_parser("verify",
+                              help="Check bases against their root hash")
+    v.add_argument("BASE", nargs="*",
+                   help="The bases to check, all bases by default")
+    v.add_argument("--seal", action="store_true",
+                   help="Compute the root hash of bases which have none")
+    v.add_argument("--workers", type=int, default=4,
+                   help="Number of bases to check in parallel")
+
+
+def post_argparse(app, args):
+    if args.command == "verify":
+        verify_bases(app.imgbase, args.BASE, args.seal, args.workers)
+
+
+def on_base_removed(imgbase, base_lv):
+    path = tree_path(base_lv)
+    if os.path.exists(path):
+        log.debug("Removing hash tree %s" % path)
+        os.unlink(path)
+
+
+def format_regions(regions):
+    """
+    >>> print(format_regions([(40960, 8192), (1048576, 4096)]))
+      at 40.0KiB: 8.0KiB
+      at 1.0MiB: 4.0KiB
+    """
+    return "\n".join("  at %s: %s" % (format_bytes(o), format_bytes(n))
+                     for o, n in regions)
+
+
+def verify_bases(imgbase, names=None, seal_missing=False, workers=4):
+    """Check the bases in parallel and print which regions differ, raises
+    VerityError if any base does not match its root hash
+    """
+    bases = [Image.from_nvr(n) for n in names] if names \
+        else sorted(imgbase.naming.bases())
+    lvs = [imgbase._lvm_from_layer(b) for b in bases]
+    for lv in lvs:
+        lv.activate(True, True)
+        if seal_missing and sealed_tree(lv) is None:
+            seal(lv)
+
+    failed = []
+    for lv, regions, error in verify_all(lvs, workers):
+        if isinstance(error, NotSealedError):
+            print("%s: no root hash, use --seal to compute it" % lv.lv_name)
+        elif error:
+            print("%s: %s" % (lv.lv_name, error))
+            failed.append(lv.lv_name)
+        elif regions:
+            print("%s: %d regions differ" % (lv.lv_name, len(regions)))
+            print(format_regions(regions))
+            failed.append(lv.lv_name)
+        else:
+            print("%s: ok" % lv.lv_name)
+    if failed:
+        raise VerityError("%s did not match the root hash" %
+                          ", ".join(failed))
+
+# vim: sw=4 et sts=4:
@@ -0,0 +1,252 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# imgbase
+#
+# Copyright (C) 2018  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Checks which run before an update writes anything
+
+An update needs space in the thinpool for the data of the new base (and
+the metadata to map it), and space in /boot for the kernel and initrd of
+the new layer.  All of this can be estimated from the image up front.
+"""
+import glob
+import logging
+import os
+import platform
+import stat
+
+from .progress import format_bytes, format_duration
+from .timeline import Timeline
+from .utils import mounted_liveimg
+
+log = logging.getLogger(__package__)
+
+
+class PreflightError(Exception):
+    pass
+
+
+class Requirement(object):
+    """Space needed by the update, compared to what is available
+
+    >>> r = Requirement("/boot", 300 * 1024 ** 2, 200 * 1024 ** 2)
+    >>> r.shortfall == 100 * 1024 ** 2
+    True
+    >>> print(r)
+    /boot                needs 300.0MiB, 200.0MiB available, short by 100.0MiB
+    """
+    def __init__(self, name, needed, available):
+        self.name = name
+        self.needed = int(needed)
+        self.available = int(available)
+
+    @property
+    def shortfall(self):
+        return max(0, self.needed - self.available)
+
+    def __str__(self):
+        line = "%-20s needs %s, %s available" % \
+            (self.name, format_bytes(self.needed),
+             format_bytes(self.available))
+        if self.shortfall:
+            line += ", short by %s" % format_bytes(self.shortfall)
+        return line
+
+
+def _boot_files(boot, kver="*"):
+    return glob.glob(os.path.join(boot, "vmlinuz-%s" % kver)) + \
+        glob.glob(os.path.join(boot, "initramfs-%s.img" % kver))
+
+
+def tree_usage(root, kver="*"):
+    """Returns the used bytes of the filesystem of root, and the bytes
+    of the kernels and initrds in its /boot
+
+    The initrd is built on the host, if the tree has none the largest
+    initrd in the host's /boot is used as estimate.
+
+    >>> import tempfile
+    >>> root = tempfile.mkdtemp()
+    >>> os.mkdir(root + "/boot")
+    >>> with open(root + "/boot/vmlinuz-4.18", "wb") as f:
+    ...     _ = f.write(b"0" * 1024)
+    >>> with open(root + "/boot/initramfs-4.18.img", "wb") as f:
+    ...     _ = f.write(b"0" * 4096)
+    >>> used, boot = tree_usage(root)
+    >>> used > 0, boot
+    (True, 5120)
+    """
+    st = os.statvfs(root)
+    used = (st.f_blocks - st.f_bfree) * st.f_frsize
+    files = _boot_files(os.path.join(root, "boot"), kver)
+    boot = sum(os.path.getsize(f) for f in files)
+    if not any("initramfs-" in f for f in files):
+        initrds = [os.path.getsize(f) for f in _boot_files("/boot")
+                   if "initramfs-" in f]
+        boot += max(initrds or [0])
+    return used, boot
+
+
+def changed_usage(root, old_root):
+    """Returns the bytes of the regular files of root which are not in
+    old_root, or differ in size or mtime, which is what a snapshot of
+    old_root needs to become root
+
+    >>> import tempfile
+    >>> old, new = tempfile.mkdtemp(), tempfile.mkdtemp()
+    >>> for root in [old, new]:
+    ...     os.mkdir(root + "/etc")
+    ...     with open(root + "/etc/motd", "w") as f:
+    ...         _ = f.write("Hello")
+    ...     os.utime(root + "/etc/motd", (0, 0))
+    >>> changed_usage(new, old)
+    0
+    >>> with open(new + "/etc/motd", "w") as f:
+    ...     _ = f.write("Bye")
+    >>> with open(new + "/etc/issue", "w") as f:
+    ...     _ = f.write("Kernel")
+    >>> changed_usage(new, old)
+    9
+    """
+    changed = 0
+    stack = [""]
+    while stack:
+        relpath = stack.pop()
+        with os.scandir(os.path.join(root, relpath)) as it:
+            for entry in it:
+                path = os.path.join(relpath, entry.name)
+                st = entry.stat(follow_symlinks=False)
+                if stat.S_ISDIR(st.st_mode):
+                    stack.append(path)
+                    continue
+                if not stat.S_ISREG(st.st_mode):
+                    continue
+                try:
+                    old = os.lstat(os.path.join(old_root, path))
+                except OSError:
+                    old = None
+                if old is None or (old.st_size, old.st_mtime_ns) != \
+                        (st.st_size, st.st_mtime_ns):
+                    changed += st.st_size
+    return changed
+
+
+def image_usage(liveimgfile):
+    """Returns tree_usage() of the root filesystem inside a squashfs image
+    """
+    with mounted_liveimg(liveimgfile) as rootfs:
+        return tree_usage(rootfs.target)
+
+
+def running_usage():
+    """Returns tree_usage() of the running system, as estimate for a tree
+    which is only known after it was reconstructed (i.e. from a delta)
+    """
+    return tree_usage("/", platform.release())
+
+
+def expected_duration(log_dir, last=5):
+    """Returns the median duration of the last successful updates, or
+    None if none was recorded
+
+    >>> import tempfile
+    >>> tmpdir = tempfile.mkdtemp()
+    >>> expected_duration(tmpdir) is None
+    True
+    >>> for idx, duration in enumerate([600, 900, 700]):
+    ...     with open("%s/update-2018010%dT0.jsonl" % (tmpdir, idx), "w") \\
+    ...             as f:
+    ...         _ = f.write('{"event": "stop", "result": "ok", '
+    ...                     '"duration": %d}\\n' % duration)
+    >>> expected_duration(tmpdir)
+    700
+    """
+    durations = []
+    for path in Timeline.list(log_dir)[::-1]:
+        try:
+            events = Timeline.load(path)
+        except ValueError:
+            continue
+        durations += [e["duration"] for e in events
+                      if e["event"] == "stop" and e.get("result") == "ok"]
+        if len(durations) >= last:
+            break
+    if not durations:
+        return None
+    return sorted(durations)[len(durations) // 2]
+
+
+class Preflight(object):
+    """Compares the space needed by an update with the available space
+    """
+    # Headroom for the files written by the migration to the new layer,
+    # and for thin pool chunks which are only partially used
+    margin = 1.1
+    # Mapping a chunk of the pool takes up to 64 bytes of metadata
+    metadata_per_chunk = 64
+
+    def __init__(self, imgbase):
+        self.imgbase = imgbase
+
+    def _boot_free(self):
+        st = os.statvfs("/boot")
+        return st.f_bavail * st.f_frsize
+
+    def requirements(self, used, boot):
+        """Returns the requirements for a new base of used bytes, with
+        kernels and initrds of boot bytes
+        """
+        needed = used * self.margin
+        pool = self.imgbase._thinpool()
+        meta_pct, meta_size, chunk_size = pool.metadata_usage()
+
+        # The kernel and initrd are copied to /boot/<layer>/ and /boot/
+        return [Requirement("thinpool data", needed,
+                            self.imgbase.free_space(units="b")),
+                Requirement("thinpool metadata",
+                            needed / chunk_size * self.metadata_per_chunk,
+                            meta_size * (100 - meta_pct) / 100),
+                Requirement("/boot", boot * 2, self._boot_free())]
+
+    def check(self, used, boot, reclaimable=None):
+        """Raises PreflightError with a report if anything is short
+
+        reclaimable are the bases which could be removed to make room
+        """
+        requirements = self.requirements(used, boot)
+        for r in requirements:
+            log.debug("Pre-flight: %s" % r)
+        short = [r for r in requirements if r.shortfall]
+        if short:
+            report = ["Not enough space for the update:"]
+            report += ["  %s" % r for r in short]
+            if reclaimable:
+                report.append("Use --gc-first to remove %s before the "
+                              "update" % ", ".join(str(b)
+                                                   for b in reclaimable))
+            raise PreflightError("\n".join(report))
+        log.info("Pre-flight checks passed")
+
+    @staticmethod
+    def announce(log_dir):
+        duration = expected_duration(log_dir)
+        if duration:
+            log.info("The update is expected to take about %s" %
+                     format_duration(duration))
+
+# vim: sw=4 et sts=4:
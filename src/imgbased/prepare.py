@@ -0,0 +1,148 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# imgbase
+#
+# Copyright (C) 2018  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Results which are computed ahead of an update (update --prepare)
+
+Each result is stored with a key (i.e. the layer or image it belongs to)
+and a fingerprint of its inputs.  The fingerprint only looks at the
+metadata of the inputs, so an update can cheaply check if a result is
+still valid, and otherwise computes it again.
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+from . import constants
+
+log = logging.getLogger(__package__)
+
+
+def fingerprint(root, *paths):
+    """Returns a fingerprint of the metadata of paths (relative to root),
+    directories are included with all their entries
+
+    Only the relative path, type, mode, owner, size and mtime are used,
+    thus a copy of a tree has the same fingerprint.
+
+    >>> import tempfile
+    >>> root = tempfile.mkdtemp()
+    >>> os.mkdir(root + "/etc")
+    >>> with open(root + "/etc/motd", "w") as f:
+    ...     _ = f.write("Hello")
+    >>> a = fingerprint(root, "etc", "missing")
+    >>> a == fingerprint(root, "etc", "missing")
+    True
+    >>> with open(root + "/etc/motd", "w") as f:
+    ...     _ = f.write("Bye!!")
+    >>> os.utime(root + "/etc/motd", ns=(0, 0))
+    >>> a == fingerprint(root, "etc", "missing")
+    False
+    """
+    h = hashlib.sha256()
+
+    def add(relpath):
+        try:
+            st = os.lstat(os.path.join(root, relpath))
+        except FileNotFoundError:
+            h.update(("%s missing\0" % relpath).encode("utf-8", "replace"))
+            return
+        h.update(("%s %o %d %d %d %d\0" %
+                  (relpath, st.st_mode, st.st_uid, st.st_gid, st.st_size,
+                   st.st_mtime_ns)).encode("utf-8", "replace"))
+
+    for path in paths:
+        path = path.strip("/")
+        add(path)
+        for dirpath, dirnames, filenames in os.walk(os.path.join(root,
+                                                                 path)):
+            dirnames.sort()
+            for name in sorted(dirnames + filenames):
+                add(os.path.relpath(os.path.join(dirpath, name), root))
+    return h.hexdigest()
+
+
+class PrepareCache(object):
+    """Stores prepared results as JSON files
+
+    >>> import tempfile
+    >>> cache = PrepareCache(tempfile.mkdtemp())
+    >>> cache.load("etc-changes", "Image-1.0-0+1", "abc") is None
+    True
+    >>> cache.store("etc-changes", "Image-1.0-0+1", "abc", ["etc/motd"])
+    >>> cache.load("etc-changes", "Image-1.0-0+1", "abc")
+    ['etc/motd']
+
+    The result is not used if the key or fingerprint differ:
+
+    >>> cache.load("etc-changes", "Image-1.0-0+1", "def") is None
+    True
+
+    >>> calls = []
+    >>> cache.cached("etc-changes", "Image-1.0-0+1", "abc",
+    ...              lambda: calls.append(1))
+    ['etc/motd']
+    >>> calls
+    []
+    """
+    directory = None
+
+    def __init__(self, directory=None):
+        self.directory = directory or constants.IMGBASED_PREPARE_DIR
+
+    def _path(self, name):
+        return os.path.join(self.directory, "%s.json" % name)
+
+    def store(self, name, key, fingerprint, value):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        tmp = self._path(name) + ".tmp"
+        with open(tmp, "w") as dst:
+            json.dump({"key": key, "fingerprint": fingerprint,
+                       "value": value}, dst)
+        os.rename(tmp, self._path(name))
+
+    def load(self, name, key, fingerprint):
+        try:
+            with open(self._path(name)) as src:
+                entry = json.load(src)
+        except (IOError, OSError, ValueError):
+            return None
+        if entry.get("key") != key or \
+                entry.get("fingerprint") != fingerprint:
+            log.debug("Prepared %s is outdated" % name)
+            return None
+        log.debug("Using prepared %s" % name)
+        return entry["value"]
+
+    def cached(self, name, key, fingerprint, compute):
+        """Returns the prepared result, or computes it
+        """
+        value = self.load(name, key, fingerprint)
+        if value is None:
+            value = compute()
+        return value
+
+    def clear(self):
+        if os.path.isdir(self.directory):
+            shutil.rmtree(self.directory)
+
+# vim: sw=4 et sts=4:
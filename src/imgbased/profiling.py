@@ -0,0 +1,129 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# imgbase
+#
+# Copyright (C) 2018  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import cProfile
+import logging
+import time
+from contextlib import contextmanager
+
+
+log = logging.getLogger(__package__)
+
+
+class Profiler(object):
+    """Attribute wall time to plugins and hooks, the whole run is profiled
+    with cProfile if there is an output file for its statistics
+
+    Only one profiler is active at a time, code which wants to be
+    attributed uses the module level timed() helper, which does nothing
+    if no profiler was started:
+
+    >>> with timed("init", "nothing"):
+    ...     pass
+
+    >>> p = Profiler().start()
+    >>> with timed("init", "imgbased.plugins.core"):
+    ...     pass
+    >>> with timed("init", "imgbased.plugins.core"):
+    ...     pass
+    >>> p.stop()
+    >>> [(k, n, c) for k, n, c, t in p.summary()]
+    [('init', 'imgbased.plugins.core', 2)]
+    >>> "imgbased.plugins.core" in p.report()
+    True
+    """
+    _active = None
+
+    timings = None
+    output = None
+    _profile = None
+
+    def __init__(self, output=None):
+        self.output = output
+        self.timings = []
+        # cProfile slows everything down, only pay for it if it's written
+        if output:
+            self._profile = cProfile.Profile()
+
+    @classmethod
+    def active(cls):
+        return cls._active
+
+    def start(self):
+        Profiler._active = self
+        if self._profile:
+            self._profile.enable()
+        return self
+
+    def stop(self):
+        if self._profile:
+            self._profile.disable()
+        Profiler._active = None
+        if self._profile:
+            log.debug("Writing profile to %s" % self.output)
+            self._profile.dump_stats(self.output)
+
+    def add(self, kind, name, seconds):
+        self.timings.append((kind, name, seconds))
+
+    def summary(self):
+        """Returns (kind, name, calls, seconds) sorted by seconds
+        """
+        totals = {}
+        for kind, name, seconds in self.timings:
+            calls, total = totals.get((kind, name), (0, 0.0))
+            totals[(kind, name)] = (calls + 1, total + seconds)
+        return sorted(((k, n, c, t) for (k, n), (c, t) in totals.items()),
+                      key=lambda e: e[3], reverse=True)
+
+    def report(self):
+        lines = ["%-32s %-48s %5s %10s" % ("Kind", "Name", "Calls",
+                                           "Wall [s]")]
+        for kind, name, calls, seconds in self.summary():
+            lines.append("%-32s %-48s %5d %10.4f" % (kind, name, calls,
+                                                     seconds))
+        return "\n".join(lines)
+
+
+@contextmanager
+def timed(kind, name):
+    """Record the wall time of the block with the active profiler
+    """
+    profiler = Profiler.active()
+    if profiler is None:
+        yield
+        return
+    started = time.time()
+    try:
+        yield
+    finally:
+        profiler.add(kind, name, time.time() - started)
+
+
+def callable_name(cb):
+    """Return a readable name for a hook callback
+
+    >>> callable_name(callable_name)
+    'imgbased.profiling.callable_name'
+    """
+    return "%s.%s" % (getattr(cb, "__module__", None) or "?",
+                      getattr(cb, "__name__", repr(cb)))
+
+# vim: sw=4 et sts=4:
@@ -0,0 +1,320 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# imgbase
+#
+# Copyright (C) 2018  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+
+log = logging.getLogger(__package__)
+
+
+def format_bytes(n):
+    """
+    >>> format_bytes(512), format_bytes(3 * 1024 * 1024)
+    ('512B', '3.0MiB')
+    """
+    for unit in ["B", "KiB", "MiB", "GiB"]:
+        if n < 1024 or unit == "GiB":
+            break
+        n /= 1024.0
+    return ("%d%s" if unit == "B" else "%.1f%s") % (n, unit)
+
+
+def format_duration(seconds):
+    """
+    >>> format_duration(75), format_duration(3725)
+    ('01:15', '1:02:05')
+    """
+    m, s = divmod(int(seconds), 60)
+    h, m = divmod(m, 60)
+    return "%d:%02d:%02d" % (h, m, s) if h else "%02d:%02d" % (m, s)
+
+
+def _logs_to_console(logger=log):
+    """Whether the records of logger are written to stdout or stderr
+
+    >>> logger = logging.getLogger("imgbased.progress.test")
+    >>> logger.propagate = False
+    >>> _logs_to_console(logger)
+    False
+    >>> logger.addHandler(logging.StreamHandler())
+    >>> _logs_to_console(logger)
+    True
+    """
+    while logger:
+        for handler in logger.handlers:
+            if isinstance(handler, logging.StreamHandler) and \
+                    not isinstance(handler, logging.FileHandler) and \
+                    handler.stream in (sys.stdout, sys.stderr):
+                return True
+        if not logger.propagate:
+            break
+        logger = logger.parent
+    return False
+
+
+class Progress(object):
+    """Reports the progress of an update on the terminal and as JSON in a
+    status file, which can be read by other tools
+
+    Only one progress is active at a time.  Steps of the timeline are
+    reported automatically, code which copies data reports the amount
+    with track():
+
+    >>> import tempfile
+    >>> status = tempfile.mkdtemp() + "/update-status.json"
+    >>> p = Progress.start(status, "Image-2.0-0.squashfs.img",
+    ...                    stream=None, interval=None)
+    >>> p.begin_step("copy-tree")
+    >>> with p.track(bytes_total=4096, files_total=4) as t:
+    ...     t.advance(bytes=1024, files=1)
+    ...     s = p.status()
+    >>> s["step"], s["bytes"], s["bytes_total"], s["files"], s["percent"]
+    ('copy-tree', 1024, 4096, 1, 25.0)
+    >>> p.end_step("copy-tree")
+    >>> p.stop("ok")
+
+    >>> s = json.load(open(status))
+    >>> s["state"], s["step"], s["steps_done"]
+    ('ok', None, ['copy-tree'])
+    """
+    _active = None
+
+    path = None
+    target = None
+    stream = None
+
+    def __init__(self, path, target, stream=sys.stderr, interval=1.0):
+        self.path = path
+        self.target = target
+        self.stream = stream
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._started = time.time()
+        self._state = "running"
+        self._steps = []
+        self._steps_done = []
+        self._tracker = None
+        self._stopped = threading.Event()
+        self._ticker = None
+        self._last_log = 0
+
+    @classmethod
+    def active(cls):
+        return cls._active
+
+    @classmethod
+    def start(cls, path, target, stream=sys.stderr, interval=1.0):
+        """Start reporting, returns None if the status can not be written
+        """
+        progress = cls(path, target, stream, interval)
+        try:
+            directory = os.path.dirname(path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            progress.write_status()
+        except (IOError, OSError):
+            log.warning("Unable to write update status to %s" % path)
+            return None
+        cls._active = progress
+        if interval and not os.getenv("IMGBASED_DISABLE_THREADS"):
+            progress._ticker = threading.Thread(target=progress._tick,
+                                                name="progress")
+            progress._ticker.daemon = True
+            progress._ticker.start()
+        return progress
+
+    def stop(self, result):
+        self._stopped.set()
+        if self._ticker:
+            self._ticker.join()
+        with self._lock:
+            self._state = result
+            self._tracker = None
+        self.refresh(final=True)
+        Progress._active = None
+
+    def _tick(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.refresh()
+            except Exception:
+                log.debug("Failed to report progress", exc_info=True)
+
+    def begin_step(self, name):
+        with self._lock:
+            self._steps.append(name)
+        self.refresh()
+
+    def end_step(self, name):
+        with self._lock:
+            if name in self._steps:
+                self._steps.remove(name)
+            self._steps_done.append(name)
+        self.refresh()
+
+    @contextmanager
+    def track(self, bytes_total=None, files_total=None, counter=None):
+        """Track the amount of processed data of the current step
+
+        counter is a callable returning the processed bytes and files,
+        alternatively advance() can be called on the returned tracker
+        """
+        tracker = Tracker(bytes_total, files_total, counter)
+        with self._lock:
+            self._tracker = tracker
+        try:
+            yield tracker
+        finally:
+            with self._lock:
+                if self._tracker is tracker:
+                    self._tracker = None
+
+    def status(self):
+        with self._lock:
+            tracker = self._tracker
+            status = {"target": self.target,
+                      "state": self._state,
+                      "step": ", ".join(self._steps) or None,
+                      "steps_done": list(self._steps_done),
+                      "elapsed": time.time() - self._started,
+                      "time": time.time()}
+        if tracker:
+            status.update(tracker.status())
+        return status
+
+    def write_status(self, status=None):
+        status = status or self.status()
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as dst:
+            json.dump(status, dst, sort_keys=True)
+        os.rename(tmp, self.path)
+
+    def refresh(self, final=False):
+        status = self.status()
+        try:
+            self.write_status(status)
+        except (IOError, OSError):
+            log.debug("Failed to write %s" % self.path, exc_info=True)
+        if self.stream is None:
+            return
+        line = self.format(status)
+        # Log lines on the same terminal would end up in the middle of
+        # the progress line
+        if self.stream.isatty() and not _logs_to_console():
+            self.stream.write("\r\033[K" + line + ("\n" if final else ""))
+            self.stream.flush()
+        elif final or time.time() - self._last_log > 30:
+            # Don't flood logs and journals
+            self._last_log = time.time()
+            log.info(line)
+
+    @staticmethod
+    def format(status):
+        """
+        >>> print(Progress.format({"step": "copy-tree", "elapsed": 75,
+        ...                        "bytes": 1048576, "bytes_total": 4194304,
+        ...                        "files": 10, "files_total": 40,
+        ...                        "percent": 25.0, "files_per_second": 5,
+        ...                        "bytes_per_second": 524288, "eta": 6}))
+        [01:15] copy-tree: 25% 1.0MiB/4.0MiB 10/40 files 5 files/s \
+512.0KiB/s ETA 00:06
+        """
+        line = "[%s] %s" % (format_duration(status["elapsed"]),
+                            status.get("step") or status.get("state"))
+        if status.get("bytes") is not None:
+            line += ":"
+            if status.get("percent") is not None:
+                line += " %d%%" % status["percent"]
+            line += " %s" % format_bytes(status["bytes"])
+            if status.get("bytes_total"):
+                line += "/%s" % format_bytes(status["bytes_total"])
+            if status.get("files") is not None:
+                line += " %d" % status["files"]
+                if status.get("files_total"):
+                    line += "/%d" % status["files_total"]
+                line += " files %d files/s" % status["files_per_second"]
+            line += " %s/s" % format_bytes(status["bytes_per_second"])
+            if status.get("eta") is not None:
+                line += " ETA %s" % format_duration(status["eta"])
+        return line
+
+
+class Tracker(object):
+    """The processed data of a single step
+    """
+    def __init__(self, bytes_total=None, files_total=None, counter=None):
+        self.bytes_total = bytes_total
+        self.files_total = files_total
+        self.counter = counter
+        self.bytes = 0
+        self.files = 0
+        self._started = time.time()
+        self._lock = threading.Lock()
+
+    def advance(self, bytes=0, files=0):
+        with self._lock:
+            self.bytes += bytes
+            self.files += files
+
+    def status(self):
+        if self.counter:
+            done_bytes, done_files = self.counter()
+        else:
+            with self._lock:
+                done_bytes, done_files = self.bytes, self.files
+        seconds = max(time.time() - self._started, 0.001)
+        status = {"bytes": done_bytes,
+                  "bytes_total": self.bytes_total,
+                  "files": done_files,
+                  "files_total": self.files_total,
+                  "bytes_per_second": done_bytes / seconds,
+                  "files_per_second": done_files / seconds,
+                  "percent": None,
+                  "eta": None}
+        if self.bytes_total:
+            done = min(done_bytes, self.bytes_total)
+            status["percent"] = 100.0 * done / self.bytes_total
+            if done:
+                status["eta"] = (self.bytes_total - done) / \
+                    status["bytes_per_second"]
+        return status
+
+
+@contextmanager
+def tracked(bytes_total=None, files_total=None, counter=None):
+    """Track the processed data with the active progress, if any
+
+    >>> with tracked(4096) as t:
+    ...     t.advance(bytes=4096)
+    """
+    progress = Progress.active()
+    if progress is None:
+        yield Tracker(bytes_total, files_total, counter)
+        return
+    with progress.track(bytes_total, files_total, counter) as tracker:
+        yield tracker
+
+# vim: sw=4 et sts=4:
@@ -0,0 +1,207 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# imgbase
+#
+# Copyright (C) 2018  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Run steps in parallel as far as their dependencies and resources allow
+
+A step declares the steps it has to run after, and the resources it reads
+or writes, i.e. "new /etc" or "/var".  Steps writing a resource don't run
+together with other steps using it.  Once a step failed no further steps
+are started, the running ones are waited for and the first error is raised.
+"""
+import logging
+import os
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, \
+    wait
+
+log = logging.getLogger(__package__)
+
+
+class Task(object):
+    """A step, and when it ran
+    """
+    start = None
+    stop = None
+    # The task whose end let this one start
+    blocked_by = None
+
+    def __init__(self, name, func, args, kwargs, after, reads, writes):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.after = list(after)
+        self.reads = set(reads)
+        self.writes = set(writes)
+
+    def conflicts(self, other):
+        return bool(self.writes & (other.writes | other.reads) or
+                    self.reads & other.writes)
+
+    @property
+    def duration(self):
+        return self.stop - self.start
+
+    def __repr__(self):
+        return "<Task %s>" % self.name
+
+
+class Scheduler(object):
+    """
+    >>> order = []
+    >>> s = Scheduler()
+    >>> s.add("etc", order.append, "etc", writes=["new /etc"])
+    >>> s.add("var", order.append, "var", writes=["/var"])
+    >>> s.add("boot", order.append, "boot", after=["etc", "var"])
+    >>> s.run()
+    >>> order[-1]
+    'boot'
+    >>> [t.name for t in s.critical_path()][-1]
+    'boot'
+
+    >>> s = Scheduler()
+    >>> s.add("a", order.append, "a", after=["b"])
+    >>> s.add("b", order.append, "b", after=["a"])
+    >>> s.run()
+    Traceback (most recent call last):
+    ...
+    ValueError: The steps a, b depend on each other
+    """
+    def __init__(self):
+        self._tasks = []
+        self._started = None
+        self._stopped = None
+
+    def add(self, name, func, *args, after=(), reads=(), writes=(),
+            **kwargs):
+        """Register func(*args, **kwargs) as the step name
+        """
+        assert name not in [t.name for t in self._tasks], name
+        self._tasks.append(Task(name, func, args, kwargs, after, reads,
+                                writes))
+
+    def _check(self):
+        names = set(t.name for t in self._tasks)
+        for task in self._tasks:
+            unknown = set(task.after) - names
+            if unknown:
+                raise ValueError("The step %s runs after the unknown steps "
+                                 "%s" % (task.name, ", ".join(unknown)))
+        ordered = set()
+        remaining = list(self._tasks)
+        while remaining:
+            free = [t for t in remaining if ordered.issuperset(t.after)]
+            if not free:
+                raise ValueError("The steps %s depend on each other" %
+                                 ", ".join(sorted(t.name
+                                                  for t in remaining)))
+            ordered.update(t.name for t in free)
+            remaining = [t for t in remaining if t not in free]
+
+    @staticmethod
+    def _inline(task):
+        future = Future()
+        try:
+            future.set_result(task.func(*task.args, **task.kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def run(self):
+        """Run all steps, raises the error of the first step which failed
+        """
+        self._check()
+        threaded = not os.getenv("IMGBASED_DISABLE_THREADS")
+        pending = list(self._tasks)
+        running = {}
+        done = set()
+        failure = None
+        trigger = None
+        self._started = time.time()
+
+        with ThreadPoolExecutor(max_workers=max(len(pending), 1)) as pool:
+            while pending or running:
+                for task in list(pending if failure is None else []):
+                    if not done.issuperset(task.after) or \
+                            any(task.conflicts(r) for r in running.values()):
+                        continue
+                    if not threaded and running:
+                        break
+                    log.debug("Starting step %s" % task.name)
+                    task.start = time.time()
+                    task.blocked_by = trigger
+                    pending.remove(task)
+                    running[pool.submit(task.func, *task.args, **task.kwargs)
+                            if threaded else self._inline(task)] = task
+                if failure is not None and pending:
+                    log.info("Not running the steps %s" %
+                             ", ".join(t.name for t in pending))
+                    pending = []
+                if not running:
+                    break
+
+                finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in finished:
+                    task = running.pop(future)
+                    task.stop = time.time()
+                    trigger = task
+                    error = future.exception()
+                    if error is None:
+                        done.add(task.name)
+                        continue
+                    log.error("Step %s failed: %s" % (task.name, error))
+                    log.debug("".join(traceback.format_exception(
+                        type(error), error, error.__traceback__)))
+                    if failure is None:
+                        failure = error
+        self._stopped = time.time()
+
+        if failure is not None:
+            raise failure
+
+    def critical_path(self):
+        """Returns the chain of steps which determined how long the run
+        took, each waited for the one before it
+        """
+        ran = [t for t in self._tasks if t.stop is not None]
+        if not ran:
+            return []
+        path = [max(ran, key=lambda t: t.stop)]
+        while path[-1].blocked_by is not None:
+            path.append(path[-1].blocked_by)
+        return list(reversed(path))
+
+    def report(self):
+        """Returns the timing of the critical path as text
+        """
+        path = self.critical_path()
+        if not path:
+            return "No steps were run"
+        lines = ["Critical path of %d steps, %.1fs of %.1fs:" %
+                 (len(path), sum(t.duration for t in path),
+                  self._stopped - self._started)]
+        for task in path:
+            lines.append("  %-28s %7.1fs  (at %.1fs)" %
+                         (task.name, task.duration,
+                          task.start - self._started))
+        return "\n".join(lines)
+
+# vim: sw=4 et sts=4:
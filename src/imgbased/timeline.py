@@ -0,0 +1,228 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# imgbase
+#
+# Copyright (C) 2018  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from .progress import Progress
+
+log = logging.getLogger(__package__)
+
+
+class Step(object):
+    """Accounting of a single step, the code running the step can fill in
+    the amount of data it processed
+    """
+    name = None
+    bytes = None
+    files = None
+
+    def __init__(self, name):
+        self.name = name
+
+
+class Timeline(object):
+    """Records the steps of an update as JSON lines
+
+    Only one timeline is active at a time, code which wants to record a
+    step uses the module level step() helper.  Without an active timeline
+    this does nothing:
+
+    >>> with step("tar") as s:
+    ...     s.files = 42
+
+    >>> import tempfile
+    >>> tmpdir = tempfile.mkdtemp()
+    >>> t = Timeline.start(tmpdir, "Image-1.0-0.squashfs.img")
+    >>> with step("tar") as s:
+    ...     s.files = 42
+    >>> t.stop("ok")
+
+    >>> events = Timeline.load(t.path)
+    >>> [e["event"] for e in events]
+    ['start', 'step', 'stop']
+    >>> events[1]["step"], events[1]["files"], events[1]["result"]
+    ('tar', 42, 'ok')
+    """
+    _active = None
+
+    path = None
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._started = time.time()
+
+    @classmethod
+    def active(cls):
+        return cls._active
+
+    @classmethod
+    def start(cls, directory, target):
+        """Start a new timeline in directory, returns None if it can not
+        be written
+        """
+        now = time.time()
+        # Microseconds, so runs within the same second don't share a file
+        path = os.path.join(directory, "update-%s-%06d.jsonl" %
+                            (time.strftime("%Y%m%dT%H%M%S",
+                                           time.localtime(now)),
+                             int(now % 1 * 1000000)))
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            # Never append to the timeline of another run
+            open(path, "x").close()
+            timeline = cls(path)
+            timeline.record(event="start", target=target)
+        except (IOError, OSError):
+            log.warning("Unable to write timeline to %s" % path)
+            return None
+        log.debug("Recording timeline to %s" % path)
+        cls._active = timeline
+        return timeline
+
+    def stop(self, result):
+        self.record(event="stop", result=result,
+                    duration=time.time() - self._started)
+        Timeline._active = None
+
+    def record(self, **event):
+        event.setdefault("time", time.time())
+        with self._lock:
+            with open(self.path, "a") as dst:
+                dst.write(json.dumps(event, sort_keys=True) + "\n")
+
+    def annotate(self, **info):
+        self.record(event="info", **info)
+
+    @staticmethod
+    def load(path):
+        with open(path) as src:
+            return [json.loads(line) for line in src if line.strip()]
+
+    @staticmethod
+    def list(directory):
+        return sorted(glob.glob(os.path.join(directory, "update-*.jsonl")))
+
+
+@contextmanager
+def step(name):
+    """Record the block as a step with the active timeline, and report it
+    to the active progress
+    """
+    s = Step(name)
+    timeline = Timeline.active()
+    progress = Progress.active()
+    if timeline is None and progress is None:
+        yield s
+        return
+    started = time.time()
+    result = "ok"
+    if progress:
+        progress.begin_step(name)
+    try:
+        yield s
+    except BaseException as e:
+        result = "failed: %s" % e.__class__.__name__
+        raise
+    finally:
+        stopped = time.time()
+        if progress:
+            progress.end_step(name)
+        if timeline:
+            timeline.record(event="step", step=name, start=started,
+                            stop=stopped, duration=stopped - started,
+                            bytes=s.bytes, files=s.files, result=result)
+
+
+def fs_usage(path):
+    """Returns the used bytes and files of the filesystem of path
+
+    >>> b, f = fs_usage("/")
+    >>> b > 0 and f > 0
+    True
+    """
+    st = os.statvfs(path)
+    return ((st.f_blocks - st.f_bfree) * st.f_frsize,
+            st.f_files - st.f_ffree)
+
+
+def summarize(events):
+    """Returns a label and the duration per step of a recorded update,
+    repeated steps are summed up
+
+    >>> summarize([{"event": "start", "target": "a.img", "time": 0},
+    ...            {"event": "info", "nvr": "Image-2.0-0"},
+    ...            {"event": "step", "step": "dracut", "duration": 1.0},
+    ...            {"event": "step", "step": "dracut", "duration": 2.0}])
+    ('Image-2.0-0', {'dracut': 3.0})
+    """
+    label = None
+    durations = {}
+    for event in events:
+        if event["event"] == "start":
+            label = event.get("target")
+        elif event["event"] == "info" and "nvr" in event:
+            label = event["nvr"]
+        elif event["event"] == "step":
+            durations[event["step"]] = durations.get(event["step"], 0) + \
+                event["duration"]
+    return label, durations
+
+
+def history_table(runs, threshold=1.5):
+    """Format the step durations of several updates as a table
+
+    A step which took threshold times longer than in the previous update
+    is marked with a '!'
+
+    >>> print(history_table([("Image-1.0-0", {"tar": 10.0, "gc": 1.0}),
+    ...                      ("Image-2.0-0", {"tar": 20.0})]))
+    Step                 Image-1.0-0  Image-2.0-0
+    gc                           1.0            -
+    tar                         10.0         20.0!
+    """
+    width = max([12] + [len(label or "") + 1 for label, _ in runs])
+    steps = sorted(set(s for _, durations in runs for s in durations))
+    lines = [("%-20s" % "Step" +
+              "".join(("%" + str(width) + "s ") % label
+                      for label, _ in runs)).rstrip()]
+    for s in steps:
+        line = "%-20s" % s
+        previous = None
+        for _, durations in runs:
+            duration = durations.get(s)
+            if duration is None:
+                line += ("%" + str(width) + "s ") % "-"
+            else:
+                slower = previous and duration > previous * threshold
+                line += ("%" + str(width) + ".1f%s") % \
+                    (duration, "!" if slower else " ")
+            previous = duration
+        lines.append(line.rstrip())
+    return "\n".join(lines)
+
+# vim: sw=4 et sts=4:
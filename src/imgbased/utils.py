@@ -22,6 +22,8 @@
 #
 
 import glob
+import hashlib
+import json
 import logging
 import os
 import re
@@ -33,6 +35,7 @@ import sys
 import tempfile
 import threading
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 
 from queue import Queue
@@ -217,6 +220,52 @@ class mounted(object):
         return self.mp.path(subpath)
 
 
+@contextmanager
+def mounted_liveimg(liveimgfile):
+    """Mount the root filesystem inside a squashfs image read-only
+    """
+    with mounted(liveimgfile, options="ro") as squashfs:
+        liveimg = glob.glob(squashfs.target + "/*/*.img").pop()
+        with mounted(liveimg, options="ro") as rootfs:
+            yield rootfs
+
+
+def _ionice_args(current):
+    """Returns the ionice arguments to restore a priority as printed by
+    ionice
+
+    >>> _ionice_args("best-effort: prio 4")
+    ['-c', '2', '-n', '4']
+    >>> _ionice_args("none: prio 4")
+    ['-c', '0']
+    >>> _ionice_args("idle")
+    ['-c', '3']
+    """
+    classes = {"none": "0", "realtime": "1", "best-effort": "2", "idle": "3"}
+    name, _, prio = current.partition(":")
+    args = ["-c", classes[name.strip()]]
+    if name.strip() in ("realtime", "best-effort"):
+        args += ["-n", prio.split()[-1]]
+    return args
+
+
+@contextmanager
+def idle_io():
+    """Run the block with idle I/O priority
+
+    The priority is inherited by the threads and processes started in the
+    block, thus it applies to bulk copies running in worker threads.
+    """
+    pid = str(os.getpid())
+    ionice = ExternalBinary().ionice
+    previous = ionice(["-p", pid])
+    ionice(["-c", "3", "-p", pid])
+    try:
+        yield
+    finally:
+        ionice(_ionice_args(previous) + ["-p", pid])
+
+
 @contextmanager
 def bindmounted(source, target, rbind=False, readonly=False):
     options = "rbind" if rbind else "bind,private"
@@ -270,6 +319,11 @@ class Filesystem():
     def randomize_uuid(self):
         raise NotImplementedError
 
+    def grow(self):
+        """Grow the filesystem to the size of the device
+        """
+        raise NotImplementedError
+
 
 class Ext4(Filesystem):
     @staticmethod
@@ -292,6 +346,11 @@ class Ext4(Filesystem):
         log.debug("Running: %s" % cmd)
         command.call(cmd, stderr=subprocess.STDOUT)
 
+    def grow(self):
+        cmd = ["resize2fs", self.path]
+        log.debug("Running: %s" % cmd)
+        command.call(cmd, stderr=subprocess.STDOUT)
+
 
 class XFS(Filesystem):
     @staticmethod
@@ -311,6 +370,13 @@ class XFS(Filesystem):
         log.debug("Running: %s" % cmd)
         command.call(cmd, stderr=subprocess.STDOUT)
 
+    def grow(self):
+        # XFS can only be grown while it is mounted
+        with mounted(self.path) as mnt:
+            cmd = ["xfs_growfs", mnt.target]
+            log.debug("Running: %s" % cmd)
+            command.call(cmd, stderr=subprocess.STDOUT)
+
 
 def findls(path):
     return ExternalBinary().find(["-ls"], cwd=path).splitlines(True)
@@ -416,6 +482,9 @@ class ExternalBinary(object):
     def sync(self, args, **kwargs):
         return self.call(["sync"] + args, **kwargs)
 
+    def ionice(self, args, **kwargs):
+        return self.call(["ionice"] + args, **kwargs)
+
 
 class LvmBinary(ExternalBinary):
     def call(self, *args, **kwargs):
@@ -493,10 +562,10 @@ class SELinuxDomain(object):
             return
         self.run.semanage(["permissive", "-d", self._domain])
 
-    def runcon(self, args):
+    def runcon(self, args, **kwargs):
         if SELinux.disabled(self._mode):
             return
-        self.run.runcon(["-t", self._domain, "--"] + args)
+        return self.run.runcon(["-t", self._domain, "--"] + args, **kwargs)
 
 
 class File(object):
@@ -1001,7 +1070,13 @@ class Tar():
         dstcmd = ["tar", "xBf", "-"] + default_args + ["-C", dst]
         log.debug("Calling binary: %s" % dstcmd)
         dstproc = subprocess.Popen(dstcmd, stdin=src.stdout)
+        # Let the source tar receive a SIGPIPE if the destination exits
+        src.stdout.close()
         dstproc.communicate()
+        src.wait()
+        for proc, cmd in [(src, srccmd), (dstproc, dstcmd)]:
+            if proc.returncode != 0:
+                raise subprocess.CalledProcessError(proc.returncode, cmd)
         log.debug("Done syncing new filesystem")
 
 
@@ -1053,6 +1128,228 @@ class Rsync():
         self._run(cmd)
 
 
+class ChecksumMismatchError(Exception):
+    pass
+
+
+class ChecksumLagError(Exception):
+    pass
+
+
+class ImageChecksum(object):
+    """Checksum a file while it's read
+
+    If the caller reads the file itself, it passes each chunk to update()
+    and the file is only read once.
+
+    If someone else reads it (i.e. the loop device of a mounted squashfs,
+    which is read by the kernel), start() reads the file sequentially in
+    a background thread.  This only comes without additional I/O as long
+    as the thread stays close enough to the consumer to find its pages in
+    the page cache.  If the loop devices of the file read more than
+    max_lag bytes ahead of the thread, the pages are likely evicted and
+    hashing them would read the image a second time, then the thread gives
+    up and verify() raises ChecksumLagError.
+
+    >>> import tempfile
+    >>> fn = tempfile.mkstemp()[1]
+    >>> File(fn).write("Hello")
+    >>> digest = ("sha256:185f8db32271fe25f561a6fc938b2e26"
+    ...           "4306ec304eda518007d1764826381969")
+
+    >>> c = ImageChecksum(fn, digest)
+    >>> c.start()
+    >>> c.verify()
+
+    >>> c = ImageChecksum(fn, digest)
+    >>> c.update(b"Hel")
+    >>> c.update(b"lo")
+    >>> c.verify()
+
+    >>> c = ImageChecksum(fn, "sha256:00")
+    >>> c.start()
+    >>> c.verify()
+    Traceback (most recent call last):
+    ...
+    imgbased.utils.ChecksumMismatchError: ...
+
+    >>> File(fn + ".sha256").write(digest[7:] + "  image.squashfs.img\\n")
+    >>> ImageChecksum.from_sidecar(fn).expected == digest[7:]
+    True
+    >>> ImageChecksum.from_sidecar("/no/such/file") is None
+    True
+    """
+    chunk_size = 4 * 1024 * 1024
+    max_lag = 256 * 1024 * 1024
+
+    def __init__(self, path, expected):
+        self.path = path
+        self.algorithm, _, self.expected = expected.rpartition(":")
+        self.algorithm = self.algorithm or "sha256"
+        self.expected = self.expected.lower()
+        self.position = 0
+        self._hash = hashlib.new(self.algorithm)
+        self._cancelled = threading.Event()
+        self._thread = None
+
+    @classmethod
+    def from_sidecar(cls, path):
+        """Use the digest from a sha256sum style file next to path
+        """
+        sidecar = File(path + ".sha256")
+        if not sidecar.exists():
+            return None
+        return cls(path, "sha256:" + sidecar.contents.split()[0])
+
+    def update(self, data):
+        """Hash the next chunk of the file, read by the caller
+        """
+        self._hash.update(data)
+        self.position += len(data)
+
+    def _consumed(self):
+        """The bytes the loop devices of the file read, None if it is not
+        attached to one
+        """
+        path = os.path.realpath(self.path)
+        consumed = None
+        for backing in glob.glob("/sys/block/loop*/loop/backing_file"):
+            if File(backing).contents.strip() != path:
+                continue
+            blockdev = os.path.dirname(os.path.dirname(backing))
+            sectors = File(blockdev + "/stat").contents.split()[2]
+            consumed = (consumed or 0) + int(sectors) * 512
+        return consumed
+
+    def _read(self):
+        with open(self.path, "rb") as src:
+            for chunk in iter(lambda: src.read(self.chunk_size), b""):
+                if self._cancelled.is_set():
+                    return
+                self.update(chunk)
+                consumed = self._consumed()
+                if consumed and consumed - self.position > self.max_lag:
+                    raise ChecksumLagError("Checksumming %s fell %d bytes "
+                                           "behind, verify it before the "
+                                           "update instead" %
+                                           (self.path,
+                                            consumed - self.position))
+
+    def start(self):
+        log.debug("Checksumming %s with %s" % (self.path, self.algorithm))
+        self._thread = ThreadRunner(self._read)
+        if os.getenv("IMGBASED_DISABLE_THREADS"):
+            self._thread.run()
+        else:
+            self._thread.start()
+
+    def _join(self):
+        thread, self._thread = self._thread, None
+        if thread:
+            thread.join_with_exceptions()
+
+    def cancel(self):
+        self._cancelled.set()
+        try:
+            self._join()
+        except Exception:
+            log.debug("Checksumming %s failed" % self.path, exc_info=True)
+
+    def verify(self):
+        self._join()
+        digest = self._hash.hexdigest()
+        if digest != self.expected:
+            raise ChecksumMismatchError("%s has %s checksum %s, expected %s" %
+                                        (self.path, self.algorithm, digest,
+                                         self.expected))
+        log.info("Verified %s checksum of %s" % (self.algorithm, self.path))
+
+
+class IDRegistry(object):
+    """The ids which the accounts of the images settled on
+
+    Every account of an image is stored with the id the image gives it
+    (the factory id) and the id it got on this system (the settled id).
+    The next image usually brings the same accounts with the same factory
+    ids, then the drift is known without merging the accounts again.
+
+    >>> import tempfile
+    >>> old, new = tempfile.mkdtemp(), tempfile.mkdtemp()
+    >>> File(old + "/passwd").write("sshd:x:74:74::/:/sbin/nologin\\n")
+    >>> File(old + "/group").write("sshd:x:74:\\n")
+    >>> File(new + "/passwd").write("sshd:x:75:75::/:/sbin/nologin\\n")
+    >>> File(new + "/group").write("sshd:x:75:\\n")
+    >>> path = tempfile.mkdtemp() + "/idmap.json"
+    >>> IDRegistry(path).known(old, new) is None
+    True
+    >>> IDRegistry(path).record(new, File(old + "/passwd").contents,
+    ...                         File(old + "/group").contents)
+    >>> IDRegistry(path).users
+    {'sshd': [75, 74]}
+    >>> IDRegistry(path).known(old, new)
+    ([(74, 75)], [(74, 75)])
+    """
+    users = None
+    groups = None
+
+    def __init__(self, path=None):
+        self.path = path or constants.IMGBASED_IDMAP_REGISTRY
+        self.users, self.groups = {}, {}
+        try:
+            with open(self.path) as src:
+                data = json.load(src)
+            self.users = dict(data["users"])
+            self.groups = dict(data["groups"])
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            pass
+
+    def known(self, from_etc, to_etc):
+        """Returns the drift from from_etc to the factory to_etc if every
+        account of to_etc has the factory id it had before, and from_etc
+        still uses the id it settled on.  Otherwise None.
+        """
+        parse = IDMap(None, None)._parse_ids
+        drift = []
+        for name, entries in [("passwd", self.users),
+                              ("group", self.groups)]:
+            old = parse(File(from_etc + "/" + name).contents)
+            new = parse(File(to_etc + "/" + name).contents)
+            pairs = []
+            for account, factory_id in new.items():
+                entry = entries.get(account)
+                if entry is None or entry[0] != factory_id or \
+                        old.get(account) != entry[1]:
+                    log.debug("%s %s has no known id" % (name, account))
+                    return None
+                if entry[1] != factory_id:
+                    pairs.append((entry[1], factory_id))
+            drift.append(sorted(pairs))
+        return tuple(drift)
+
+    def record(self, factory_etc, passwd_content, group_content):
+        """Remember the ids which the accounts of factory_etc settled on
+        in the merged passwd and group
+        """
+        parse = IDMap(None, None)._parse_ids
+        for name, content, entries in [("passwd", passwd_content,
+                                        self.users),
+                                       ("group", group_content,
+                                        self.groups)]:
+            settled = parse(content)
+            factory = parse(File(factory_etc + "/" + name).contents)
+            for account, factory_id in factory.items():
+                if account in settled:
+                    entries[account] = [factory_id, settled[account]]
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as dst:
+            json.dump({"users": self.users, "groups": self.groups}, dst,
+                      sort_keys=True)
+        os.rename(tmp, self.path)
+
+
 class IDMap():
     """This class can help to detect uid/gid drift an get it fixed
 
@@ -1079,13 +1376,15 @@ class IDMap():
     from_etc = None
     to_etc = None
     changed_ids = {}
-    _merge_gids = []
-    _merge_uids = []
 
-    def __init__(self, from_etc, to_etc):
+    def __init__(self, from_etc, to_etc, registry=None):
         self.from_etc = from_etc
         self.to_etc = to_etc
+        self.registry = registry
         self._new_ugids = False
+        self._merge_gids = []
+        self._merge_uids = []
+        self._drift = None
 
     def _parse_ids(self, id_data):
         """foo
@@ -1187,9 +1486,6 @@ class IDMap():
         ids = {}
         changed_ids = {}
 
-        def check_id_in_use(i, j):
-            return any([i == int(k) for k in j.values()])
-
         old_lines = old_content.strip().split('\n')
         new_lines = new_content.strip().split('\n')
 
@@ -1197,6 +1493,10 @@ class IDMap():
             name, _, i = o.split(":")[:3]
             ids[name] = i
 
+        # Looking up every candidate in ids.values() made the allocation
+        # quadratic in the number of accounts
+        in_use = set(int(i) for i in ids.values())
+
         for n in new_lines:
             _write_content = False
             name, _, i = n.split(":")[:3]
@@ -1205,11 +1505,12 @@ class IDMap():
                 _write_content = True
                 self._new_ugids = True
                 old_id = i
-                if not check_id_in_use(i, ids):
-                    pass
+                if i not in in_use:
+                    ids[name] = str(i)
+                    in_use.add(i)
                 else:
                     log.debug("ID in use")
-                    while check_id_in_use(i, ids):
+                    while i in in_use:
                         i += 1
                         if i > 1000:
                             # If it's a system account, do our best to
@@ -1222,6 +1523,7 @@ class IDMap():
                     log.debug("Assigning {} as {}".format(fields[0],
                                                           fields[2]))
                     ids[name] = i
+                    in_use.add(int(i))
                     changed_ids[str(old_id)] = i
                     li.append((int(i), old_id))
 
@@ -1259,7 +1561,24 @@ class IDMap():
 
     def get_drift(self):
         """Returns the uid and gid dirft from the old to the new etc
+
+        The drift is only computed once.  If the registry knows the ids of
+        all accounts of the new etc, they are not merged again: the old
+        passwd and group already have every account with its settled id.
+        Nothing is written, the registry is recorded by the caller once
+        the drift was fixed.
         """
+        if self._drift is not None:
+            return self._drift
+
+        known = self.registry.known(self.from_etc, self.to_etc) \
+            if self.registry else None
+        if known is not None:
+            log.debug("The ids of the new etc are known: %s %s" % known)
+            self.group_content = File(self.from_etc + "/group").contents
+            self.passwd_content = File(self.from_etc + "/passwd").contents
+            self._drift = known
+            return self._drift
 
         self._sync_files()
 
@@ -1275,13 +1594,37 @@ class IDMap():
         gidmap = gidmap + self._merge_gids
         uidmap = uidmap + self._merge_uids
 
-        return (uidmap, gidmap)
+        self._drift = (uidmap, gidmap)
+        return self._drift
 
     def has_drift(self):
         """Returns True if the id mapping of a group or user has changed
         """
         return (sum(len(m) for m in self.get_drift()) > 0) or self._new_ugids
 
+    def _reverse_drift(self, _fake_drift=None):
+        """Returns the maps from the new uids and gids to the old ones
+
+        >>> IDMap(None, None)._reverse_drift(([(1, 11)], [(2, 22), (3, 33)]))
+        ({11: 1}, {22: 2, 33: 3})
+        """
+        drift = _fake_drift or self.get_drift()
+        assert drift
+
+        uidmap, gidmap = map(dict, drift)
+
+        # *map maps from old to new
+
+        rev_uidmap = dict(map(reversed, uidmap.items()))
+        rev_gidmap = dict(map(reversed, gidmap.items()))
+
+        # rev*map maps from new to old
+
+        assert len(uidmap) == len(rev_uidmap)
+        assert len(gidmap) == len(rev_gidmap)
+
+        return rev_uidmap, rev_gidmap
+
     def _map_new_ids_to_old_ids(self, paths_and_ids, _fake_drift=None):
         """Translate all uids/gids in path
 
@@ -1312,21 +1655,7 @@ class IDMap():
         >>> list(changes)
         [('/foo', (-1, 2)), ('/bar', (1, -1)), ('/allchange', (1, 2))]
         """
-
-        drift = _fake_drift or self.get_drift()
-        assert drift
-
-        uidmap, gidmap = map(dict, drift)
-
-        # *map maps from old to new
-
-        rev_uidmap = dict(map(reversed, uidmap.items()))
-        rev_gidmap = dict(map(reversed, gidmap.items()))
-
-        # rev*map maps from new to old
-
-        assert len(uidmap) == len(rev_uidmap)
-        assert len(gidmap) == len(rev_gidmap)
+        rev_uidmap, rev_gidmap = self._reverse_drift(_fake_drift)
 
         for (fn, new_uid, new_gid) in paths_and_ids:
             # Check if for a given id, an old - different - id
@@ -1338,58 +1667,120 @@ class IDMap():
                 # If there is a change, emit it
                 yield (fn, (old_uid, old_gid))
 
-    def fix_drift(self, new_path):
-        """This function will walk a tree and adjust all UID/GIDs which drifted
+    def drifted_names(self):
+        """Returns the names of the users and of the groups whose ids
+        drifted
+        """
+        rev_uidmap, rev_gidmap = self._reverse_drift()
+        to_uids = self._parse_ids(File(self.to_etc + "/passwd").contents)
+        to_gids = self._parse_ids(File(self.to_etc + "/group").contents)
+        return (sorted(n for n, i in to_uids.items() if i in rev_uidmap),
+                sorted(n for n, i in to_gids.items() if i in rev_gidmap))
 
-        path is expected to be a path with the new uid/gid.
+    @staticmethod
+    def _fix_owner(fn, st, rev_uidmap, rev_gidmap):
+        """Change the owner of fn back to the old ids, returns True if it
+        was changed
         """
-        # Go through all paths and find their uid/gid
-        changed_new_ids = []
-        for (dirpath, dirnames, filenames) in os.walk(new_path):
-            for fn in dirnames + filenames:
-                fullfn = dirpath + "/" + fn
-                if not os.path.exists(fullfn):
-                    log.debug("File does not exist: %s" % fn)
-                    continue
-                st = os.stat(fullfn)
-                uid = st.st_uid
-                gid = st.st_gid
-                changed_new_ids.append((fullfn, uid, gid))
-
-        # For each new path, see if the uid/gid changed
-        new_ids_xlated_to_old = self._map_new_ids_to_old_ids(changed_new_ids)
-        for (fn, old_ids) in new_ids_xlated_to_old:
-            # The uid/gid has changed, so change it to the old uid/gid
+        old_uid = rev_uidmap.get(st.st_uid, -1)
+        old_gid = rev_gidmap.get(st.st_gid, -1)
+        if old_uid == -1 and old_gid == -1:
+            return False
+        try:
+            log.debug("Chowning %r to %s" % (fn, (old_uid, old_gid)))
+            os.chown(fn, old_uid, old_gid, follow_symlinks=False)
+            # FIXME changing the uid/gid is dropping the setuid and setgid
+            # bits, restore them
+            mode = stat.S_IMODE(st.st_mode)
+            if not stat.S_ISLNK(st.st_mode) and \
+                    mode & (stat.S_ISUID | stat.S_ISGID):
+                log.debug("Restoring mode of %s to: %o" % (fn, mode))
+                os.chmod(fn, mode)
+        except OSError as e:
+            log.debug("Failed to chown %s: %r" % (fn, e))
+            return False
+        return True
+
+    @classmethod
+    def _fix_tree(cls, top, rev_uidmap, rev_gidmap):
+        """Walk top and fix the owners, without following symlinks
+        """
+        changed = []
+        stack = [top]
+        while stack:
             try:
-                restore_mode = False
-                st = os.stat(fn)
-                if stat.S_ISDIR(st.st_mode):
-                    ftype = "directory"
-                elif stat.S_ISREG(st.st_mode):
-                    ftype = "file"
-                else:
-                    ftype = ""
-                mode = stat.S_IMODE(st.st_mode)
-                log.debug("The mode of {} {} is: {:o}".format(
-                    ftype,
-                    fn,
-                    mode,
-                ))
-                if (mode & stat.S_ISUID) or (mode & stat.S_ISGID):
-                    log.debug("Going to restore the access mode")
-                    restore_mode = True
-                log.debug("Chowning %r to %s" % (fn, old_ids))
-                os.chown(fn, *old_ids)
-                if restore_mode:
-                    log.debug("Restoring mode of {} {} to: {:o}".format(
-                        ftype,
-                        fn,
-                        mode,
-                    ))
-                    os.chmod(fn, mode)
-                yield fn
+                it = os.scandir(stack.pop())
             except OSError as e:
-                log.debug("Failed to chown %s: %r" % (fn, e))
+                log.debug("Failed to list %s: %r" % (top, e))
+                continue
+            with it:
+                for entry in it:
+                    try:
+                        st = entry.stat(follow_symlinks=False)
+                    except OSError:
+                        continue
+                    if cls._fix_owner(entry.path, st, rev_uidmap,
+                                      rev_gidmap):
+                        changed.append(entry.path)
+                    if stat.S_ISDIR(st.st_mode):
+                        stack.append(entry.path)
+        return changed
+
+    @classmethod
+    def _fix_paths(cls, paths, rev_uidmap, rev_gidmap):
+        changed = []
+        for fn in paths:
+            try:
+                st = os.lstat(fn)
+            except OSError:
+                log.debug("File does not exist: %s" % fn)
+                continue
+            if cls._fix_owner(fn, st, rev_uidmap, rev_gidmap):
+                changed.append(fn)
+        return changed
+
+    def fix_drift(self, new_path, manifest=None, paths=None, workers=None):
+        """Change all UID/GIDs below new_path which drifted back to the old
+        ids, returns the changed paths
+
+        new_path is expected to be a path with the new uid/gid.  The tree
+        is walked, unless the manifest of the image or the paths (relative
+        to new_path) which can have drifted ids are given.  The top level
+        directories are fixed in parallel.
+        """
+        rev_uidmap, rev_gidmap = self._reverse_drift()
+        if not rev_uidmap and not rev_gidmap:
+            return []
+        new_path = new_path.rstrip("/")
+        if manifest is not None:
+            paths = (row["path"] for row in
+                     manifest.owned_by(rev_uidmap, rev_gidmap))
+        if os.getenv("IMGBASED_DISABLE_THREADS"):
+            workers = 1
+
+        jobs = []
+        changed = []
+        if paths is not None:
+            groups = {}
+            for path in paths:
+                top = path.lstrip("/").split("/", 1)[0]
+                groups.setdefault(top, []).append(new_path + "/" +
+                                                  path.lstrip("/"))
+            for group in groups.values():
+                jobs.append((self._fix_paths, group))
+        else:
+            changed += self._fix_paths([e.path for e in os.scandir(new_path)],
+                                       rev_uidmap, rev_gidmap)
+            for entry in os.scandir(new_path):
+                if entry.is_dir(follow_symlinks=False):
+                    jobs.append((self._fix_tree, entry.path))
+
+        with ThreadPoolExecutor(max_workers=workers or 8) as pool:
+            results = [pool.submit(func, arg, rev_uidmap, rev_gidmap)
+                       for func, arg in jobs]
+            for result in results:
+                changed += result.result()
+        return changed
 
 
 class SystemRelease(File):
@@ -1560,15 +1951,4 @@ class ThreadRunner(threading.Thread):
             raise exc[1]
 
 
-def thread_group_handler(threads, exc=None):
-    threaded = not os.getenv("IMGBASED_DISABLE_THREADS")
-    [getattr(t, "start" if threaded else "run")() for t in threads]
-
-    for t in threads:
-        try:
-            t.join_with_exceptions()
-        except Exception:
-            log.debug(traceback.format_exc())
-            sys.exit(1)
-
 # vim: sw=4 et sts=4
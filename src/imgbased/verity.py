@@ -0,0 +1,339 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# imgbase
+#
+# Copyright (C) 2018  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Hash trees of bases, to detect corrupted or modified blocks
+
+The tree has the dm-verity on-disk format (version 1, sha256, 4096 byte
+data and hash blocks, no superblock), the highest level is stored first.
+It can thus also be checked with:
+
+    veritysetup verify --no-superblock --salt SALT DEVICE TREE ROOT_HASH
+
+The root hash and salt are stored as tags of the base, the tree itself in
+/var/imgbased/verity/.  A base which doesn't match its root hash is
+compared block by block with the stored tree, to find the regions which
+differ.
+"""
+import hashlib
+import logging
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from . import constants
+
+log = logging.getLogger(__package__)
+
+
+BLOCK_SIZE = 4096
+DIGEST_SIZE = 32
+HASHES_PER_BLOCK = BLOCK_SIZE // DIGEST_SIZE
+
+TAG_ROOT_HASH = "imgbased:verity-root="
+TAG_SALT = "imgbased:verity-salt="
+
+
+class VerityError(Exception):
+    pass
+
+
+class NotSealedError(VerityError):
+    pass
+
+
+def _device_blocks(path):
+    with open(path, "rb") as src:
+        size = src.seek(0, os.SEEK_END)
+    if size % BLOCK_SIZE:
+        raise VerityError("The size of %s is not a multiple of %d" %
+                          (path, BLOCK_SIZE))
+    return size // BLOCK_SIZE
+
+
+def _block_digests(path, salt, offset=0, count=None, chunk=256):
+    """Yields the salted digest of each block of path
+
+    Unprovisioned regions of thin volumes read as zeros, the digest of a
+    zero block is only computed once.
+    """
+    zero = bytes(BLOCK_SIZE)
+    zero_digest = hashlib.sha256(salt + zero).digest()
+    with open(path, "rb") as src:
+        src.seek(offset)
+        remaining = count
+        while remaining is None or remaining > 0:
+            n = chunk if remaining is None else min(chunk, remaining)
+            data = src.read(n * BLOCK_SIZE)
+            if not data:
+                break
+            for pos in range(0, len(data), BLOCK_SIZE):
+                block = data[pos:pos + BLOCK_SIZE]
+                if block == zero:
+                    yield zero_digest
+                else:
+                    yield hashlib.sha256(salt + block).digest()
+            if remaining is not None:
+                remaining -= len(data) // BLOCK_SIZE
+
+
+def _pack(digests, dst):
+    """Write the digests into hash blocks, returns the number of blocks
+    """
+    blocks = 0
+    block = []
+    for digest in digests:
+        block.append(digest)
+        if len(block) == HASHES_PER_BLOCK:
+            dst.write(b"".join(block))
+            blocks += 1
+            block = []
+    if block:
+        data = b"".join(block)
+        dst.write(data + bytes(BLOCK_SIZE - len(data)))
+        blocks += 1
+    return blocks
+
+
+def level_blocks(data_blocks):
+    """Returns the number of hash blocks of each level, lowest first
+
+    >>> level_blocks(1), level_blocks(128), level_blocks(129)
+    ([], [1], [2, 1])
+    >>> level_blocks(128 * 128 * 3)
+    [384, 3, 1]
+    """
+    levels = []
+    count = data_blocks
+    while count > 1:
+        count = (count + HASHES_PER_BLOCK - 1) // HASHES_PER_BLOCK
+        levels.append(count)
+    return levels
+
+
+class HashTree(object):
+    """The hash tree of a device
+
+    >>> workdir = tempfile.mkdtemp()
+    >>> device = workdir + "/device"
+    >>> with open(device, "wb") as f:
+    ...     _ = f.write(bytes(BLOCK_SIZE * 200))
+    >>> tree = HashTree.build(device, workdir + "/tree", salt=b"salt")
+    >>> tree.data_blocks, os.path.getsize(tree.path) // BLOCK_SIZE
+    (200, 3)
+    >>> tree.differences(device)
+    []
+
+    >>> with open(device, "r+b") as f:
+    ...     _ = f.seek(BLOCK_SIZE * 10)
+    ...     _ = f.write(b"corrupted")
+    ...     _ = f.seek(BLOCK_SIZE * 11)
+    ...     _ = f.write(b"corrupted")
+    >>> tree.differences(device)
+    [(40960, 8192)]
+    """
+    path = None
+    root_hash = None
+    salt = None
+    data_blocks = None
+
+    def __init__(self, path, root_hash, salt, data_blocks):
+        self.path = path
+        self.root_hash = root_hash
+        self.salt = salt
+        self.data_blocks = data_blocks
+
+    @classmethod
+    def build(cls, device, path, salt=None):
+        """Hash the blocks of device, and write the tree to path
+        """
+        salt = os.urandom(DIGEST_SIZE) if salt is None else salt
+        data_blocks = _device_blocks(device)
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        digests = _block_digests(device, salt)
+        levels = []
+        try:
+            for _ in level_blocks(data_blocks):
+                level = tempfile.NamedTemporaryFile(dir=directory,
+                                                    delete=False)
+                with level:
+                    _pack(digests, level)
+                levels.append(level.name)
+                digests = _block_digests(level.name, salt)
+            # The single block of the top level (or data block) remains
+            root_hash = next(digests)
+
+            with open(path + ".tmp", "wb") as dst:
+                for level in reversed(levels):
+                    with open(level, "rb") as src:
+                        while True:
+                            data = src.read(BLOCK_SIZE * 256)
+                            if not data:
+                                break
+                            dst.write(data)
+                dst.flush()
+                os.fsync(dst.fileno())
+            os.rename(path + ".tmp", path)
+        finally:
+            for level in levels:
+                os.unlink(level)
+        return cls(path, root_hash, salt, data_blocks)
+
+    def _leaf_offset(self):
+        return sum(level_blocks(self.data_blocks)[1:]) * BLOCK_SIZE
+
+    def _leaf_digests(self):
+        """Yields the stored digests of the data blocks
+        """
+        if not self.data_blocks > 1:
+            return
+        with open(self.path, "rb") as src:
+            src.seek(self._leaf_offset())
+            remaining = self.data_blocks
+            while remaining:
+                data = src.read(BLOCK_SIZE)
+                if len(data) < BLOCK_SIZE:
+                    raise VerityError("The hash tree %s is truncated" %
+                                      self.path)
+                n = min(remaining, HASHES_PER_BLOCK)
+                for pos in range(0, n * DIGEST_SIZE, DIGEST_SIZE):
+                    yield data[pos:pos + DIGEST_SIZE]
+                remaining -= n
+
+    def is_intact(self):
+        """True if the stored levels lead to the root hash
+        """
+        levels = level_blocks(self.data_blocks)
+        if not levels:
+            return True
+        try:
+            with tempfile.NamedTemporaryFile(dir=os.path.dirname(self.path)) \
+                    as rest:
+                # The leaves are verified by rebuilding the levels above
+                digests = _block_digests(self.path, self.salt,
+                                         self._leaf_offset(), levels[0])
+                for _ in levels[1:]:
+                    rest.seek(0)
+                    rest.truncate()
+                    _pack(digests, rest)
+                    rest.flush()
+                    digests = list(_block_digests(rest.name, self.salt))
+                return next(iter(digests)) == self.root_hash
+        except (IOError, OSError, StopIteration):
+            return False
+
+    def differences(self, device):
+        """Returns the (offset, length) of the regions of device which
+        differ from the tree, an empty list if it matches
+        """
+        if _device_blocks(device) != self.data_blocks:
+            raise VerityError("The size of %s changed" % device)
+        regions = []
+        current = self._leaf_digests() if self.data_blocks > 1 \
+            else iter([self.root_hash])
+        actual = _block_digests(device, self.salt)
+        for idx, (expected, digest) in enumerate(zip(current, actual)):
+            if expected == digest:
+                continue
+            offset = idx * BLOCK_SIZE
+            if regions and sum(regions[-1]) == offset:
+                regions[-1] = (regions[-1][0], regions[-1][1] + BLOCK_SIZE)
+            else:
+                regions.append((offset, BLOCK_SIZE))
+        return regions
+
+
+def tree_path(lv):
+    return os.path.join(constants.IMGBASED_VERITY_DIR,
+                        "%s.hashtree" % lv.lv_name)
+
+
+def _tag_value(tags, prefix):
+    values = [t.strip()[len(prefix):] for t in tags
+              if t.strip().startswith(prefix)]
+    return values[0] if values else None
+
+
+def seal(lv):
+    """Compute the hash tree of a base, and tag it with the root hash
+    """
+    log.info("Computing the hash tree of %s" % lv.lv_name)
+    tree = HashTree.build(lv.path, tree_path(lv))
+    for tag in lv.tags():
+        if tag.strip().startswith((TAG_ROOT_HASH, TAG_SALT)):
+            lv.deltag(tag.strip())
+    lv.addtag(TAG_SALT + tree.salt.hex())
+    lv.addtag(TAG_ROOT_HASH + tree.root_hash.hex())
+    log.debug("Root hash of %s: %s" % (lv.lv_name, tree.root_hash.hex()))
+    return tree
+
+
+def sealed_tree(lv):
+    """Returns the hash tree of a base, or None if it was not sealed
+    """
+    tags = lv.tags()
+    root_hash = _tag_value(tags, TAG_ROOT_HASH)
+    salt = _tag_value(tags, TAG_SALT)
+    if root_hash is None or salt is None:
+        return None
+    data_blocks = _device_blocks(lv.path)
+    return HashTree(tree_path(lv), bytes.fromhex(root_hash),
+                    bytes.fromhex(salt), data_blocks)
+
+
+def verify(lv):
+    """Returns the regions of a base which differ from its root hash
+
+    Raises NotSealedError if the base was not sealed, and VerityError if
+    the stored tree is damaged as well and the regions can not be told
+    """
+    tree = sealed_tree(lv)
+    if tree is None:
+        raise NotSealedError("%s has no root hash" % lv.lv_name)
+    if tree.is_intact():
+        return tree.differences(lv.path)
+
+    rebuilt = HashTree.build(lv.path, tree.path + ".rebuilt", tree.salt)
+    if rebuilt.root_hash != tree.root_hash:
+        os.unlink(rebuilt.path)
+        raise VerityError("%s and its hash tree do not match the root hash"
+                          % lv.lv_name)
+    log.warning("The hash tree of %s was damaged, it was rebuilt" %
+                lv.lv_name)
+    os.rename(rebuilt.path, tree.path)
+    return []
+
+
+def verify_all(lvs, workers=4):
+    """Verify several bases in parallel, returns a list of (lv, regions,
+    error)
+    """
+    def check(lv):
+        try:
+            return (lv, verify(lv), None)
+        except (VerityError, IOError, OSError) as e:
+            return (lv, None, e)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(check, lvs))
+
+# vim: sw=4 et sts=4:
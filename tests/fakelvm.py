@@ -35,6 +35,10 @@ class FakeLVM(imgbased.lvm.LVM):
         debug("LVS %s" % lvs)
         return [lv.lvm_name for lv in lvs]
 
+    @staticmethod
+    def _list_lv_tags(filtr=""):
+        return dict((lv.lvm_name, list(lv.tags())) for lv in FakeLVM.lvs())
+
     @staticmethod
     def lvs():
         lvs = []
@@ -204,4 +208,7 @@ class FakeLVM(imgbased.lvm.LVM):
         def check_metadata_size(self, resize=False):
             pass
 
+        def metadata_usage(self):
+            return 10.0, 1024 ** 3, 64 * 1024
+
 # vim: et ts=4 sw=4 sts=4
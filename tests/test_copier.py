@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# vim: et ts=4 sw=4 sts=4
+
+import os
+import stat
+
+import pytest
+from imgbased.copier import TreeCopier
+
+
+@pytest.fixture
+def tree(tmpdir):
+    src = tmpdir.mkdir("src")
+    src.mkdir("usr").mkdir("bin")
+
+    exe = src.join("usr", "bin", "sudo")
+    exe.write_binary(os.urandom(1024 * 1024))
+    exe.chmod(0o4711)
+
+    with open(str(src.join("usr", "sparse")), "wb") as f:
+        f.seek(64 * 1024 * 1024)
+        f.write(b"end")
+
+    os.link(str(exe), str(src.join("usr", "bin", "sudoedit")))
+    os.symlink("bin/sudo", str(src.join("usr", "sudo")))
+    os.utime(str(src.join("usr")), (1234567890, 1234567890))
+
+    return str(src), str(tmpdir.mkdir("dst"))
+
+
+def test_copy_preserves_content_and_metadata(tree):
+    src, dst = tree
+    stats = TreeCopier(workers=4).sync(src, dst)
+
+    assert stats.files == 2
+    assert stats.hardlinks == 1
+    for path in ["/usr", "/usr/bin/sudo", "/usr/sparse", "/usr/sudo"]:
+        a, b = os.lstat(src + path), os.lstat(dst + path)
+        assert (a.st_mode, a.st_uid, a.st_gid, a.st_size, a.st_mtime_ns) == \
+            (b.st_mode, b.st_uid, b.st_gid, b.st_size, b.st_mtime_ns)
+
+    with open(src + "/usr/bin/sudo", "rb") as a, \
+            open(dst + "/usr/bin/sudo", "rb") as b:
+        assert a.read() == b.read()
+    assert stat.S_IMODE(os.stat(dst + "/usr/bin/sudo").st_mode) == 0o4711
+    assert os.path.samefile(dst + "/usr/bin/sudo", dst + "/usr/bin/sudoedit")
+
+
+@pytest.mark.skipif(os.getuid() != 0, reason="Changing owners needs root")
+def test_copy_writes_mapped_owners(tree):
+    src, dst = tree
+    uid, gid = os.getuid(), os.getgid()
+    TreeCopier(workers=2, owners=({uid: 4242}, {gid: 4343})).sync(src, dst)
+
+    for path in ["/usr", "/usr/bin/sudo", "/usr/sudo"]:
+        st = os.lstat(dst + path)
+        assert (st.st_uid, st.st_gid) == (4242, 4343)
+    assert stat.S_IMODE(os.stat(dst + "/usr/bin/sudo").st_mode) == 0o4711
+
+    # A mirror only rewrites owners which differ from the mapped ones
+    stats = TreeCopier(workers=2, mirror=True,
+                       owners=({uid: 4242}, {gid: 4343})).sync(src, dst)
+    assert stats.written == 0
+
+
+def test_copy_keeps_holes(tree):
+    src, dst = tree
+    TreeCopier(workers=1).sync(src, dst)
+
+    st = os.stat(dst + "/usr/sparse")
+    assert st.st_blocks * 512 < st.st_size
+    with open(dst + "/usr/sparse", "rb") as f:
+        f.seek(st.st_size - 3)
+        assert f.read() == b"end"
+
+
+def test_copy_raises_on_failure(tree):
+    src, dst = tree
+    os.makedirs(dst + "/usr/sudo")
+
+    with pytest.raises(OSError):
+        TreeCopier(workers=2).sync(src, dst)
+
+
+def test_copy_reports_bytes_within_files(tree):
+    src, dst = tree
+    copier = TreeCopier(workers=1)
+    copier._chunk_size = 64 * 1024
+    seen = []
+    copier.on_progress = lambda n: seen.append((copier.stats.copied,
+                                                copier.stats.files))
+    stats = copier.sync(src, dst)
+
+    # sudo is 16 chunks, each of them is reported before the file is done
+    done = [files for copied, files in seen]
+    assert 16 in [done.count(files) for files in done]
+    assert seen == sorted(seen)
+    assert stats.copied == stats.bytes
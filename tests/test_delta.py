@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+# vim: et ts=4 sw=4 sts=4
+
+import os
+
+import pytest
+from imgbased.delta import (DeltaChecksumError, DeltaPayload, create_delta,
+                            tree_checksum)
+
+
+@pytest.fixture
+def trees(tmpdir):
+    old, new = tmpdir.mkdir("old"), tmpdir.mkdir("new")
+    for root in [old, new]:
+        root.mkdir("etc").mkdir("ssh")
+        root.mkdir("usr").join("motd").write("Hello")
+    old.join("etc", "ssh", "moduli").write("1024")
+    new.join("etc", "ssh", "sshd_config").write("PermitRootLogin no")
+    new.join("usr", "motd").write("Bye")
+    for root in [old, new]:
+        for path in ["etc", "etc/ssh", "usr", "usr/motd"]:
+            os.utime(str(root.join(path)), (0, 0))
+    return str(old), str(new), tmpdir
+
+
+def test_delta_roundtrip(trees):
+    old, new, tmpdir = trees
+    payload = str(tmpdir.join("delta.tar.xz"))
+    create_delta(old, new, "Image-1.0-0", "Image-2.0-0", payload)
+
+    chunks = []
+    delta = DeltaPayload.extract(payload, str(tmpdir.mkdir("unpacked")),
+                                 chunks.append)
+    with open(payload, "rb") as f:
+        assert b"".join(chunks) == f.read()
+    assert delta.manifest["from"] == "Image-1.0-0"
+    assert delta.manifest["to"] == "Image-2.0-0"
+    assert delta.manifest["removed"] == ["etc/ssh/moduli"]
+    assert delta.manifest["checksum"] == tree_checksum(new)
+
+    with open(delta.tree + "/usr/motd") as f:
+        assert f.read() == "Bye"
+    assert os.path.exists(delta.tree + "/etc/ssh/sshd_config")
+    assert os.stat(delta.tree + "/etc/ssh").st_mtime == \
+        os.stat(new + "/etc/ssh").st_mtime
+
+    delta.verify(new)
+    with pytest.raises(DeltaChecksumError):
+        delta.verify(old)
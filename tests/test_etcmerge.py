@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# vim: et ts=4 sw=4 sts=4
+
+import os
+
+import pytest
+from imgbased.etcmerge import EtcMerge, scan
+
+
+def _write(root, path, data):
+    path = os.path.join(root, path)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, "w") as f:
+        f.write(data)
+
+
+@pytest.fixture
+def layers(tmpdir):
+    old, new = str(tmpdir.mkdir("old")), str(tmpdir.mkdir("new"))
+    for root, version in [(old, "1"), (new, "2")]:
+        for etc in ["etc", "usr/share/factory/etc"]:
+            _write(root, etc + "/passwd", "root:x:0:0:%s" % version)
+            _write(root, etc + "/issue", "Release %s" % version)
+            _write(root, etc + "/selinux/targeted/active/modules/a", "")
+            for target in ["multi-user", "basic"]:
+                os.makedirs(os.path.join(root, etc, "systemd/system",
+                                         target + ".target.wants"))
+    return old, new
+
+
+def test_critical_files_are_not_restored(layers):
+    old, new = layers
+    _write(new, "etc/passwd", "root:x:0:0:merged")
+
+    decisions = EtcMerge(old, new).plan()
+    assert [(d.action, d.path) for d in decisions] == [("keep", "issue")]
+
+
+def test_update_restores_factory(layers):
+    old, new = layers
+    _write(new, "etc/issue", "Release 1")
+
+    merge = EtcMerge(old, new)
+    decisions = merge.plan()
+    assert [(d.action, d.path) for d in decisions] == [("factory", "issue")]
+
+    merge.apply(decisions)
+    assert open(new + "/etc/issue").read() == "Release 2"
+
+
+def test_user_changes_are_copied(layers):
+    old, new = layers
+    _write(old, "etc/issue", "Welcome")
+    _write(old, "etc/selinux/targeted/active/modules/a", "local")
+    _write(old, "etc/sysconfig/custom/settings", "a=b")
+
+    merge = EtcMerge(old, new)
+    decisions = merge.plan()
+    assert [(d.action, d.path) for d in decisions] == [
+        ("copy", "issue"),
+        ("imgnew", "issue"),
+        ("keep", "selinux/targeted/active/modules/a"),
+        ("copy", "sysconfig")]
+
+    merge.apply(decisions)
+    assert open(new + "/etc/issue").read() == "Welcome"
+    assert open(new + "/etc/issue.imgnew").read() == "Release 2"
+    assert open(new + "/etc/sysconfig/custom/settings").read() == "a=b"
+    assert open(new + "/etc/selinux/targeted/active/modules/a").read() == ""
+
+
+def test_excluded_directories_are_not_copied(layers):
+    old, new = layers
+    _write(old, "etc/selinux/targeted/active/modules/400/local/cil", "x")
+
+    merge = EtcMerge(old, new)
+    decisions = merge.plan()
+    assert [(d.action, d.path) for d in decisions
+            if d.path.startswith("selinux")] == [
+        ("keep", "selinux/targeted/active/modules/400/local/cil")]
+
+    merge.apply(decisions)
+    assert not os.path.exists(new + "/etc/selinux/targeted/active/"
+                              "modules/400")
+
+
+def test_disabled_units_stay_disabled(layers):
+    old, new = layers
+    wants = "systemd/system/%s.target.wants/firewalld.service"
+    for etc in ["etc", "usr/share/factory/etc"]:
+        os.symlink("/usr/lib/systemd/system/firewalld.service",
+                   os.path.join(old, etc, wants % "basic"))
+    # The new image moved the unit to another target
+    os.symlink("/usr/lib/systemd/system/firewalld.service",
+               os.path.join(new, "etc", wants % "multi-user"))
+    os.unlink(os.path.join(old, "etc", wants % "basic"))
+
+    merge = EtcMerge(old, new, subtree="systemd")
+    decisions = merge.plan()
+    assert [(d.action, d.path) for d in decisions] == [
+        ("remove", wants % "multi-user")]
+
+    merge.apply(decisions)
+    assert wants % "multi-user" not in scan(new + "/etc")
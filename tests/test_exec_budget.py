@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+# vim: et ts=4 sw=4 sts=4
+
+"""Guard the number of external commands spawned by each verb
+
+Performance regressions in imgbased tend to show up as additional
+lvs/grubby/rpm invocations.  Every verb below is run against a synthetic
+layout (built with FakeLVM) and all commands which would have been executed
+are recorded instead of being run.  The calls into FakeLVM are recorded as
+the lvs, lvcreate, lvremove, ... which LVM would have spawned.
+"""
+
+import logging
+import sys
+from collections import Counter
+from io import StringIO
+
+import pytest
+from fakelvm import FakeLVM
+from imgbased import CliApplication
+from imgbased.imgbase import ImageLayers
+from imgbased.naming import Image
+
+log = logging.debug
+
+
+# The checked-in budget: the maximum number of calls per binary for each
+# verb.  Binaries which are not listed must not be called at all.
+EXEC_BUDGET = {
+    "layout": {"lvs": 1},
+    "w": {},
+    "check": {"grubby": 2, "findmnt": 2, "lvs": 1, "vgs": 1},
+    "layer --add": {"lvs": 2, "vgs": 2, "lvcreate": 1, "lvchange": 5},
+    # Per layer of the base: an lvchange and an lvremove
+    "base --remove": {"lvs": 1, "vgs": 3, "lvchange": 3, "lvremove": 3},
+    "rollback": {"lvs": 2, "grubby": 2, "grub2-editenv": 1},
+    "recover --list": {"lvs": 1, "grubby": 1},
+}
+
+VERBS = {
+    "layout": ["layout"],
+    "w": ["w"],
+    "check": ["check"],
+    "layer --add": ["layer", "--add"],
+    "base --remove": ["base", "--remove", "Image-1.0-0"],
+    "rollback": ["rollback"],
+    "recover --list": ["--experimental", "recover", "--list"],
+}
+
+LAYERS_PER_BASE = 2
+
+# FakeLVM keeps the layout in memory, its entry points are counted as the
+# binary the real LVM class spawns for them
+LVM_BINARIES = [
+    (FakeLVM, "_list_lv_full_names", "lvs"),
+    (FakeLVM, "_list_lv_tags", "lvs"),
+    (FakeLVM.VG, "find_by_tag", "vgs"),
+    (FakeLVM.VG, "tags", "vgs"),
+    (FakeLVM.VG, "addtag", "vgchange"),
+    (FakeLVM.LV, "find_by_tag", "vgs"),
+    (FakeLVM.LV, "tags", "lvs"),
+    (FakeLVM.LV, "thinpool", "lvs"),
+    (FakeLVM.LV, "create_snapshot", "lvcreate"),
+    (FakeLVM.LV, "remove", "lvremove"),
+    (FakeLVM.LV, "activate", "lvchange"),
+    (FakeLVM.LV, "setactivationskip", "lvchange"),
+    (FakeLVM.LV, "permission", "lvchange"),
+    (FakeLVM.LV, "addtag", "lvchange"),
+    (FakeLVM.Thinpool, "create_thinvol", "lvcreate"),
+    (FakeLVM.Thinpool, "metadata_usage", "lvs"),
+]
+_LVM_ORIGINALS = dict(((cls, name), cls.__dict__[name])
+                      for cls, name, _ in LVM_BINARIES)
+
+
+class CountingExternalBinary(object):
+    """Stands in for ExternalBinary.call and command.call
+
+    Nothing is executed, the binary of each call is just recorded.
+    """
+    def __init__(self, layers):
+        self.calls = []
+        self.layers = layers
+        self._nested = False
+
+    def _grubby_info(self):
+        entries = []
+        for idx, layer in enumerate(self.layers):
+            entries.append("index=%d\n"
+                           "kernel=/boot/%s/vmlinuz-3.10.0-1.el7.x86_64\n"
+                           "args=\"ro quiet img.bootid=%s\"\n"
+                           "root=/dev/hostvg/%s\n"
+                           "initrd=/boot/%s/initramfs-3.10.0-1.el7.x86_64."
+                           "img\n"
+                           "title=ovirt-node %s\n" %
+                           (idx, layer, layer, layer, layer, layer))
+        return "".join(entries)
+
+    def _stdout_for(self, cmd):
+        if cmd[0] == "grubby" and "--info=ALL" in cmd:
+            return self._grubby_info()
+        if cmd[0] == "lvs":
+            return "10.00 5.00"
+        if cmd[0] == "findmnt":
+            return "rw,relatime,discard"
+        return ""
+
+    def external_binary_call(self, cmd, **kwargs):
+        log("Counting: %s" % cmd)
+        self.calls.append(cmd[0])
+        return self._stdout_for(cmd)
+
+    def command_call(self, cmd, **kwargs):
+        return self.external_binary_call(cmd).encode()
+
+    def counts(self):
+        return Counter(self.calls)
+
+    def counted(self, binary, func):
+        """Returns func, which records a call of binary when called
+
+        FakeLVM calls its own entry points, only the outermost call is
+        one the real LVM spawns a binary for.
+        """
+        static = isinstance(func, staticmethod)
+        func = func.__func__ if static else func
+
+        def _counted(*args, **kwargs):
+            if self._nested:
+                return func(*args, **kwargs)
+            log("Counting: %s (%s)" % (binary, func.__name__))
+            self.calls.append(binary)
+            self._nested = True
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._nested = False
+        return staticmethod(_counted) if static else _counted
+
+
+def _fake_layout(num_bases, num_layers):
+    vg = FakeLVM.VG("hostvg")
+    vg._pvs = ["/dev/sda"]
+    vg.addtag(ImageLayers.vg_tag)
+    FakeLVM._vgs = [vg]
+
+    pool = FakeLVM.Thinpool()
+    pool.vg_name = vg.vg_name
+    pool.lv_name = "pool0"
+    pool.addtag(ImageLayers.thinpool_tag)
+    vg._lvs.add(pool)
+
+    layers = []
+    for b in range(1, num_bases + 1):
+        base = pool.create_thinvol("Image-%d.0-0" % b, 10)
+        base.addtag(ImageLayers.lv_base_tag)
+        for idx in range(1, num_layers + 1):
+            layer = base.create_snapshot("%s+%d" % (base.lv_name, idx))
+            layer.addtag(ImageLayers.lv_layer_tag)
+            layers.append(layer.lv_name)
+    return layers
+
+
+@pytest.fixture
+def exec_counter(mocker, tmpdir):
+    def _counter(num_bases):
+        layers = _fake_layout(num_bases, LAYERS_PER_BASE)
+        counter = CountingExternalBinary(layers)
+
+        grubcfg = tmpdir.join("grub.cfg")
+        grubcfg.write("# fake grub.cfg\n")
+        tmpdir.join("grubenv").write("#" * 1024)
+
+        mocker.patch("imgbased.utils.subprocess")
+        mocker.patch("imgbased.command.subprocess")
+        mocker.patch("imgbased.utils.ExternalBinary.call",
+                     counter.external_binary_call)
+        mocker.patch("imgbased.command.call", counter.command_call)
+        mocker.patch("imgbased.utils.grub_cfg_path",
+                     return_value=str(grubcfg))
+        mocker.patch("imgbased.lvm.LVM", FakeLVM)
+        mocker.patch("imgbased.imgbase.LVM", FakeLVM)
+        mocker.patch("imgbased.volume.LVM", FakeLVM)
+        for cls, name, binary in LVM_BINARIES:
+            mocker.patch.object(cls, name, counter.counted(
+                binary, _LVM_ORIGINALS[(cls, name)]))
+        mocker.patch("imgbased.imgbase.Hooks")
+        mocker.patch("imgbased.imgbase.utils.Filesystem")
+        mocker.patch("imgbased.volume.Filesystem")
+        mocker.patch("imgbased.plugins.core.volume_paths",
+                     return_value={"/var": {}})
+        mocker.patch("imgbased.plugins.recover.volume_paths",
+                     return_value={"/var": {}})
+        mocker.patch("os.path.ismount", return_value=True)
+        mocker.patch("imgbased.imgbase.ImageLayers.current_layer",
+                     lambda s: Image.from_nvr(layers[-1]))
+        return counter
+
+    return _counter
+
+
+def _run(counter, args):
+    oldargv, oldout = sys.argv, sys.stdout
+    # Plugins look at sys.argv to find out if --experimental is set
+    sys.argv = ["imgbase"] + args
+    sys.stdout = StringIO()
+    try:
+        CliApplication(args)
+    finally:
+        sys.argv, sys.stdout = oldargv, oldout
+    return counter.counts()
+
+
+@pytest.mark.parametrize("verb", sorted(VERBS))
+def test_verb_within_budget(exec_counter, verb):
+    """Test that a verb does not spawn more commands than budgeted"""
+    counts = _run(exec_counter(3), VERBS[verb])
+    budget = EXEC_BUDGET[verb]
+
+    over = dict((binary, count) for binary, count in counts.items()
+                if count > budget.get(binary, 0))
+    assert not over, \
+        "%r exceeds its exec budget %s: %s" % (verb, budget, dict(counts))
+
+
+@pytest.mark.parametrize("verb", sorted(VERBS))
+def test_verb_does_not_scale_with_bases(exec_counter, verb):
+    """Test that the number of commands does not grow with the bases"""
+    few = _run(exec_counter(2), VERBS[verb])
+    many = _run(exec_counter(6), VERBS[verb])
+
+    assert few == many, \
+        "%r spawns more commands with more bases: %s vs %s" % \
+        (verb, dict(few), dict(many))
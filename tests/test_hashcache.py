@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# vim: et ts=4 sw=4 sts=4
+
+import hashlib
+
+import pytest
+from imgbased import hashcache
+from imgbased.hashcache import HashCache
+
+
+@pytest.fixture
+def files(tmpdir):
+    paths = []
+    for idx in range(4):
+        f = tmpdir.join("file%d" % idx)
+        f.write("content %d" % idx)
+        paths.append(str(f))
+    yield paths
+    HashCache.stop()
+
+
+def _sha256(data):
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+def test_digests_in_threads(files, mocker):
+    mocker.patch("imgbased.hashcache.PARALLEL_BYTES", 0)
+    pool = mocker.spy(hashcache, "ThreadPoolExecutor")
+
+    assert hashcache.digests(files, workers=2) == \
+        {p: _sha256("content %d" % i) for i, p in enumerate(files)}
+    assert pool.call_count == 1
+
+
+def test_cached_files_are_not_read(files, tmpdir, mocker):
+    HashCache.start(str(tmpdir.join("hash-cache")))
+    hashcache.digests(files)
+    HashCache.stop()
+
+    HashCache.start(str(tmpdir.join("hash-cache")))
+    sha256sum = mocker.spy(hashcache, "sha256sum")
+    with open(files[0], "a") as f:
+        f.write(" changed")
+
+    digests = hashcache.digests(files)
+    assert digests[files[0]] == _sha256("content 0 changed")
+    assert digests[files[1]] == _sha256("content 1")
+    sha256sum.assert_called_once_with(files[0])
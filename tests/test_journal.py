@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# vim: et ts=4 sw=4 sts=4
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from imgbased.etcmerge import EtcMerge
+from imgbased.journal import Journal
+from imgbased.plugins import osupdater
+
+
+@pytest.fixture
+def journal(tmpdir):
+    yield Journal.start("Image-2.0-0.squashfs.img", str(tmpdir.join("j")))
+    Journal.stop()
+
+
+def _write(root, path, data):
+    path = os.path.join(root, path)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, "w") as f:
+        f.write(data)
+
+
+def test_record_from_threads(journal):
+    def record(idx):
+        osupdater.journal.record("step-%d" % (idx % 2), "created",
+                                 ["/var/%d" % idx])
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        list(pool.map(record, range(20)))
+
+    assert len(journal.paths()) == 20
+    assert len(journal.changes(step="step-1")) == 10
+
+
+def test_record_decisions(journal, tmpdir):
+    old, new = str(tmpdir.mkdir("old")), str(tmpdir.mkdir("new"))
+    for root, version in [(old, "1"), (new, "2")]:
+        for etc in ["etc", "usr/share/factory/etc"]:
+            _write(root, etc + "/chrony.conf", "pool %s" % version)
+    _write(old, "etc/chrony.conf", "server ntp")
+    _write(old, "etc/hostname", "node")
+
+    merge = EtcMerge(old, new)
+    decisions = merge.plan()
+    merge.apply(decisions)
+    osupdater.record_decisions("remediate-etc", merge, decisions)
+
+    assert [tuple(c) for c in journal.changes()] == [
+        ("/etc/chrony.conf.imgnew", "created", "remediate-etc",
+         "changed by the update too"),
+        ("/etc/hostname", "created", "remediate-etc", "changed by the user"),
+        ("/etc/chrony.conf", "modified", "remediate-etc",
+         "changed by the user")]
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# vim: et ts=4 sw=4 sts=4
+
+import os
+
+import pytest
+from imgbased import manifest
+from imgbased.etcmerge import EtcMerge
+from imgbased.manifest import Manifest
+
+
+def _write(root, path, data, mode=0o644):
+    path = os.path.join(root, path)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, "w") as f:
+        f.write(data)
+    os.chmod(path, mode)
+
+
+@pytest.fixture
+def image(tmpdir, mocker):
+    mocker.patch("imgbased.manifest.rpm_files",
+                 return_value={"/usr/bin/ping": ("iputils", ""),
+                               "/etc/issue": ("setup", "cn"),
+                               "/var/log/lastlog": ("systemd", "g")})
+    root = str(tmpdir.mkdir("image"))
+    gid = os.getgid()
+    for etc in ["etc", "usr/share/factory/etc"]:
+        _write(root, etc + "/issue", "Release 2")
+        _write(root, etc + "/group", "root:x:0:\nusers:x:%d:\n" % gid)
+    _write(root, "usr/bin/ping", "ELF", 0o4755)
+    os.makedirs(root + "/proc/1")
+    manifest.build(root)
+    return root
+
+
+def test_build(image):
+    m = Manifest.open(image)
+    assert m.get("/proc/1") is None
+    assert m.get("/usr/share/imgbased/manifest") is None
+
+    ping = m.get("/usr/bin/ping")
+    assert (ping["type"], ping["mode"], ping["rpm"]) == \
+        ("file", 0o4755, "iputils")
+    assert ping["sha256"] == \
+        "706abe3c90152075e656b661079730facf323f3ebccda7547ee1935c90845a09"
+    assert [r["path"] for r in m.packaged()] == ["/etc/issue",
+                                                 "/usr/bin/ping"]
+
+
+def test_merge_reads_the_new_image(image, tmpdir):
+    old = str(tmpdir.mkdir("old"))
+    for etc in ["etc", "usr/share/factory/etc"]:
+        _write(old, etc + "/issue", "Release 1")
+    _write(image, "etc/issue", "Changed after the build")
+
+    merge = EtcMerge(old, image, manifest=Manifest.open(image))
+    assert merge.new["issue"].same(merge.new_factory["issue"])
+    assert [(d.action, d.path) for d in merge.plan()] == \
+        [("keep", "issue")]
@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+# vim: et ts=4 sw=4 sts=4
+
+import os
+
+import pytest
+from imgbased.checkpoint import Checkpoint
+from imgbased.journal import Journal
+from imgbased.plugins import osupdater
+from imgbased.plugins.update import LiveimgExtractor, \
+    UpdateConfigurationSection
+from imgbased.utils import IDMap, IDRegistry
+
+
+def test_migrate_rpm_files(tmpdir, mocker):
+    new_root = tmpdir.mkdir("new")
+    live = tmpdir.mkdir("live")
+    files = {"noreplace.conf": "cn", "ghost.log": "g", "data": "",
+             "same": "", "unowned": None}
+    for name in files:
+        live.join(name).write("old")
+        new_root.join(str(live), name).write("new", ensure=True)
+    new_root.join(str(live), "same").write("old")
+    mocker.patch("imgbased.plugins.osupdater.rpm_files",
+                 return_value={str(live.join(n)): ("pkg", f)
+                               for n, f in files.items() if f is not None})
+
+    osupdater.migrate_rpm_files(str(new_root),
+                                [str(live.join(n)) for n in files])
+
+    assert sorted(os.listdir(str(live))) == [
+        "data", "data.imgbak", "ghost.log", "noreplace.conf",
+        "noreplace.conf.imgnew", "same", "unowned"]
+    assert live.join("data").read() == "new"
+    assert live.join("noreplace.conf").read() == "old"
+    assert live.join("unowned").read() == "old"
+
+
+@pytest.mark.skipif(os.getuid() != 0, reason="Changing owners needs root")
+def test_fix_drift(tmpdir, mocker):
+    mocker.patch.object(IDMap, "get_drift",
+                        return_value=([(1001, 2001)], [(1002, 2002)]))
+    root = tmpdir.mkdir("root")
+    root.mkdir("usr").mkdir("bin").join("tool").write("")
+    root.mkdir("var").join("state").write("")
+    tool = str(root.join("usr", "bin", "tool"))
+    os.chown(tool, 2001, 2002)
+    os.chmod(tool, 0o4755)
+    os.symlink("tool", str(root.join("usr", "bin", "link")))
+    os.lchown(str(root.join("usr", "bin", "link")), 2001, 0)
+    os.chown(str(root.join("var")), 0, 2002)
+
+    changed = IDMap(None, None).fix_drift(str(root), workers=2)
+
+    assert sorted(changed) == [str(root.join(p)) for p in
+                               ["usr/bin/link", "usr/bin/tool", "var"]]
+    st = os.lstat(tool)
+    assert (st.st_uid, st.st_gid, st.st_mode & 0o7777) == \
+        (1001, 1002, 0o4755)
+    assert os.lstat(str(root.join("usr", "bin", "link"))).st_uid == 1001
+
+    # Only the given paths are looked at
+    os.chown(tool, 2001, 2002)
+    os.chown(str(root.join("var", "state")), 2001, 0)
+    assert IDMap(None, None).fix_drift(str(root), paths=["/var/state"]) \
+        == [str(root.join("var", "state"))]
+
+
+def _accounts(etc, sshd, tss):
+    etc.join("passwd").write("root:x:0:0::/root:/bin/bash\n"
+                             "sshd:x:%d:%d::/:/sbin/nologin\n"
+                             "tss:x:%d:%d::/:/sbin/nologin\n" %
+                             (sshd, sshd, tss, tss))
+    etc.join("group").write("root:x:0:\nsshd:x:%d:\ntss:x:%d:\n" %
+                            (sshd, tss))
+
+
+def test_idmap_registry(tmpdir, mocker):
+    old, new = tmpdir.mkdir("old"), tmpdir.mkdir("new")
+    old.join("passwd").write("root:x:0:0::/root:/bin/bash\n"
+                             "sshd:x:74:74::/:/sbin/nologin\n")
+    old.join("group").write("root:x:0:\nsshd:x:74:\n")
+    _accounts(new, 75, 74)
+    path = str(tmpdir.join("idmap.json"))
+
+    first = IDMap(str(old), str(new), IDRegistry(path))
+    assert first.get_drift() == ([(74, 75), (75, 74)], [(74, 75), (75, 74)])
+    # Only the caller records the registry, once the drift was fixed
+    assert not os.path.exists(path)
+    IDRegistry(path).record(str(new), first.passwd_content,
+                            first.group_content)
+    assert IDRegistry(path).users == {"root": [0, 0], "sshd": [75, 74],
+                                      "tss": [74, 75]}
+
+    # The next image brings the same factory ids
+    old.join("passwd").write(first.passwd_content)
+    old.join("group").write(first.group_content)
+    merge_ids = mocker.spy(IDMap, "_merge_ids")
+    second = IDMap(str(old), str(new), IDRegistry(path))
+    assert second.get_drift() == first.get_drift()
+    assert second.passwd_content == first.passwd_content
+    assert merge_ids.call_count == 0
+
+    # An account which moved in the image is merged again
+    _accounts(new, 76, 74)
+    assert IDMap(str(old), str(new), IDRegistry(path)).has_drift()
+    assert merge_ids.call_count == 2
+
+
+def test_known_drift_is_not_fixed_again(tmpdir, mocker):
+    running, image = tmpdir.mkdir("running"), tmpdir.mkdir("image")
+    factory = image.mkdir("usr").mkdir("share").mkdir("factory").mkdir("etc")
+    running.join("passwd").write("root:x:0:0::/root:/bin/bash\n"
+                                 "sshd:x:74:74::/:/sbin/nologin\n")
+    running.join("group").write("root:x:0:\nsshd:x:74:\n")
+    _accounts(factory, 75, 74)
+    mocker.patch("imgbased.constants.IMGBASED_IDMAP_REGISTRY",
+                 str(tmpdir.join("idmap.json")))
+    known = IDRegistry.known
+    mocker.patch.object(IDRegistry, "known", autospec=True,
+                        side_effect=lambda self, _, to_etc:
+                        known(self, str(running), to_etc))
+    mocker.patch("imgbased.plugins.osupdater.Manifest.open",
+                 return_value=None)
+    fix = mocker.patch.object(IDMap, "fix_drift", return_value=[])
+    imgbase = mocker.Mock()
+    imgbase.config.section.return_value = UpdateConfigurationSection()
+    extractor = LiveimgExtractor(imgbase)
+
+    Checkpoint.start(str(tmpdir.join("checkpoint")), "Image-2.0-0.0")
+    try:
+        owners = []
+        for update in range(2):
+            owners.append(extractor._settled_owners(str(image)))
+            # migrate-etc
+            idmaps = IDMap(str(running), str(factory), IDRegistry())
+            assert idmaps.has_drift()
+            osupdater.fix_drift(imgbase, idmaps, str(image))
+            IDRegistry().record(str(factory), idmaps.passwd_content,
+                                idmaps.group_content)
+            running.join("passwd").write(idmaps.passwd_content)
+            running.join("group").write(idmaps.group_content)
+    finally:
+        Checkpoint.active().stop()
+
+    assert owners == [None, ({75: 74, 74: 75}, {75: 74, 74: 75})]
+    assert fix.call_count == 1
+
+
+@pytest.mark.skipif(os.getuid() != 0, reason="Changing owners needs root")
+def test_restore_rpm_permissions(tmpdir, mocker):
+    root = tmpdir.mkdir("root")
+    root.mkdir("etc").join("passwd").write("root:x:0:0::/root:/bin/bash\n"
+                                           "tss:x:59:59::/:/sbin/nologin\n")
+    root.join("etc", "group").write("root:x:0:\ntss:x:59:\n")
+    for name in ["ping", "tpm", "ls", "unowned"]:
+        root.ensure("usr", "bin", name)
+        os.chmod(str(root.join("usr", "bin", name)), 0o755)
+    os.chown(str(root.join("usr", "bin", "tpm")), 0, 0)
+    mocker.patch("imgbased.plugins.osupdater.rpm_file_attrs",
+                 return_value={"/usr/bin/ping": (0o104755, "root", "root"),
+                               "/usr/bin/tpm": (0o100750, "tss", "tss"),
+                               "/usr/bin/ls": (0o100644, "root", "root")})
+
+    fixed = osupdater.restore_rpm_permissions(
+        str(root), ["/usr/bin/tpm", "/usr/bin/unowned"])
+
+    # ls was not touched by the drift fix and is not setuid
+    assert fixed == [str(root.join("usr", "bin", n)) for n in ["ping", "tpm"]]
+    st = os.lstat(str(root.join("usr", "bin", "tpm")))
+    assert (st.st_uid, st.st_gid, st.st_mode) == (59, 59, 0o100750)
+    assert os.lstat(str(root.join("usr", "bin", "ping"))).st_mode == 0o104755
+    assert os.lstat(str(root.join("usr", "bin", "ls"))).st_mode == 0o100755
+
+
+@pytest.fixture
+def relabel(tmpdir, mocker, monkeypatch):
+    monkeypatch.delenv("IMGBASED_DISABLE_THREADS", raising=False)
+    root = tmpdir.mkdir("root")
+    root.ensure("etc/selinux/targeted/contexts/files/file_contexts")
+    mocker.patch("imgbased.plugins.osupdater.chroot",
+                 return_value=b"usage: restorecon [-T nthreads] [-f file]")
+    domain = mocker.patch("imgbased.plugins.osupdater.SELinuxDomain")
+    runcon = domain.return_value.__enter__.return_value.runcon
+    runcon.return_value = "Relabeled /etc/ssh/sshd_config from a to b"
+    return root, runcon
+
+
+def test_relabel_selinux(relabel, mocker):
+    root, runcon = relabel
+    walk = mocker.patch("imgbased.plugins.osupdater.relabel_candidates")
+    root.ensure("etc/ssh", dir=True)
+    for path in ["root/.bashrc", "var/lib/new/state", "usr/bin/ping"]:
+        root.ensure(path)
+    mocker.patch("imgbased.plugins.osupdater.journal.Journal.active")
+    mocker.patch("imgbased.plugins.osupdater.journal.paths",
+                 lambda action: {"created": ["/root/.bashrc", "/root/gone",
+                                             "/var/lib/new",
+                                             "/var/lib/new/state"],
+                                 "modified": ["/etc/ssh"],
+                                 "chowned": ["/usr/bin/ping"]}[action])
+
+    osupdater.relabel_selinux(str(root), since=1000)
+
+    # The changes are taken from the journal, /var is not walked
+    assert walk.call_count == 0
+    # Without -R, /etc/ssh itself is labeled but not descended into
+    runcon.assert_called_once_with(
+        ["chroot", str(root), "restorecon", "-v", "-T", "0", "-f", "-"],
+        input=b"/etc/ssh\n/root/.bashrc\n/usr/bin/ping\n/var/lib/new\n"
+              b"/var/lib/new/state\n")
+
+
+def test_relabel_selinux_without_journal(relabel, mocker):
+    root, runcon = relabel
+    mocker.patch("imgbased.plugins.osupdater.relabel_candidates",
+                 return_value=["/etc/ssh", "/etc/ssh/sshd_config"])
+
+    osupdater.relabel_selinux(str(root), since=1000)
+
+    runcon.assert_called_once_with(
+        ["chroot", str(root), "restorecon", "-v", "-T", "0", "-f", "-"],
+        input=b"/etc/ssh\n/etc/ssh/sshd_config\n")
+
+
+def test_copy_var_entry_returns_created_paths(tmpdir):
+    src = tmpdir.mkdir("image").mkdir("new")
+    src.ensure("sub", "state")
+    os.symlink("sub", str(src.join("link")))
+    dst = str(tmpdir.join("var", "new"))
+    tmpdir.mkdir("var")
+
+    assert sorted(osupdater._copy_var_entry(str(src), dst, "dir")) == \
+        [dst, dst + "/link", dst + "/sub", dst + "/sub/state"]
+    assert osupdater._copy_var_entry(str(src.join("gone")),
+                                     dst + "/gone", "file") == []
+
+
+def test_journaled_records_what_tools_changed(tmpdir):
+    root = tmpdir.mkdir("root")
+    root.ensure("etc", dir=True)
+    root.ensure("usr", "bin", "tool")
+    Journal.start("Image-2.0-0", str(tmpdir.join("journal")))
+    try:
+        with osupdater.journaled("postprocess", str(root), ["/etc"]):
+            root.ensure("etc", "lvm", "lvm.conf")
+        assert Journal.active().paths("modified") == \
+            ["/etc", "/etc/lvm", "/etc/lvm/lvm.conf"]
+    finally:
+        Journal.stop()
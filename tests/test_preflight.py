@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+# vim: et ts=4 sw=4 sts=4
+
+import pytest
+from fakelvm import FakeLVM
+from imgbased.preflight import Preflight, PreflightError
+
+GiB = 1024 ** 3
+
+
+class FakeImageLayers(object):
+    def __init__(self, free):
+        self.free = free
+
+    def _thinpool(self):
+        return FakeLVM.Thinpool()
+
+    def free_space(self, units="m"):
+        assert units == "b"
+        return self.free
+
+
+@pytest.fixture
+def boot_free(mocker):
+    return mocker.patch.object(Preflight, "_boot_free",
+                               return_value=GiB)
+
+
+def test_preflight_passes(boot_free):
+    Preflight(FakeImageLayers(10 * GiB)).check(4 * GiB, 100 * 1024 ** 2)
+
+
+def test_preflight_reports_shortfall(boot_free):
+    boot_free.return_value = 100 * 1024 ** 2
+    preflight = Preflight(FakeImageLayers(4 * GiB))
+
+    with pytest.raises(PreflightError) as e:
+        preflight.check(4 * GiB, 100 * 1024 ** 2, ["Image-1.0-0"])
+
+    report = str(e.value)
+    assert "thinpool data" in report
+    assert "short by 409.6MiB" in report
+    assert "/boot" in report
+    assert "short by 100.0MiB" in report
+    assert "thinpool metadata" not in report
+    assert "--gc-first to remove Image-1.0-0" in report
@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+# vim: et ts=4 sw=4 sts=4
+
+import os
+
+import pytest
+from imgbased.plugins import osupdater
+from imgbased.prepare import PrepareCache
+
+
+@pytest.fixture
+def root(tmpdir, mocker):
+    mocker.patch("imgbased.constants.IMGBASED_PREPARE_DIR",
+                 str(tmpdir.join("prepare")))
+    root = tmpdir.mkdir("root")
+    etc = root.mkdir("etc")
+    factory = root.mkdir("usr").mkdir("share").mkdir("factory").mkdir("etc")
+    for d in [etc, factory]:
+        d.mkdir("ssh").join("sshd_config").write("PermitRootLogin no")
+        d.join("motd").write("Hello")
+        os.utime(str(d.join("motd")), (0, 0))
+    etc.join("ssh", "sshd_config").write("PermitRootLogin yes")
+    etc.join("hostname").write("node")
+    return str(root)
+
+
+def test_etc_changes(root):
+    assert sorted(osupdater.etc_changes(root)) == \
+        ["/etc/hostname", "/etc/ssh/sshd_config"]
+
+
+def test_prepared_etc_changes(root):
+    PrepareCache().store("etc-changes", "Image-1.0-0+1",
+                         osupdater._etc_fingerprint(root), ["/etc/prepared"])
+
+    assert osupdater.prepared_etc_changes("Image-1.0-0+1", root) == \
+        ["/etc/prepared"]
+    assert "/etc/hostname" in \
+        osupdater.prepared_etc_changes("Image-2.0-0+1", root)
+
+    # A change in /etc invalidates the prepared change set
+    with open(root + "/etc/motd", "w") as f:
+        f.write("Bye")
+    assert "/etc/motd" in \
+        osupdater.prepared_etc_changes("Image-1.0-0+1", root)
@@ -5,12 +5,15 @@ import logging
 import subprocess
 import sys
 from collections import namedtuple
+from contextlib import contextmanager
 from io import StringIO
 
 import pytest
 from fakelvm import FakeLVM
 import imgbased
-from imgbased import CliApplication, utils
+from imgbased import CliApplication, journal, utils
+from imgbased.journal import Journal
+from imgbased.timeline import Timeline
 
 log = logging.debug
 
@@ -149,6 +152,16 @@ def test_layout_layers(cli_runner):
     r = cli_runner("--debug", "layout", "--layers")
     assert r.stdout.strip() == "Image-1.0-0+1"
 
+
+def test_profile(cli_runner, mocker):
+    """ Test that --profile attributes time to plugins and hooks """
+    cprofile = mocker.patch("imgbased.profiling.cProfile.Profile")
+    r = cli_runner("--profile", "layout", "--bases")
+    assert not cprofile.called
+    assert r.stdout.strip() == "Image-1.0-0"
+    assert "imgbased.plugins.core" in r.stderr
+    assert "imgbased.plugins.core.post_argparse" in r.stderr
+
 # Base Verb Tests
 
 
@@ -185,10 +198,38 @@ def test_base_of_layer(cli_runner):
     layers = cli_runner("layout", "--layers").stdout
     assert "Image-42-0+2" in layers.strip()
 
+
+def test_base_add_from_base(cli_runner):
+    """ Test that a base can be created as snapshot of another base """
+    cli_runner("layout", "--bases")
+    imgbase = imgbased.imgbase.ImageLayers()
+    base = imgbased.naming.Image.from_nvr("Image-42-0")
+    imgbase.add_base("4096", "Image-43-0", from_base=base)
+
+    r = cli_runner("layout", "--bases")
+    assert "Image-43-0" in r.stdout.strip()
+    lv = imgbase._lvm_from_layer(imgbased.naming.Image.from_nvr("Image-43-0"))
+    assert lv.origin().lv_name == "Image-42-0"
+
 # Update verb tests
 
 
-def test_update(cli_runner, mocker):
+@pytest.fixture
+def update_env(mocker, tmpdir):
+    mocker.patch("imgbased.plugins.update.Timeline")
+    mocker.patch("imgbased.plugins.update.Progress")
+    mocker.patch("imgbased.plugins.update.LiveimgExtractor.preflight")
+    mocker.patch("imgbased.plugins.update._image_key",
+                 lambda fn: (fn, "0 0"))
+    mocker.patch("imgbased.constants.IMGBASED_CHECKPOINT",
+                 str(tmpdir.join("checkpoint.json")))
+    mocker.patch("imgbased.constants.IMGBASED_HASH_CACHE",
+                 str(tmpdir.join("hash-cache")))
+    mocker.patch("imgbased.constants.IMGBASED_JOURNAL",
+                 str(tmpdir.join("journal")))
+
+
+def test_update(cli_runner, mocker, update_env):
     mock_extract = mocker.patch(
         "imgbased.plugins.update.LiveimgExtractor.extract"
     )
@@ -198,4 +239,131 @@ def test_update(cli_runner, mocker):
 
     mock_extract.assert_called_once_with("/my/file")
 
+
+def test_update_base_mode(cli_runner, mocker, update_env):
+    mock_extract = mocker.patch(
+        "imgbased.plugins.update.LiveimgExtractor.extract", autospec=True
+    )
+    mock_extract.return_value = ("Image-1.0-0", "Image-2.0-0")
+
+    cli_runner("update", "--base-mode", "image", "/my/file")
+
+    extractor = mock_extract.call_args[0][0]
+    assert extractor.base_mode == "image"
+
+
+def test_update_checksum_mismatch(cli_runner, mocker, tmpdir, update_env):
+    """ Test that an image with a wrong checksum rolls the update back """
+    image = tmpdir.join("image.squashfs.img")
+    image.write("Hello")
+    mocker.patch("imgbased.plugins.update.LiveimgExtractor._extract",
+                 lambda self, fn, nvr: self._verify_image())
+    reset = mocker.patch(
+        "imgbased.plugins.update.LVM.reset_registered_volumes"
+    )
+
+    with pytest.raises(utils.ChecksumMismatchError):
+        cli_runner("update", "--checksum", "sha256:00", str(image))
+    reset.assert_called_once_with()
+
+
+def test_update_resume(cli_runner, mocker, update_env):
+    """ Test that a resumed update reuses the base of the failed update """
+    def fail(self, fn, nvr):
+        self._base_built(mocker.Mock(lv_name="Image-2.0-0.0"))
+        raise RuntimeError("Migration failed")
+
+    mocker.patch("imgbased.plugins.update.LiveimgExtractor._extract", fail)
+    reset = mocker.patch(
+        "imgbased.plugins.update.LVM.reset_registered_volumes"
+    )
+    with pytest.raises(RuntimeError):
+        cli_runner("update", "/my/file")
+    reset.assert_called_once_with(keep=["Image-2.0-0.0", None])
+
+    lv = mocker.patch("imgbased.imgbase.ImageLayers.lv")
+    add_layer = mocker.patch(
+        "imgbased.plugins.update.LiveimgExtractor._add_layer"
+    )
+    mocker.patch("imgbased.plugins.update.GarbageCollector")
+    cli_runner("update", "--resume", "/my/file")
+
+    lv.assert_called_once_with("Image-2.0-0.0")
+    add_layer.assert_called_once_with(lv.return_value)
+    checkpoint = imgbased.constants.IMGBASED_CHECKPOINT
+    assert imgbased.checkpoint.Checkpoint.load(checkpoint) is None
+
+
+def test_update_plan(cli_runner, mocker, tmpdir):
+    """ Test that the plan estimates the steps from past updates """
+    @contextmanager
+    def rootfs(fn):
+        yield namedtuple("MountPoint", "source target")(fn, str(tmpdir))
+
+    mocker.patch("imgbased.plugins.update.mounted_liveimg", rootfs)
+    mocker.patch("imgbased.plugins.update.BuildMetadata").return_value \
+        .get.return_value = "Image-2.0-0"
+    mocker.patch("imgbased.plugins.update.tree_usage",
+                 return_value=(2000, 0))
+    mocker.patch("imgbased.plugins.update.fs_usage",
+                 return_value=(2000, 5))
+    mocker.patch("imgbased.plugins.update.Preflight")
+    mocker.patch("imgbased.plugins.update.GarbageCollector")
+    mocker.patch(
+        "imgbased.plugins.update.LiveimgExtractor._recommend_size_for_tree",
+        return_value="4096B"
+    )
+    extract = mocker.patch("imgbased.plugins.update.LiveimgExtractor.extract")
+    mocker.patch("imgbased.constants.IMGBASED_LOG_DIR", str(tmpdir))
+    tmpdir.join("update-20180101T000000.jsonl").write(
+        '{"event": "step", "step": "copy-tree", "duration": 100, '
+        '"bytes": 1000, "files": 10, "result": "ok"}\n'
+        '{"event": "stop", "result": "ok", "duration": 100}\n')
+
+    r = cli_runner("update", "--plan", "/my/file")
+    assert "Update plan for Image-2.0-0 (file)" in r.stdout
+    assert "Create new base Image-2.0-0 (4.0KiB)" in r.stdout
+    assert "03:20  Copy 2.0KiB in 5 files" in r.stdout
+    assert not extract.called
+
+
+def test_update_explain(cli_runner, mocker, tmpdir):
+    """ Test that explain reports the changes of the last update """
+    path = str(tmpdir.join("journal"))
+    mocker.patch("imgbased.constants.IMGBASED_JOURNAL", path)
+    Journal.start("file", path)
+    journal.record("migrate-var", "created", ["/var/lib/new"],
+                   "new in the image")
+    Journal.stop()
+
+    r = cli_runner("update", "--explain", "/my/file")
+    assert "migrate-var: 1 created" in r.stdout
+    assert "created  /var/lib/new (new in the image)" in r.stdout
+
+
+def test_history(cli_runner, mocker, tmpdir):
+    """ Test that history shows the recorded step durations """
+    mocker.patch("imgbased.constants.IMGBASED_LOG_DIR", str(tmpdir))
+    for idx, nvr in enumerate(["Image-1.0-0", "Image-2.0-0"]):
+        tmpdir.join("update-2018010%dT000000.jsonl" % idx).write(
+            '{"event": "start", "target": "image.squashfs.img"}\n'
+            '{"event": "info", "nvr": "%s"}\n'
+            '{"event": "step", "step": "tar", "duration": %d}\n' %
+            (nvr, (idx + 1) * 10))
+
+    r = cli_runner("history")
+    assert "Image-1.0-0" in r.stdout
+    assert "Image-2.0-0" in r.stdout
+    assert "20.0!" in r.stdout
+
+
+def test_timeline_per_run(tmpdir):
+    """ Test that runs within the same second get their own timeline """
+    first = Timeline.start(str(tmpdir), "a.img")
+    first.stop("ok")
+    second = Timeline.start(str(tmpdir), "a.img")
+    second.stop("ok")
+    assert first.path != second.path
+    assert len(Timeline.list(str(tmpdir))) == 2
+
 # vim: sw=4 et sts=4
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# vim: et ts=4 sw=4 sts=4
+
+import threading
+import time
+
+import pytest
+from imgbased.scheduler import Scheduler
+
+
+def test_writers_do_not_overlap(monkeypatch):
+    monkeypatch.delenv("IMGBASED_DISABLE_THREADS", raising=False)
+    spans = {}
+
+    def work(name):
+        start = time.time()
+        time.sleep(0.05)
+        spans[name] = (start, time.time())
+
+    s = Scheduler()
+    s.add("etc", work, "etc", writes=["new /etc"])
+    s.add("systemd", work, "systemd", writes=["new /etc"])
+    s.add("var", work, "var", writes=["/var"])
+    s.add("root", work, "root", reads=["new /etc"])
+    s.add("boot", work, "boot", after=["etc", "var"])
+    s.run()
+
+    def overlap(a, b):
+        return spans[a][0] < spans[b][1] and spans[b][0] < spans[a][1]
+
+    assert overlap("etc", "var")
+    assert not overlap("etc", "systemd")
+    assert not overlap("root", "etc") and not overlap("root", "systemd")
+    assert spans["boot"][0] >= max(spans["etc"][1], spans["var"][1])
+    assert s.critical_path()[-1].name in ["boot", "systemd", "root"]
+
+
+def test_failure_stops_scheduling():
+    ran = []
+
+    def fail():
+        raise RuntimeError("broken")
+
+    s = Scheduler()
+    s.add("etc", fail)
+    s.add("var", ran.append, "var")
+    s.add("boot", ran.append, "boot", after=["etc"])
+    with pytest.raises(RuntimeError):
+        s.run()
+    assert ran == ["var"]
+    assert s.report().startswith("Critical path of")
+
+
+def test_disable_threads(monkeypatch):
+    monkeypatch.setenv("IMGBASED_DISABLE_THREADS", "1")
+    threads = []
+
+    s = Scheduler()
+    for name in ["a", "b", "c"]:
+        s.add(name, lambda: threads.append(threading.current_thread()))
+    s.run()
+    assert threads == [threading.current_thread()] * 3
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# vim: et ts=4 sw=4 sts=4
+
+import hashlib
+
+import pytest
+from imgbased import verity
+from imgbased.verity import BLOCK_SIZE, NotSealedError, VerityError
+
+
+class FakeLV(object):
+    def __init__(self, path, lv_name="Image-1.0-0"):
+        self.path = path
+        self.lv_name = lv_name
+        self._tags = set()
+
+    def tags(self):
+        return list(self._tags)
+
+    def addtag(self, tag):
+        self._tags.add(tag)
+
+    def deltag(self, tag):
+        self._tags.remove(tag)
+
+
+@pytest.fixture
+def base(mocker, tmpdir):
+    mocker.patch("imgbased.constants.IMGBASED_VERITY_DIR",
+                 str(tmpdir.join("verity")))
+    device = tmpdir.join("device")
+    data = b"".join(bytes([i % 256]) * BLOCK_SIZE for i in range(300))
+    device.write_binary(data)
+    return FakeLV(str(device))
+
+
+def _corrupt(lv, offset):
+    with open(lv.path, "r+b") as dst:
+        dst.seek(offset)
+        dst.write(b"corrupted")
+
+
+def test_tree_layout(base):
+    """ Test that the tree has the dm-verity layout, top level first """
+    tree = verity.HashTree.build(base.path, base.path + ".tree", b"salt")
+    with open(base.path + ".tree", "rb") as src:
+        top, leaves = src.read(BLOCK_SIZE), src.read()
+
+    # 300 data blocks need three leaf blocks and a single top block
+    assert len(leaves) == 3 * BLOCK_SIZE
+    with open(base.path, "rb") as src:
+        first = src.read(BLOCK_SIZE)
+    assert leaves[:32] == hashlib.sha256(b"salt" + first).digest()
+    assert top[:32] == hashlib.sha256(b"salt" +
+                                      leaves[:BLOCK_SIZE]).digest()
+    assert top[3 * 32:] == bytes(BLOCK_SIZE - 3 * 32)
+    assert tree.root_hash == hashlib.sha256(b"salt" + top).digest()
+
+
+def test_seal_and_verify(base):
+    tree = verity.seal(base)
+    assert verity.TAG_ROOT_HASH + tree.root_hash.hex() in base.tags()
+    assert verity.verify(base) == []
+
+    # Sealing again replaces the tags
+    verity.seal(base)
+    assert len(base.tags()) == 2
+
+
+def test_verify_finds_regions(base):
+    verity.seal(base)
+    _corrupt(base, 0)
+    _corrupt(base, 200 * BLOCK_SIZE + 10)
+
+    assert verity.verify(base) == [(0, BLOCK_SIZE),
+                                   (200 * BLOCK_SIZE, BLOCK_SIZE)]
+
+
+def test_verify_rebuilds_damaged_tree(base):
+    tree = verity.seal(base)
+    _corrupt(base, 0)
+    with open(tree.path, "r+b") as dst:
+        dst.seek(BLOCK_SIZE)
+        dst.write(b"damaged")
+
+    with pytest.raises(VerityError):
+        verity.verify(base)
+
+    tree = verity.seal(base)
+    with open(tree.path, "r+b") as dst:
+        dst.seek(BLOCK_SIZE)
+        dst.write(b"damaged")
+
+    assert verity.verify(base) == []
+    assert verity.sealed_tree(base).is_intact()
+
+
+def test_verify_all(base, tmpdir):
+    verity.seal(base)
+    other = FakeLV(base.path, "Image-2.0-0")
+
+    results = verity.verify_all([base, other], workers=2)
+    assert results[0] == (base, [], None)
+    assert isinstance(results[1][2], NotSealedError)